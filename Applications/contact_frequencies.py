@@ -6,16 +6,18 @@ is defined write the results to a file, otherwise write to stdout.
 
 import argparse as ap
 from collections import defaultdict
+import os
 import sys
-import re
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from contact_calc.contact_io import read_contact_header, read_contacts
 
 
 def main():
     parser = ap.ArgumentParser(description=__doc__, formatter_class=ap.RawTextHelpFormatter)
     parser.add_argument('--input',
-                        type=ap.FileType("r"),
+                        type=str,
                         required=True,
-                        help='Contact-list generated by MDContactNetwork')
+                        help='Contact-list (tsv or bin) generated by get_dynamic_contacts.py')
 
     parser.add_argument('--output',
                         type=ap.FileType("w"),
@@ -26,24 +28,13 @@ def main():
 
     interaction_frames = defaultdict(set)
     max_frame = 0
-    total_frames = 0
-    for line in args.input.readlines():
-        line = line.strip()
-        if not line:  # Ignore empty lines
-            continue
-
-        # Parse header
-        if line[0] == "#":
-            total_frame_match = re.search(r'total_frames:(\d+)', line)
-            if total_frame_match:
-                total_frames = int(total_frame_match.group(1))
-            continue
-
-        # Regex that matches a contact line and groups the frame number and the two first residues,
-        frame_resi_match = re.match(r'^(\d+)\t.*?\t([^:]+:[^:]+:\d+).*?\t([^:]+:[^:]+:\d+)', line)
-        frame = int(frame_resi_match.group(1))
-        res1 = frame_resi_match.group(2)
-        res2 = frame_resi_match.group(3)
+    header = read_contact_header(args.input)
+    total_frames = header["total_frames"] or 0
+    for contact in read_contacts(args.input):
+        # Frame number and residues of the two first atoms
+        frame = contact[0]
+        res1 = contact[2][0:contact[2].rfind(":")]
+        res2 = contact[3][0:contact[3].rfind(":")]
 
         if res2 < res1:
             res1, res2 = res2, res1
@@ -56,7 +47,8 @@ def main():
         print("total_frames must be larger than zero and defined in header")
         exit(-1)
 
-    assert max_frame < total_frames
+    # Frame numbers refer to the original trajectory, which may have been windowed or strided
+    assert max_frame < header["first_frame"] + total_frames * header["stride"]
 
     # Define output channel
     if args.output:
@@ -64,9 +56,9 @@ def main():
     else:
         output = sys.stdout
 
-    # Write contacts
+    # Write contacts, normalized by the number of computed frames like get_contact_frequencies.py
     for (res1, res2), frames in interaction_frames.items():
-        frequency = len(frames) / float(max_frame + 1)
+        frequency = len(frames) / float(total_frames)
         output.write("\t".join((res1, res2, str(frequency))) + "\n")
 
     if args.output:
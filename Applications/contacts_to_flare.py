@@ -22,6 +22,8 @@ is formatted as a comma-separated list of abbreviations corresponding to
     hlb            ligand-backbone residue hydrogen bonds
     lwb            ligand water bridges
     lwb2           extended ligand water bridges
+    wb3 ... wb6    water bridges through 3 to 6 waters
+    lwb3 ... lwb6  ligand water bridges through 3 to 6 waters
 
 By default, the labels on the plot will reflect the residue identifier.
 Optionally, a "flare-label" file can be supplied which indicates how residue
@@ -43,6 +45,12 @@ is just used as a filter. A third column can be supplied indicating a color in
 CSS-format (e.g. '#FF0000' or 'red').
 """
 
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from contact_calc.contact_io import MAX_WATER_BRIDGE_DEPTH
+from contact_calc.flare import parse_contacts
+
 
 def main():
     """
@@ -58,8 +66,8 @@ def main():
 
     required.add_argument('--input',
                           required=True,
-                          type=ap.FileType('r'),
-                          help='A multi-frame contact-file generated by dynamic_contact.py')
+                          type=str,
+                          help='A multi-frame contact-file (tsv or bin) generated by get_dynamic_contacts.py')
     required.add_argument('--output',
                           required=False,
                           type=ap.FileType('w'),
@@ -70,6 +78,14 @@ def main():
                           default="all",
                           type=str,
                           help='Interaction types to include (comma separated list) [default: all]')
+    optional.add_argument('--frame_range',
+                          required=False,
+                          default=None,
+                          type=int,
+                          nargs=2,
+                          metavar=('BEGIN', 'END'),
+                          help='Only include frames from BEGIN to END (inclusive). Uses the frame index of the '
+                               'contact-file if it was written with --frame_index')
     optional.add_argument('--flarelabels',
                           required=False,
                           default=None,
@@ -79,11 +95,11 @@ def main():
     args = parser.parse_args()
 
     if args.output:
-        print("Parsing %s contacts from %s" % (args.itype, args.input.name))
+        print("Parsing %s contacts from %s" % (args.itype, args.input))
 
     # Read contacts and generate graph
     itypes = parse_itypes(args.itype)
-    contacts = parse_contacts(args.input, itypes)
+    contacts = parse_contacts(args.input, itypes, args.frame_range)
     labels = parse_flarelabels(args.flarelabels)
     graph = create_graph(contacts, labels)
 
@@ -104,57 +120,6 @@ def main():
         print(pretty_json)
 
 
-def parse_contacts(contact_file, itypes):
-    """
-    Parses the contact file and returns it a list of atomic contacts. Atom strings are converted to tuples by splitting
-    on ":".
-
-    Parameters
-    ----------
-    contact_file: file
-        Contact-file generated by dynamic_contacts.py
-
-    itypes: set of str
-        A set of interaction types to retain.
-
-    Returns
-    -------
-    list of tuples of (str, str, tuple, tuple [[, tuple], tuple])
-        Each entry contains a column of the contact_file, e.g.
-        `[("0", "hbbb", ("A", "ARG", "4", "H"), ("A", "PHE", "22", "O")), (..) ]`
-    """
-    def parse_atom(atom_str):
-        atom_tokens = atom_str.split(":")
-        return tuple(atom_tokens)
-
-    ret = []
-    for line in contact_file:
-        line = line.strip()
-        if not line or line[0] == "#":
-            continue  # Ignore empty and commented lines
-
-        # Check number of columns is correct and skip if interaction type is not specified
-        columns = line.split("\t")
-        if not len(columns) in range(4, 7):
-            raise AssertionError("Invalid interaction line: '"+line+"'")
-        if not columns[1] in itypes:
-            continue
-
-        # Parse atoms
-        columns[2] = parse_atom(columns[2])
-        columns[3] = parse_atom(columns[3])
-        if len(columns) >= 5:
-            columns[4] = parse_atom(columns[4])
-        if len(columns) == 6:
-            columns[5] = parse_atom(columns[5])
-
-        ret.append(tuple(columns))
-
-    contact_file.close()
-
-    return ret
-
-
 def parse_flarelabels(label_file):
     """
     Parses a flare-label file and generates a dictionary mapping residue identifiers (e.g. A:ARG:123) to a
@@ -209,7 +174,9 @@ def parse_itypes(itype_argument):
     """Parses the itype argument and returns a set of strings with all the selected interaction types """
     if "all" in itype_argument:
         return ["sb", "pc", "ps", "ts", "vdw", "hb", "lhb", "hbbb", "hbsb",
-                "hbss", "wb", "wb2", "hls", "hlb", "lwb", "lwb2"]
+                "hbss", "wb", "wb2", "hls", "hlb", "lwb", "lwb2"] + \
+               ["wb%d" % depth for depth in range(3, MAX_WATER_BRIDGE_DEPTH + 1)] + \
+               ["lwb%d" % depth for depth in range(3, MAX_WATER_BRIDGE_DEPTH + 1)]
     return set(itype_argument.split(","))
 
 
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Converts a contact file between the per-frame formats (tsv or bin) and the interval
+format, in which each atom level interaction takes one line with the [start, end) frame
+intervals in which it is present. Converting tsv to int and back keeps every contact
+line of every frame, including lines repeated within a frame, but the contacts within
+a frame are ordered by the position of their interaction in the interval file.
+
+Example:
+    python convert_contacts.py --input_contacts contacts.tsv --output contacts.int --output_format int
+    python convert_contacts.py --input_contacts contacts.int --output contacts.tsv --output_format tsv
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from contact_calc.contact_io import read_contacts, read_contact_header, add_contact_intervals, \
+    write_interval_header, write_interval_contacts
+
+
+def write_tsv_contacts(input_path, output_path, header):
+    """
+    Write the contacts of any contact file as tab separated lines
+    """
+    with open(output_path, "wb") as output_fd:
+        header_line = "# total_frames:%d interaction_types:%s" % (header["total_frames"],
+                                                                   ",".join(header["interaction_types"]))
+        if header["first_frame"] != 0 or header["stride"] != 1:
+            header_line += " first_frame:%d stride:%d" % (header["first_frame"], header["stride"])
+        output_fd.write((header_line + "\n").encode())
+        output_fd.write(b"# Columns: frame, interaction_type, atom_1, atom_2[, atom_3[, atom_4]]\n")
+        for contact in read_contacts(input_path):
+            output_fd.write(("%d\t%s\n" % (contact[0], "\t".join(contact[1:]))).encode("utf-8"))
+
+
+def write_interval_file(input_path, output_path, header):
+    """
+    Write the contacts of a tsv or bin contact file as frame intervals
+    """
+    interval_contacts = add_contact_intervals({}, read_contacts(input_path), header["stride"])
+    with open(output_path, "wb") as output_fd:
+        write_interval_header(output_fd, header["total_frames"], header["interaction_types"],
+                              header["first_frame"], header["stride"])
+        write_interval_contacts(output_fd, interval_contacts)
+
+
+def main(argv=None):
+    import argparse as ap
+    parser = ap.ArgumentParser(description=__doc__, formatter_class=ap.RawTextHelpFormatter)
+    parser.add_argument('--input_contacts', type=str, required=True, help='path to a contact file in any format')
+    parser.add_argument('--output', type=str, required=True, help='path to the converted contact file')
+    parser.add_argument('--output_format', type=str, default="int", choices=["tsv", "int"],
+                        help='"int" for frame intervals or "tsv" for tab separated lines [default = int]')
+    args = parser.parse_args(argv)
+
+    header = read_contact_header(args.input_contacts)
+    if header["total_frames"] is None:
+        # Contact files without a header count frames from 0 up to the last one with contacts
+        last_frame = -1
+        for contact in read_contacts(args.input_contacts):
+            last_frame = contact[0]
+        header["total_frames"] = last_frame + 1
+
+    if args.output_format == "int":
+        write_interval_file(args.input_contacts, args.output, header)
+    else:
+        write_tsv_contacts(args.input_contacts, args.output, header)
+    print("Wrote %s in %s format" % (args.output, args.output_format))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,9 +16,11 @@ Example usages:
     pymol pymol_frequencies.py -- ../example/5xnd_topology.pdb ../example/5xnd_all-contacts.tsv
 """
 
-import re
 from collections import defaultdict
+import os
 import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from contact_calc.contact_io import read_contact_header, read_contacts
 
 # Check cmd-line arguments
 if len(sys.argv) not in [3,4] or "pymol" not in sys.modules:
@@ -39,30 +41,15 @@ cmd.load(sys.argv[1])
 
 # Parse contact-file
 interaction_frames = defaultdict(set)
-total_frames = 0
-with open(sys.argv[2]) as cfile:
-    for line in cfile.readlines():
-        line = line.strip()
-        if not line:  # Ignore empty lines
-            continue
-
-        # Parse header
-        if line[0] == "#":
-            total_frame_match = re.search(r'total_frames:(\d+)', line)
-            if total_frame_match:
-                total_frames = int(total_frame_match.group(1))
-            continue
-
-        # Regex that matches a contact line and groups the frame number and the two first residues,
-        frame_atom_match = re.match(r'^(\d+)\t.*?\t([^:]+:[^:]+:\d+:[^\s]+)\t([^:]+:[^:]+:\d+:[^\s]+)', line)
-        frame = int(frame_atom_match.group(1))
-        atom1 = frame_atom_match.group(2)
-        atom2 = frame_atom_match.group(3)
-
-        if atom2 < atom1:
-            atom1, atom2 = atom2, atom1
-
-        interaction_frames[(atom1, atom2)].add(frame)
+total_frames = read_contact_header(sys.argv[2])["total_frames"] or 0
+for contact in read_contacts(sys.argv[2]):
+    # Frame number and the two first atoms
+    frame, atom1, atom2 = contact[0], contact[2], contact[3]
+
+    if atom2 < atom1:
+        atom1, atom2 = atom2, atom1
+
+    interaction_frames[(atom1, atom2)].add(frame)
 
 
 
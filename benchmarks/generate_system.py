@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+############################################################################
+# Copyright 2018 Anthony Ma & Stanford University                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+"""
+Generates a synthetic solvated protein of a given size as a PSF topology and a DCD
+trajectory, for benchmarking get_dynamic_contacts.py at production scale.
+
+Residues are drawn from a small set of templates (ALA, SER, ASP, LYS and PHE) so that
+the aromatic and charged content can be controlled, and are placed on a cubic grid
+with random orientations, chain after chain. TIP3 waters fill the grid sites closest to
+the protein. Frames are the initial coordinates with Gaussian noise, so contacts
+fluctuate from frame to frame. Only NumPy is required.
+
+Example:
+    python3 generate_system.py --num_atoms 100k --num_frames 100 --output_prefix data/system_100k
+"""
+
+##############################################################################
+# Imports
+##############################################################################
+
+import argparse
+import struct
+import numpy as np
+
+##############################################################################
+# Globals
+##############################################################################
+
+ELEMENT_MASSES = {"C": 12.011, "N": 14.007, "O": 15.999, "H": 1.008}
+GRID_SPACING = 3.1  # Angstroms between grid sites, a residue occupies 2x2x2 sites and a water one site
+CHAIN_LENGTH = 200
+
+# Backbone atoms shared by all residue templates
+BACKBONE_ATOMS = [("N", 0.00, -1.20, -1.00, -0.47), ("HN", -0.60, -1.90, -1.40, 0.31),
+                  ("CA", 0.00, -0.10, -0.10, 0.07), ("C", 1.20, 0.00, -0.90, 0.51),
+                  ("O", 2.20, -0.60, -0.70, -0.51)]
+BACKBONE_BONDS = [("N", "HN"), ("N", "CA"), ("CA", "C"), ("C", "O")]
+# CG, CD1, CE1, CZ, CE2, CD2 on a planar hexagon with 1.39 angstrom sides
+PHE_RING = [(0.1 + 1.39 * np.sin(angle), 2.8 - 1.39 * np.cos(angle), 1.0) for angle in np.radians(range(0, 360, 60))]
+
+# Residue templates as (name, x, y, z, charge) for each sidechain atom and the bonds among them
+RESIDUE_TEMPLATES = {
+    "ALA": {"atoms": [("CB", 0.10, 0.20, 1.40, -0.27)],
+            "bonds": [("CA", "CB")]},
+    "SER": {"atoms": [("CB", 0.10, 0.20, 1.40, 0.05), ("OG", 0.20, 1.60, 1.50, -0.66),
+                      ("HG1", 0.30, 1.90, 2.40, 0.43)],
+            "bonds": [("CA", "CB"), ("CB", "OG"), ("OG", "HG1")]},
+    "ASP": {"atoms": [("CB", 0.10, 0.20, 1.40, -0.28), ("CG", 0.20, 1.60, 1.90, 0.62),
+                      ("OD1", -0.60, 2.40, 1.40, -0.76), ("OD2", 1.10, 1.90, 2.70, -0.76)],
+            "bonds": [("CA", "CB"), ("CB", "CG"), ("CG", "OD1"), ("CG", "OD2")]},
+    "LYS": {"atoms": [("CB", 0.10, 0.20, 1.40, -0.18), ("CG", 0.20, 1.60, 1.00, -0.18),
+                      ("CD", 0.30, 2.60, 2.10, -0.18), ("CE", 0.40, 4.00, 1.60, 0.21),
+                      ("NZ", 0.50, 5.00, 2.60, -0.30), ("HZ1", 1.30, 4.90, 3.20, 0.33),
+                      ("HZ2", -0.30, 5.00, 3.20, 0.33), ("HZ3", 0.50, 5.90, 2.10, 0.33)],
+            "bonds": [("CA", "CB"), ("CB", "CG"), ("CG", "CD"), ("CD", "CE"), ("CE", "NZ"),
+                      ("NZ", "HZ1"), ("NZ", "HZ2"), ("NZ", "HZ3")]},
+    "PHE": {"atoms": [("CB", 0.10, 0.20, 1.40, -0.18)] +
+                     [(name, x, y, z, -0.12) for name, (x, y, z) in zip(["CG", "CD1", "CE1", "CZ", "CE2", "CD2"],
+                                                                       PHE_RING)],
+            "bonds": [("CA", "CB"), ("CB", "CG"), ("CG", "CD1"), ("CD1", "CE1"), ("CE1", "CZ"),
+                      ("CZ", "CE2"), ("CE2", "CD2"), ("CD2", "CG")]},
+}
+WATER_ATOMS = [("OH2", 0.0, 0.0, 0.0, -0.834), ("H1", 0.9572, 0.0, 0.0, 0.417), ("H2", -0.24, 0.927, 0.0, 0.417)]
+WATER_BONDS = [("OH2", "H1"), ("OH2", "H2")]
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def parse_size(size):
+    """
+    Parse a number of atoms with an optional k or M suffix, ie "100k" or "1M"
+    """
+    multipliers = {"k": 1000, "K": 1000, "m": 1000000, "M": 1000000}
+    if size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def random_rotation(rng):
+    """
+    Uniformly distributed random 3x3 rotation matrix
+    """
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    q *= np.sign(np.diag(r))
+    if np.linalg.det(q) < 0:
+        q[:, 0] = -q[:, 0]
+    return q
+
+
+def gen_residue_sequence(num_protein_atoms, aromatic_fraction, charged_fraction, rng):
+    """
+    Draw residue names until they hold at least `num_protein_atoms` atoms. Charged residues are
+    split evenly between LYS and ASP, and the remaining residues between ALA and SER.
+    """
+    resnames = ["PHE", "LYS", "ASP", "ALA", "SER"]
+    neutral_fraction = max(0.0, 1.0 - aromatic_fraction - charged_fraction)
+    probabilities = np.array([aromatic_fraction, charged_fraction / 2, charged_fraction / 2,
+                              neutral_fraction / 2, neutral_fraction / 2])
+    probabilities /= probabilities.sum()
+    residue_sizes = {resname: len(BACKBONE_ATOMS) + len(RESIDUE_TEMPLATES[resname]["atoms"]) for resname in resnames}
+
+    sequence, num_atoms = [], 0
+    while num_atoms < num_protein_atoms:
+        for resname in rng.choice(resnames, size=1024, p=probabilities):
+            if num_atoms >= num_protein_atoms:
+                break
+            sequence.append(str(resname))
+            num_atoms += residue_sizes[resname]
+    return sequence
+
+
+def gen_system(num_atoms, water_fraction, aromatic_fraction, charged_fraction, seed=0):
+    """
+    Build a synthetic solvated protein with approximately `num_atoms` atoms
+
+    Parameters
+    ----------
+    num_atoms: int
+    water_fraction: float
+        Fraction of atoms in TIP3 waters
+    aromatic_fraction: float
+        Fraction of residues that are PHE
+    charged_fraction: float
+        Fraction of residues that are LYS or ASP
+    seed: int, default = 0
+
+    Returns
+    -------
+    system: dict
+        "atoms" holds a (segid, resid, resname, name, charge) tuple per atom, "bonds" an
+        np.array of shape (num_bonds, 2) with 0-based atom positions and "coords" an
+        np.array of shape (num_atoms, 3)
+    """
+    rng = np.random.RandomState(seed)
+    num_waters = int(round(num_atoms * water_fraction / len(WATER_ATOMS)))
+    sequence = gen_residue_sequence(num_atoms - num_waters * len(WATER_ATOMS), aromatic_fraction,
+                                    charged_fraction, rng)
+
+    # Smallest grid with an even number of sites per side that holds all residues and waters
+    grid_size = 2
+    while grid_size ** 3 < 8 * len(sequence) + num_waters:
+        grid_size += 2
+    num_blocks = grid_size // 2
+
+    # Residues fill 2x2x2 blocks in snake order, so consecutive residues of a chain are neighbors
+    blocks = []
+    for bz in range(num_blocks):
+        for by in (range(num_blocks) if bz % 2 == 0 else reversed(range(num_blocks))):
+            for bx in (range(num_blocks) if (by + bz) % 2 == 0 else reversed(range(num_blocks))):
+                blocks.append((bx, by, bz))
+    residue_blocks = np.array(blocks[0:len(sequence)], dtype=np.int64)
+
+    atoms, bonds, coords = [], [], []
+
+    def add_molecule(segid, resid, resname, template_atoms, template_bonds, center):
+        rotation = random_rotation(rng)
+        template_coords = np.array([atom[1:4] for atom in template_atoms])
+        template_coords = (template_coords - template_coords.mean(axis=0)).dot(rotation.T) + center
+        positions = {}
+        for (name, _, _, _, charge), position in zip(template_atoms, template_coords):
+            positions[name] = len(atoms)
+            atoms.append((segid, resid, resname, name, charge))
+            coords.append(position)
+        bonds.extend((positions[name1], positions[name2]) for name1, name2 in template_bonds)
+        return positions
+
+    previous_carbon = None
+    for residue_idx, (resname, block) in enumerate(zip(sequence, residue_blocks)):
+        chain_idx = residue_idx // CHAIN_LENGTH
+        template = RESIDUE_TEMPLATES[resname]
+        positions = add_molecule("P%d" % chain_idx, residue_idx + 1, resname, BACKBONE_ATOMS + template["atoms"],
+                                 BACKBONE_BONDS + template["bonds"], (2 * block + 1) * GRID_SPACING)
+        if residue_idx % CHAIN_LENGTH != 0:
+            bonds.append((previous_carbon, positions["N"]))
+        previous_carbon = positions["C"]
+
+    # Waters take the free sites closest to the protein
+    occupied = np.zeros((grid_size, grid_size, grid_size), dtype=bool)
+    for offset in np.ndindex(2, 2, 2):
+        occupied[tuple((2 * residue_blocks + offset).T)] = True
+    free_sites = np.argwhere(~occupied)
+    protein_center = (2 * residue_blocks + 1).mean(axis=0) if len(residue_blocks) else np.zeros(3)
+    site_distances = np.linalg.norm(free_sites + 0.5 - protein_center, axis=1)
+    water_sites = free_sites[np.argsort(site_distances, kind="stable")[0:num_waters]]
+    for water_idx, site in enumerate(water_sites):
+        add_molecule("WAT", water_idx + 1, "TIP3", WATER_ATOMS, WATER_BONDS, (site + 0.5) * GRID_SPACING)
+
+    return {"atoms": atoms, "bonds": np.array(bonds, dtype=np.int64).reshape(-1, 2),
+            "coords": np.array(coords, dtype=np.float32)}
+
+
+def write_psf(psf_path, system):
+    """
+    Write the atoms and bonds of `system` to an extended format PSF file
+    """
+    with open(psf_path, "w") as psf_fd:
+        psf_fd.write("PSF EXT\n\n")
+        psf_fd.write("%10d !NTITLE\n" % 1)
+        psf_fd.write(" REMARKS synthetic system generated by benchmarks/generate_system.py\n\n")
+
+        psf_fd.write("%10d !NATOM\n" % len(system["atoms"]))
+        for atom_idx, (segid, resid, resname, name, charge) in enumerate(system["atoms"]):
+            element = name[0]
+            psf_fd.write("%10d %-8s %-8d %-8s %-8s %-6s %14.6f%14.4f%8d\n" %
+                         (atom_idx + 1, segid, resid, resname, name, element, charge, ELEMENT_MASSES[element], 0))
+        psf_fd.write("\n")
+
+        bonds = system["bonds"] + 1
+        psf_fd.write("%10d !NBOND: bonds\n" % len(bonds))
+        for line_beg in range(0, len(bonds), 4):
+            psf_fd.write("".join("%10d%10d" % (atom1, atom2) for atom1, atom2 in bonds[line_beg:line_beg + 4]) + "\n")
+        psf_fd.write("\n")
+
+        for section in ("!NTHETA: angles", "!NPHI: dihedrals", "!NIMPHI: impropers", "!NDON: donors",
+                        "!NACC: acceptors"):
+            psf_fd.write("%10d %s\n\n" % (0, section))
+
+
+def write_fortran_record(output_fd, data):
+    """
+    Write `data` as an unformatted Fortran record, framed by its length in bytes
+    """
+    output_fd.write(struct.pack("<i", len(data)))
+    output_fd.write(data)
+    output_fd.write(struct.pack("<i", len(data)))
+
+
+def write_dcd(dcd_path, coords, num_frames, jitter, seed=0):
+    """
+    Write a CHARMM format DCD trajectory whose frames are `coords` with Gaussian noise
+
+    Parameters
+    ----------
+    dcd_path: str
+    coords: np.array of shape (num_atoms, 3)
+    num_frames: int
+    jitter: float
+        Standard deviation of the noise added to each coordinate, in angstroms
+    seed: int, default = 0
+    """
+    rng = np.random.RandomState(seed + 1)
+    num_atoms = len(coords)
+    icntrl = [num_frames, 0, 1, num_frames, 0, 0, 0, 0, 0]
+    with open(dcd_path, "wb") as dcd_fd:
+        # CORD, 9 ints, the timestep as a float and 10 ints ending with the CHARMM version
+        write_fortran_record(dcd_fd, b"CORD" + struct.pack("<9i", *icntrl) + struct.pack("<f", 1.0) +
+                             struct.pack("<10i", 0, 0, 0, 0, 0, 0, 0, 0, 0, 24))
+        title = "Synthetic trajectory generated by benchmarks/generate_system.py".ljust(80)
+        write_fortran_record(dcd_fd, struct.pack("<i", 1) + title.encode("ascii"))
+        write_fortran_record(dcd_fd, struct.pack("<i", num_atoms))
+
+        for _ in range(num_frames):
+            frame = coords + rng.normal(0, jitter, size=coords.shape).astype(np.float32)
+            for dim in range(3):
+                write_fortran_record(dcd_fd, np.ascontiguousarray(frame[:, dim], dtype="<f4").tobytes())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic solvated protein as PSF and DCD files")
+    parser.add_argument('--num_atoms', type=str, default="10k", help='approximate number of atoms, ie 10k, 100k or 1M')
+    parser.add_argument('--num_frames', type=int, default=100, help='number of trajectory frames')
+    parser.add_argument('--water_fraction', type=float, default=0.6, help='fraction of atoms in TIP3 waters')
+    parser.add_argument('--aromatic_fraction', type=float, default=0.1, help='fraction of residues that are PHE')
+    parser.add_argument('--charged_fraction', type=float, default=0.2, help='fraction of residues that are LYS or ASP')
+    parser.add_argument('--jitter', type=float, default=0.3, help='standard deviation of coordinate noise per frame')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output_prefix', type=str, required=True, help='writes OUTPUT_PREFIX.psf and OUTPUT_PREFIX.dcd')
+    args = parser.parse_args(argv)
+
+    system = gen_system(parse_size(args.num_atoms), args.water_fraction, args.aromatic_fraction,
+                        args.charged_fraction, args.seed)
+    write_psf(args.output_prefix + ".psf", system)
+    write_dcd(args.output_prefix + ".dcd", system["coords"], args.num_frames, args.jitter, args.seed)
+    print("Wrote %s.psf and %s.dcd with %d atoms and %d frames" %
+          (args.output_prefix, args.output_prefix, len(system["atoms"]), args.num_frames))
+
+
+if __name__ == "__main__":
+    main()
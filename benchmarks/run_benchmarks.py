@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+############################################################################
+# Copyright 2018 Anthony Ma & Stanford University                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+"""
+Runs get_dynamic_contacts.py on synthetic systems from generate_system.py for each
+combination of system size, interaction type and core count, and records frames per
+second, peak resident memory and output size as one tab separated line per run.
+
+Each run is a separate process, so peak memory is measured per run. It is the largest
+sum of the resident sets of the main process and all of its workers, sampled from /proc
+while the run is going, so it covers the memory of the whole run rather than of its
+largest process.
+Systems are generated once in the data directory and reused by later invocations.
+
+Example:
+    python3 run_benchmarks.py --sizes 10k 100k --itypes vdw hb all --cores 1 4 --results results.tsv
+"""
+
+##############################################################################
+# Imports
+##############################################################################
+
+import argparse
+import datetime
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+from generate_system import parse_size, gen_system, write_psf, write_dcd
+
+##############################################################################
+# Globals
+##############################################################################
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+GET_DYNAMIC_CONTACTS = os.path.join(os.path.dirname(BENCHMARK_DIR), "get_dynamic_contacts.py")
+
+# Default number of frames per system size, so that each run takes a comparable amount of time
+DEFAULT_NUM_FRAMES = {10000: 200, 100000: 50, 1000000: 10}
+# Seconds between samples of the resident memory of a run
+RSS_SAMPLE_INTERVAL = 0.1
+RESULT_COLUMNS = ["size", "num_atoms", "num_frames", "itypes", "cores", "seconds", "frames_per_sec",
+                  "peak_rss_mb", "output_bytes", "returncode"]
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def prepare_system(data_dir, size, num_frames, water_fraction, aromatic_fraction, charged_fraction, seed):
+    """
+    Generate the PSF and DCD files of a synthetic system unless they already exist
+
+    Returns
+    -------
+    prefix: str
+        Path of the system without the .psf and .dcd extensions
+    """
+    prefix = os.path.join(data_dir, "system_%s_%dframes_w%g_a%g_c%g_s%d" %
+                          (size, num_frames, water_fraction, aromatic_fraction, charged_fraction, seed))
+    if not (os.path.exists(prefix + ".psf") and os.path.exists(prefix + ".dcd")):
+        print("Generating %s" % prefix)
+        system = gen_system(parse_size(size), water_fraction, aromatic_fraction, charged_fraction, seed)
+        write_psf(prefix + ".psf", system)
+        write_dcd(prefix + ".dcd", system["coords"], num_frames, 0.3, seed)
+    return prefix
+
+
+def count_psf_atoms(psf_path):
+    """
+    Number of atoms stated in the !NATOM line of a PSF file
+    """
+    with open(psf_path, "r") as psf_fd:
+        for line in psf_fd:
+            if "!NATOM" in line:
+                return int(line.split()[0])
+    return 0
+
+
+def process_tree_rss_kb(pid):
+    """
+    Sum of the resident set sizes in kilobytes of process `pid` and all of its descendants,
+    read from /proc. Processes that exit while they are read are skipped.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as stat_fd:
+                # The command name may contain spaces, the parent pid is the second field after it
+                ppid = int(stat_fd.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    rss_kb, pids = 0, [pid]
+    while pids:
+        current_pid = pids.pop()
+        pids.extend(children.get(current_pid, []))
+        try:
+            with open("/proc/%d/status" % current_pid) as status_fd:
+                for line in status_fd:
+                    if line.startswith("VmRSS:"):
+                        rss_kb += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return rss_kb
+
+
+def run_contacts(prefix, itypes, cores, output, log_path, contact_args):
+    """
+    Run get_dynamic_contacts.py on a synthetic system in a child process
+
+    Returns
+    -------
+    seconds: float
+        Wall clock time of the run
+    peak_rss_mb: float
+        Largest sum of the resident set sizes of the child and its workers, see `process_tree_rss_kb`
+    returncode: int
+        Exit code of the child, negative if it was killed by a signal
+    """
+    command = [sys.executable, GET_DYNAMIC_CONTACTS, "--topology", prefix + ".psf", "--trajectory", prefix + ".dcd",
+               "--output", output, "--cores", str(cores), "--itypes"] + itypes + contact_args
+    tic = datetime.datetime.now()
+    peak_rss_kb = 0
+    with open(log_path, "w") as log_fd:
+        process = subprocess.Popen(command, stdout=log_fd, stderr=subprocess.STDOUT)
+        while process.poll() is None:
+            peak_rss_kb = max(peak_rss_kb, process_tree_rss_kb(process.pid))
+            time.sleep(RSS_SAMPLE_INTERVAL)
+    toc = datetime.datetime.now()
+    return (toc - tic).total_seconds(), peak_rss_kb / 1024.0, process.returncode
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark get_dynamic_contacts.py on synthetic systems")
+    parser.add_argument('--sizes', type=str, nargs="+", default=["10k", "100k", "1M"],
+                        help='approximate number of atoms of each system, ie 10k 100k 1M')
+    parser.add_argument('--num_frames', type=int, default=None,
+                        help='frames per system [default = 200, 50 and 10 frames for 10k, 100k and 1M atoms]')
+    parser.add_argument('--itypes', type=str, nargs="+", default=["sb", "pc", "ps", "ts", "vdw", "hb", "all"],
+                        help='interaction types to benchmark, each one in a separate run')
+    parser.add_argument('--cores', type=int, nargs="+", default=[1, os.cpu_count() or 1],
+                        help='core counts to benchmark')
+    parser.add_argument('--water_fraction', type=float, default=0.6, help='fraction of atoms in TIP3 waters')
+    parser.add_argument('--aromatic_fraction', type=float, default=0.1, help='fraction of residues that are PHE')
+    parser.add_argument('--charged_fraction', type=float, default=0.2, help='fraction of residues that are LYS or ASP')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic systems')
+    parser.add_argument('--data_dir', type=str, default=os.path.join(BENCHMARK_DIR, "data"),
+                        help='directory for systems, contact outputs and logs')
+    parser.add_argument('--contact_args', type=str, default="",
+                        help='extra arguments for get_dynamic_contacts.py, ie "--neighbor_engine cell"')
+    parser.add_argument('--results', type=str, default=None, help='append results to this tsv file [default = stdout]')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.data_dir):
+        os.makedirs(args.data_dir)
+    contact_args = shlex.split(args.contact_args)
+
+    results_fd = sys.stdout
+    if args.results is not None:
+        write_header = not os.path.exists(args.results)
+        results_fd = open(args.results, "a")
+        if write_header:
+            results_fd.write("\t".join(RESULT_COLUMNS) + "\n")
+    else:
+        results_fd.write("\t".join(RESULT_COLUMNS) + "\n")
+
+    try:
+        for size in args.sizes:
+            num_frames = args.num_frames or DEFAULT_NUM_FRAMES.get(parse_size(size), 20)
+            prefix = prepare_system(args.data_dir, size, num_frames, args.water_fraction, args.aromatic_fraction,
+                                    args.charged_fraction, args.seed)
+            num_atoms = count_psf_atoms(prefix + ".psf")
+            for itype in args.itypes:
+                for cores in args.cores:
+                    run_name = "%s_%s_%dcores" % (os.path.basename(prefix), itype, cores)
+                    output = os.path.join(args.data_dir, run_name + ".contacts")
+                    seconds, peak_rss_mb, returncode = run_contacts(prefix, [itype], cores, output,
+                                                                    os.path.join(args.data_dir, run_name + ".log"),
+                                                                    contact_args)
+                    output_bytes = os.path.getsize(output) if os.path.exists(output) else 0
+                    row = [size, num_atoms, num_frames, itype, cores, "%.3f" % seconds,
+                           "%.3f" % (num_frames / seconds), "%.1f" % peak_rss_mb, output_bytes, returncode]
+                    results_fd.write("\t".join(map(str, row)) + "\n")
+                    results_fd.flush()
+    finally:
+        if results_fd is not sys.stdout:
+            results_fd.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -21,61 +21,58 @@
 from vmd import *
 from .contact_utils import *
 
-__all__ = ['compute_pi_stacking', 'compute_t_stacking']
+__all__ = ['calc_fragment_ring_geometry', 'compute_pi_stacking', 'compute_t_stacking']
 
 ############################################################################
 # Functions
 ############################################################################
 
 
-def get_aromatic_triplet(traj_frag_molid, frame_idx, aromatic_residue_label):
+def calc_fragment_ring_geometry(traj_frag_molid, interaction_topology):
     """
-    Given an aromatic residue label return triplet of atoms on the ring
+    Compute centroids and normal vectors of every aromatic ring in every frame of a trajectory fragment
 
     Parameters
     ----------
     traj_frag_molid: int
         Identifier to simulation fragment in VMD
-    frame_idx: int
-        Frame number to query
-    aromatic_residue_label: string
-        ie "A:PHE:222"
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
 
     Returns
     -------
-    aromatic_atom_triplet: list of strings
-        ie ["A:PHE:329:CE1:55228", "A:PHE:329:CE2:55234", "A:PHE:329:CG:55225"]
+    ring_geometry: dict mapping string to np.array
+        ring_atom_coords: (num_frames, num_rings, 3, 3) coordinates of the atoms in `aromatic_triplets`
+        centroids: (num_frames, num_rings, 3) center of each ring
+        normal_vectors: (num_frames, num_rings, 3) vector normal to the plane of each ring
     """
+    aromatic_triplets = interaction_topology["aromatic_triplets"]
+    num_frames = molecule.numframes(traj_frag_molid)
+    ring_atom_coords = np.empty((num_frames, len(aromatic_triplets), 3, 3))
+    for frame_idx in range(num_frames):
+        ring_atom_coords[frame_idx] = vmdnumpy.timestep(traj_frag_molid, frame_idx)[aromatic_triplets]
 
-    residue_to_atom_names = {"PHE": "CG CE1 CE2", "TRP": "CD2 CZ2 CZ3", "TYR": "CG CE1 CE2"}
-    chain, resname, resid = aromatic_residue_label.split(":")
-    evaltcl("set aromatic_atoms [atomselect %s \" (chain %s) and (resname %s) and (resid %s) and (name %s)\" frame %s]"
-            % (traj_frag_molid, chain, resname, resid, residue_to_atom_names[resname], frame_idx))
-    aromatic_atom_triplet = get_atom_selection_labels("aromatic_atoms")
-    evaltcl('$aromatic_atoms delete')
-    return aromatic_atom_triplet
+    centroids, normal_vectors = calc_ring_geometry(ring_atom_coords)
+    return {"ring_atom_coords": ring_atom_coords, "centroids": centroids, "normal_vectors": normal_vectors}
 
 
-def compute_aromatics(traj_frag_molid, frame_idx, index_to_label, sele_id, itype,
-                      SOFT_DISTANCE_CUTOFF, DISTANCE_CUTOFF, ANGLE_CUTOFF, PSI_ANGLE_CUTOFF):
+def compute_aromatics(frame_idx, ring_geometry, interaction_topology, itype, SOFT_DISTANCE_CUTOFF, DISTANCE_CUTOFF,
+                      ANGLE_CUTOFF, PSI_ANGLE_CUTOFF):
     """
     Compute aromatic interactions in a frame of simulation
 
     Parameters
     ----------
-    traj_frag_molid: int
-        Identifier to simulation fragment in VMD
     frame_idx: int
         Frame number to query
-    index_to_label: dict
-        Maps VMD atom index to label "chain:resname:resid:name:index"
-        {11205: "A:ASP:114:CA:11205, ...}
-    sele_id: string, default = None
-        Compute contacts on subset of atom selection based on VMD query
+    ring_geometry: dict
+        Ring coordinates, centroids and normal vectors of the fragment from `calc_fragment_ring_geometry`
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
     itype: string
         Specify which type of aromatics ("ps" or "ts") to compute
     SOFT_DISTANCE_CUTOFF: float
-        Soft distance cutoff to find candidate aromatic pairs
+        Soft distance cutoff between ring atoms to find candidate aromatic pairs
     DISTANCE_CUTOFF: float
         Cutoff distance between aromatic centers
     ANGLE_CUTOFF: float
@@ -85,123 +82,68 @@ def compute_aromatics(traj_frag_molid, frame_idx, index_to_label, sele_id, itype
 
     Returns
     -------
-    aromatics = list of tuples, [(frame_index, atom1_label, atom2_label, itype), ...]
+    aromatics = list of lists, [[frame_index, itype_code, ring1_cg_index, ring2_cg_index], ...]
         itype = "ps" or "ts"
     """
 
     aromatics = []
-
-    if sele_id is None:
-        aromatic_atom_sel = "set aromatic_atoms [atomselect %s \" " \
-                            "((resname PHE) and (name CG CE1 CE2)) or " \
-                            "((resname TRP) and (name CD2 CZ2 CZ3)) or " \
-                            "((resname TYR) and (name CG CE1 CE2)) \" frame %s]" % (traj_frag_molid, frame_idx)
-    else:
-        aromatic_atom_sel = "set aromatic_atoms [atomselect %s \" " \
-                            "((resname PHE) and (name CG CE1 CE2) and (%s)) or " \
-                            "((resname TRP) and (name CD2 CZ2 CZ3) and (%s)) or " \
-                            "((resname TYR) and (name CG CE1 CE2) and (%s)) \" frame %s]" % \
-                            (traj_frag_molid, sele_id, sele_id, sele_id, frame_idx)
-
-    evaltcl(aromatic_atom_sel)
-    contacts = evaltcl("measure contacts %s $aromatic_atoms" % (SOFT_DISTANCE_CUTOFF))
-    evaltcl("$aromatic_atoms delete")
-
-    # Calculate set of distinct aromatic candidate pairs that may have pi-stacking
-    contact_index_pairs = parse_contacts(contacts)
-    res_pairs = set()
-    residue_to_atom_labels = {}
-    for aromatic1_index, aromatic2_index in contact_index_pairs:
-        aromatic1_label = index_to_label[aromatic1_index]
-        aromatic2_label = index_to_label[aromatic2_index]
-
-        # Check if the two atoms belong to same aromatic group
-        aromatic1_res = ":".join(aromatic1_label.split(":")[0:3])
-        aromatic2_res = ":".join(aromatic2_label.split(":")[0:3])
-        if aromatic1_res == aromatic2_res:
-            continue
-
-        if aromatic1_res not in residue_to_atom_labels:
-            residue_to_atom_labels[aromatic1_res] = get_aromatic_triplet(traj_frag_molid, frame_idx, aromatic1_res)
-        if aromatic2_res not in residue_to_atom_labels:
-            residue_to_atom_labels[aromatic2_res] = get_aromatic_triplet(traj_frag_molid, frame_idx, aromatic2_res)
-
-        k1 = (aromatic1_res, aromatic2_res)
-        k2 = (aromatic2_res, aromatic1_res)
-        if k1 not in res_pairs and k2 not in res_pairs:
-            res_pairs.add((aromatic1_res, aromatic2_res))
-
-    # Perform strict geometric criterion on candidate aromatic pairs
-    for aromatic1_res, aromatic2_res in res_pairs:
-        aromatic1_atom_labels = residue_to_atom_labels[aromatic1_res]
-        aromatic2_atom_labels = residue_to_atom_labels[aromatic2_res]
-
-        # Distance between two aromatic centers must be below DISTANCE_CUTOFF
-        arom1_atom1_coord = get_coord(traj_frag_molid, frame_idx, aromatic1_atom_labels[0])
-        arom1_atom2_coord = get_coord(traj_frag_molid, frame_idx, aromatic1_atom_labels[1])
-        arom1_atom3_coord = get_coord(traj_frag_molid, frame_idx, aromatic1_atom_labels[2])
-
-        arom2_atom1_coord = get_coord(traj_frag_molid, frame_idx, aromatic2_atom_labels[0])
-        arom2_atom2_coord = get_coord(traj_frag_molid, frame_idx, aromatic2_atom_labels[1])
-        arom2_atom3_coord = get_coord(traj_frag_molid, frame_idx, aromatic2_atom_labels[2])
-
-        aromatic1_centroid = calc_geom_centroid(arom1_atom1_coord, arom1_atom2_coord, arom1_atom3_coord)
-        aromatic2_centroid = calc_geom_centroid(arom2_atom1_coord, arom2_atom2_coord, arom2_atom3_coord)
-        aromatic_centers_distance = calc_geom_distance(aromatic1_centroid, aromatic2_centroid)
-        if aromatic_centers_distance > DISTANCE_CUTOFF:
-            continue
-
-        # Angle between vectors normal to each aromatic plane must be below cutoff
-        aromatic1_normal_vector = calc_geom_normal_vector(arom1_atom1_coord, arom1_atom2_coord, arom1_atom3_coord)
-        aromatic2_normal_vector = calc_geom_normal_vector(arom2_atom1_coord, arom2_atom2_coord, arom2_atom3_coord)
-        aromatic_plane_alignment_angle = calc_angle_between_vectors(aromatic1_normal_vector, aromatic2_normal_vector)
-        if itype == "ps":
-            aromatic_plane_alignment_angle = min(math.fabs(aromatic_plane_alignment_angle - 0),
-                                                 math.fabs(aromatic_plane_alignment_angle - 180))
-            if aromatic_plane_alignment_angle > ANGLE_CUTOFF:
-                continue
-        elif itype == "ts":
-            aromatic_plane_perpendicular_angle = \
-                math.fabs(calc_angle_between_vectors(aromatic1_normal_vector, aromatic2_normal_vector) - 90)
-            if aromatic_plane_perpendicular_angle > ANGLE_CUTOFF:
-                continue
-
-        # Psi Angle cutoff
-        psi_angle1 = calc_geom_psi_angle(aromatic1_centroid, aromatic2_centroid, aromatic1_normal_vector)
-        psi_angle2 = calc_geom_psi_angle(aromatic2_centroid, aromatic1_centroid, aromatic2_normal_vector)
-        psi_angle = min(psi_angle1, psi_angle2)
-        if psi_angle > PSI_ANGLE_CUTOFF:
-            continue
-
-        # Returns a single interaction between the CG atom of each aromatic ring
-        arom1_CG_label = convert_to_single_atom_aromatic_string(aromatic1_atom_labels[0])
-        arom2_CG_label = convert_to_single_atom_aromatic_string(aromatic2_atom_labels[0])
-        aromatics.append([frame_idx, itype, arom1_CG_label, arom2_CG_label])
-
-        # Returns all 3x3 combinations of aromatic interaction pairs (DEPRECATED)
-        # for arom1_atom_label in aromatic1_atom_labels:
-        #     for arom2_atom_label in aromatic2_atom_labels:
-        #         aromatics.append([frame_idx, itype, arom1_atom_label, arom2_atom_label])
+    aromatic_triplets = interaction_topology["aromatic_triplets"]
+    num_rings = len(aromatic_triplets)
+    if num_rings < 2:
+        return aromatics
+
+    ring_atom_coords = ring_geometry["ring_atom_coords"][frame_idx]
+    centroids = ring_geometry["centroids"][frame_idx]
+    normal_vectors = ring_geometry["normal_vectors"][frame_idx]
+
+    # Candidate pairs of distinct rings have ring atoms inside `--sele` within the soft cutoff
+    ring_atom_in_sele = interaction_topology["sele_mask"][aromatic_triplets]
+    ring_atom_distances = calc_distance_matrix(ring_atom_coords[:, np.newaxis], ring_atom_coords[np.newaxis, :])
+    ring_atom_contacts = (ring_atom_distances <= SOFT_DISTANCE_CUTOFF) & \
+                         ring_atom_in_sele[:, np.newaxis, :, np.newaxis] & ring_atom_in_sele[np.newaxis, :, np.newaxis, :]
+    candidate_pairs = np.triu(ring_atom_contacts.any(axis=(2, 3)), k=1)
+    count_profile("candidate_pairs", candidate_pairs.sum(), per_stage=True)
+
+    # Distance between two aromatic centers must be below DISTANCE_CUTOFF
+    centers_distances = calc_distance_matrix(centroids, centroids)
+
+    # Angle between vectors normal to each aromatic plane must be below cutoff
+    plane_angles = calc_angles_between_vectors(normal_vectors[:, np.newaxis], normal_vectors[np.newaxis, :])
+    if itype == "ps":
+        plane_angles = np.minimum(np.fabs(plane_angles - 0), np.fabs(plane_angles - 180))
+    elif itype == "ts":
+        plane_angles = np.fabs(plane_angles - 90)
+
+    # Psi Angle cutoff, psi_angles[i, j] is measured between normal vector of ring i and vector from ring j to ring i
+    center_to_center_vectors = centroids[:, np.newaxis] - centroids[np.newaxis, :]
+    psi_angles = calc_angles_between_vectors(normal_vectors[:, np.newaxis], center_to_center_vectors)
+    psi_angles = np.minimum(np.fabs(psi_angles - 0), np.fabs(psi_angles - 180))
+    psi_angles = np.minimum(psi_angles, psi_angles.T)
+
+    interacting_pairs = candidate_pairs & (centers_distances <= DISTANCE_CUTOFF) & \
+                        (plane_angles <= ANGLE_CUTOFF) & (psi_angles <= PSI_ANGLE_CUTOFF)
+
+    # Returns a single interaction between the CG atom of each aromatic ring
+    ring_cg_atoms = interaction_topology["ring_cg_atoms"]
+    for ring1_idx, ring2_idx in zip(*np.nonzero(interacting_pairs)):
+        aromatics.append([frame_idx, ITYPE_CODES[itype], int(ring_cg_atoms[ring1_idx]), int(ring_cg_atoms[ring2_idx])])
 
     return aromatics
 
 
-def compute_pi_stacking(traj_frag_molid, frame_idx, index_to_label, sele_id,
+def compute_pi_stacking(frame_idx, ring_geometry, interaction_topology,
                         PI_STACK_CUTOFF_DISTANCE=7.0, PI_STACK_CUTOFF_ANGLE=30, PI_STACK_PSI_ANGLE=45):
     """
     Compute pi-stacking interactions in a frame of simulation
 
     Parameters
     ----------
-    traj_frag_molid: int
-        Identifier to simulation fragment in VMD
     frame_idx: int
         Frame number to query
-    index_to_label: dict
-        Maps VMD atom index to label "chain:resname:resid:name:index"
-        {11205: "A:ASP:114:CA:11205, ...}
-    sele_id: string, default = None
-        Compute contacts on subset of atom selection based on VMD query
+    ring_geometry: dict
+        Ring coordinates, centroids and normal vectors of the fragment from `calc_fragment_ring_geometry`
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
     PI_STACK_CUTOFF_DISTANCE: float, default = 7.0 angstroms
         cutoff for distance between centroids of two aromatic rings
     PI_STACK_CUTOFF_ANGLE: float, default = 30 degrees
@@ -213,33 +155,30 @@ def compute_pi_stacking(traj_frag_molid, frame_idx, index_to_label, sele_id,
 
     Returns
     -------
-    pi_stacking = list of tuples, [(frame_index, itype, atom1_label, atom2_label), ...]
+    pi_stacking = list of lists, [[frame_index, itype_code, ring1_cg_index, ring2_cg_index], ...]
         itype = "ps"
     """
 
     PI_STACK_SOFT_DISTANCE_CUTOFF = 10.0  # angstroms
-    pi_stacking = compute_aromatics(traj_frag_molid, frame_idx, index_to_label, sele_id, "ps",
+    pi_stacking = compute_aromatics(frame_idx, ring_geometry, interaction_topology, "ps",
                                     PI_STACK_SOFT_DISTANCE_CUTOFF, PI_STACK_CUTOFF_DISTANCE,
                                     PI_STACK_CUTOFF_ANGLE, PI_STACK_PSI_ANGLE)
     return pi_stacking
 
 
-def compute_t_stacking(traj_frag_molid, frame_idx, index_to_label, sele_id,
+def compute_t_stacking(frame_idx, ring_geometry, interaction_topology,
                        T_STACK_CUTOFF_DISTANCE=5.0, T_STACK_CUTOFF_ANGLE=30, T_STACK_PSI_ANGLE=45):
     """
     Compute t-stacking interactions in a frame of simulation
 
     Parameters
     ----------
-    traj_frag_molid: int
-        Identifier to simulation fragment in VMD
     frame_idx: int
         Frame number to query
-    index_to_label: dict
-        Maps VMD atom index to label "chain:resname:resid:name:index"
-        {11205: "A:ASP:114:CA:11205, ...}
-    sele_id: string, default = None
-        Compute contacts on subset of atom selection based on VMD query
+    ring_geometry: dict
+        Ring coordinates, centroids and normal vectors of the fragment from `calc_fragment_ring_geometry`
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
     T_STACK_CUTOFF_DISTANCE: float, default = 5.0 angstroms
         cutoff for distance between centroids of two aromatic rings
     T_STACK_CUTOFF_ANGLE: float, default = 30 degrees
@@ -252,12 +191,12 @@ def compute_t_stacking(traj_frag_molid, frame_idx, index_to_label, sele_id,
 
     Returns
     -------
-    t_stacking = list of tuples, [(frame_index, itype, atom1_label, atom2_label), ...]
+    t_stacking = list of lists, [[frame_index, itype_code, ring1_cg_index, ring2_cg_index], ...]
         itype = "ts"
     """
 
     T_STACK_SOFT_DISTANCE_CUTOFF = 6.0  # angstroms
-    t_stacking = compute_aromatics(traj_frag_molid, frame_idx, index_to_label, sele_id, "ts",
+    t_stacking = compute_aromatics(frame_idx, ring_geometry, interaction_topology, "ts",
                                    T_STACK_SOFT_DISTANCE_CUTOFF, T_STACK_CUTOFF_DISTANCE,
                                    T_STACK_CUTOFF_ANGLE, T_STACK_PSI_ANGLE)
     return t_stacking
@@ -19,6 +19,10 @@
 ##############################################################################
 
 import datetime
+import glob
+import json
+import shutil
+import tempfile
 from multiprocessing import *
 from vmd import *  # Loads the static `molecule` object
 
@@ -28,11 +32,17 @@ from .hbonds import *
 from .salt_bridges import *
 from .pi_cation import *
 from .vanderwaals import *
+from .interaction_topology import *
+from .neighbor_search import NEIGHBOR_ENGINES, init_verlet_lists
+from .solvation_shell import *
+from .contact_io import *
 
 ##############################################################################
 # Global Variables
 ##############################################################################
 TRAJ_FRAG_SIZE = 100
+DEFAULT_ENGINE_OPTIONS = {"neighbor_engine": "vmd", "hbond_engine": "vmd", "shell_skin": 0, "verlet_skin": 0}
+CHECKPOINT_MANIFEST = "manifest.json"
 full_name_dirs = {'hbbb': 'hydrogen_bonds/backbone_backbone_hydrogen_bonds',
                   'hbsb': 'hydrogen_bonds/sidechain_backbone_hydrogen_bonds',
                   'hbss': 'hydrogen_bonds/sidechain_sidechain_hydrogen_bonds',
@@ -50,18 +60,40 @@ full_name_dirs = {'hbbb': 'hydrogen_bonds/backbone_backbone_hydrogen_bonds',
                   'lwb2': 'ligand_hydrogen_bonds/extended_water_mediated_hydrogen_bonds',
                   }
 
+# State that each worker process sets up once through the Pool initializer and keeps for all of its fragments
+worker_state = {}
+
 ##############################################################################
 # Functions
 ##############################################################################
 
-# Note: Trying to write directly to output and doing postprocessing after
-# May save a lot of memory instead of having massive arrays, but there is
-# also the IO time (which would happen anyways). Figure out best output
-# format and most efficient way to write to disk.
+
+def init_worker(top, output_labels, interaction_topology, profile=False):
+    """
+    Pool initializer that loads the topology into VMD and stores the label table and static
+    interaction topology in the worker process, so they are parsed and transferred once per
+    worker rather than once per fragment.
+
+    Parameters
+    ----------
+    top: str
+        Topology in .pdb or .mae format
+    output_labels: list of strings
+        Output label of each atom indexed by VMD index, generated by `gen_output_labels`
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
+    profile: bool, default = False
+        Collect stage timings and counters of each fragment, see contact_calc/profiling.py
+    """
+    enable_profiling(profile)
+    worker_state["molid"] = load_topology(top)
+    worker_state["output_labels"] = output_labels
+    worker_state["interaction_topology"] = interaction_topology
 
 
-def compute_frame_contacts(traj_frag_molid, frag_idx, frame_idx, ITYPES, geom_criterion_values, solvent_resn, sele_id,
-                           ligand, index_to_label):
+def compute_frame_contacts(traj_frag_molid, frag_idx, frame_idx, ITYPES, geom_criterion_values, ligand,
+                           interaction_topology, ring_geometry, engine_options, frame_queries=None,
+                           solvation_shells=None, verlet_lists=None):
     """
     Computes each of the specified non-covalent interaction type for a single frame
 
@@ -77,25 +109,29 @@ def compute_frame_contacts(traj_frag_molid, frag_idx, frame_idx, ITYPES, geom_cr
         Denotes the list of non-covalent interaction types to compute contacts for 
     geom_criterion_values: dict
         Dictionary containing the cutoff values for all geometric criteria
-    solvent_resn: string, default = TIP3
-        Denotes the resname of solvent in simulation
-    sele_id: string, default = None
-        Compute contacts on subset of atom selection based on VMD query
-    chain_id: string, default = None
-        Specify chain of protein to perform computation on 
     ligand: list of string, default = None
         Include ligand resname if computing contacts between ligand and binding pocket residues
-    index_to_label: dict 
-        Maps VMD atom index to label "chain:resname:resid:name:index"
-        {11205: "A:ASP:114:CA:11205, ...}
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
+    ring_geometry: dict
+        Aromatic ring geometry of the fragment generated by `calc_fragment_ring_geometry`
+    engine_options: dict
+        Dictionary containing the choice of computational engines (ie neighbor_engine, hbond_engine, shell_skin)
+    frame_queries: list of tuples, default = None
+        VMD queries of the frame generated by `gen_frame_queries`, evaluated in a single Tcl call
+    solvation_shells: dict, default = None
+        Solvation shells of hb and lhb tracked across frames, see `init_solvation_shells`.
+        Shells are queried from scratch every frame if None.
+    verlet_lists: dict, default = None
+        Verlet lists of vdw candidate pairs reused across frames, see `init_verlet_lists`.
+        Candidate pairs are searched from scratch every frame if None.
 
     Returns
     -------
-    frame_contacts: list of tuples, [(frame_index, atom1_label, atom2_label, itype), ...]
+    frame_contacts: list of lists, [[frame_index, itype_code, atom1_index, atom2_index, ...], ...]
+        Integer encoded contacts, see ITYPE_NAMES and `format_contact`
 
     """
-    # tic = datetime.datetime.now()
-
     # Extract geometric criterion
     SALT_BRIDGE_CUTOFF_DISTANCE = geom_criterion_values['SALT_BRIDGE_CUTOFF_DISTANCE']
     PI_CATION_CUTOFF_DISTANCE = geom_criterion_values['PI_CATION_CUTOFF_DISTANCE']
@@ -110,32 +146,54 @@ def compute_frame_contacts(traj_frag_molid, frag_idx, frame_idx, ITYPES, geom_cr
     HBOND_CUTOFF_ANGLE = geom_criterion_values['HBOND_CUTOFF_ANGLE']
     VDW_EPSILON = geom_criterion_values['VDW_EPSILON']
     VDW_RES_DIFF = geom_criterion_values['VDW_RES_DIFF']
-
+    WATER_BRIDGE_DEPTH = geom_criterion_values.get('WATER_BRIDGE_DEPTH', 2)
+    neighbor_engine = engine_options['neighbor_engine']
+    hbond_engine = engine_options['hbond_engine']
+
+    # Pull coordinates of the whole frame once and share them among all itypes
+    with profile_stage("coords"):
+        coords = get_frame_coords(traj_frag_molid, frame_idx)
+    neighbor_cache = {}
+    shell_selections = []
+    if solvation_shells is not None and frame_queries:
+        with profile_stage("shells"):
+            shell_selections = gen_shell_selections(frame_queries, coords, interaction_topology, neighbor_engine,
+                                                    solvation_shells)
+    with profile_stage("tcl"):
+        prefetch_frame_queries(traj_frag_molid, frame_idx, frame_queries, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE,
+                               neighbor_cache, shell_selections)
+
+    # Each itype is timed as its own stage when profiling, see contact_calc/profiling.py
     frame_contacts = []
     if "sb" in ITYPES:
-        frame_contacts += compute_salt_bridges(traj_frag_molid, frame_idx, sele_id, SALT_BRIDGE_CUTOFF_DISTANCE)
+        with profile_stage("sb"):
+            frame_contacts += compute_salt_bridges(traj_frag_molid, frame_idx, coords, interaction_topology, SALT_BRIDGE_CUTOFF_DISTANCE)
     if "pc" in ITYPES:
-        frame_contacts += compute_pi_cation(traj_frag_molid, frame_idx, index_to_label, sele_id, PI_CATION_CUTOFF_DISTANCE, PI_CATION_CUTOFF_ANGLE)
+        with profile_stage("pc"):
+            frame_contacts += compute_pi_cation(frame_idx, coords, ring_geometry, interaction_topology, PI_CATION_CUTOFF_DISTANCE, PI_CATION_CUTOFF_ANGLE)
     if "ps" in ITYPES:
-        frame_contacts += compute_pi_stacking(traj_frag_molid, frame_idx, index_to_label, sele_id, PI_STACK_CUTOFF_DISTANCE, PI_STACK_CUTOFF_ANGLE, PI_STACK_PSI_ANGLE)
+        with profile_stage("ps"):
+            frame_contacts += compute_pi_stacking(frame_idx, ring_geometry, interaction_topology, PI_STACK_CUTOFF_DISTANCE, PI_STACK_CUTOFF_ANGLE, PI_STACK_PSI_ANGLE)
     if "ts" in ITYPES:
-        frame_contacts += compute_t_stacking(traj_frag_molid, frame_idx, index_to_label, sele_id, T_STACK_CUTOFF_DISTANCE, T_STACK_CUTOFF_ANGLE, T_STACK_PSI_ANGLE)
+        with profile_stage("ts"):
+            frame_contacts += compute_t_stacking(frame_idx, ring_geometry, interaction_topology, T_STACK_CUTOFF_DISTANCE, T_STACK_CUTOFF_ANGLE, T_STACK_PSI_ANGLE)
     if "vdw" in ITYPES:
-        frame_contacts += compute_vanderwaals(traj_frag_molid, frame_idx, index_to_label, sele_id, VDW_EPSILON, VDW_RES_DIFF)
+        with profile_stage("vdw"):
+            frame_contacts += compute_vanderwaals(traj_frag_molid, frame_idx, coords, interaction_topology, VDW_EPSILON, VDW_RES_DIFF, neighbor_engine, neighbor_cache, verlet_lists)
     if "hb" in ITYPES:
-        frame_contacts += compute_hydrogen_bonds(traj_frag_molid, frame_idx, index_to_label, solvent_resn, sele_id, None, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE)
+        with profile_stage("hb"):
+            frame_contacts += compute_hydrogen_bonds(traj_frag_molid, frame_idx, coords, interaction_topology, None, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, hbond_engine, neighbor_engine, neighbor_cache, WATER_BRIDGE_DEPTH, solvation_shells)
     if "lhb" in ITYPES:
-        frame_contacts += compute_hydrogen_bonds(traj_frag_molid, frame_idx, index_to_label, solvent_resn, sele_id, ligand, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE)
+        with profile_stage("lhb"):
+            frame_contacts += compute_hydrogen_bonds(traj_frag_molid, frame_idx, coords, interaction_topology, ligand, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, hbond_engine, neighbor_engine, neighbor_cache, WATER_BRIDGE_DEPTH, solvation_shells)
 
-    # toc = datetime.datetime.now()
-    # print("Finished computing contacts for frame %d (frag %d) in %s s" %
-    #       (frag_idx*100+frame_idx, frag_idx, (toc-tic).total_seconds()))
     return frame_contacts
 
 
-def compute_fragment_contacts(frag_idx, beg_frame, end_frame, top, traj, output, itypes, geom_criterion_values, stride, solvent_resn, sele_id, ligand, index_to_label):
+def compute_fragment_contacts(frag_idx, beg_frame, end_frame, top, traj, spill_dir, itypes, geom_criterion_values, stride, solvent_resn, sele_id, ligand, engine_options, output_format):
     """ 
-    Reads in a single trajectory fragment and calls compute_frame_contacts on each frame
+    Reads a single trajectory fragment into the worker's topology molecule, calls compute_frame_contacts on each frame and
+    spills the resulting contacts to a fragment file so they don't have to be held in memory
 
     Parameters
     ----------
@@ -144,13 +202,13 @@ def compute_fragment_contacts(frag_idx, beg_frame, end_frame, top, traj, output,
     beg_frame: int
         Start frame of trajectory fragment
     end_frame: int
-        End frame of trajectory fragment
+        End frame of trajectory fragment (inclusive)
     top: str
         Topology in .pdb or .mae format
     traj: str
         Trajectory in .nc or .dcd format
-    output: str
-        Path to file where results should be written
+    spill_dir: str
+        Directory where the contacts of the fragment are written
     itypes: list
         Denotes the list of non-covalent interaction types to compute contacts for 
     geom_criterion_values: dict
@@ -163,110 +221,320 @@ def compute_fragment_contacts(frag_idx, beg_frame, end_frame, top, traj, output,
         Compute contacts on subset of atom selection based on VMD query
     ligand: list of string, default = None
         Include ligand resname if computing contacts between ligand and binding pocket residues
-    index_to_label: dict 
-        Maps VMD atom index to label "chain:resname:resid:name:index"
-        {11205: "A:ASP:114:CA:11205, ...}
+    engine_options: dict
+        Dictionary containing the choice of computational engines (ie neighbor_engine, hbond_engine, shell_skin)
+    output_format: string
+        One of CONTACT_FORMATS
 
     Return
     ------
     frag_idx: int 
 
-    fragment_contacts: list of tuples, [(frame_index, atom1_label, atom2_label, itype), ...]
+    spill_path: str
+        Path to the fragment file with one contact per line, ordered by frame
+    fragment_profile: dict
+        Stage timings and counters of the fragment, see `collect_profile`. None unless profiling.
     """
     tic = datetime.datetime.now()
-    traj_frag_molid = load_traj(top, traj, beg_frame, end_frame, stride)
+    output_labels = worker_state["output_labels"]
+    interaction_topology = worker_state["interaction_topology"]
+    traj_frag_molid = worker_state["molid"]
+
+    # Tracked shells are kept across the fragments of a worker. They are rebuilt whenever atoms moved
+    # too far, so they stay exact even though the fragments of a worker are not consecutive.
+    solvation_shells = None
+    shell_skin = engine_options.get("shell_skin", 0)
+    if shell_skin and ("hb" in itypes or "lhb" in itypes):
+        if worker_state.get("solvation_shells") is None or worker_state["solvation_shells"]["skin"] != shell_skin:
+            worker_state["solvation_shells"] = init_solvation_shells(shell_skin)
+        solvation_shells = worker_state["solvation_shells"]
+
+    # Verlet lists are kept the same way. They are built with the cell engine when the "vmd" engine is chosen.
+    verlet_lists = None
+    verlet_skin = engine_options.get("verlet_skin", 0)
+    if verlet_skin and "vdw" in itypes:
+        if worker_state.get("verlet_lists") is None or worker_state["verlet_lists"]["skin"] != verlet_skin:
+            worker_state["verlet_lists"] = init_verlet_lists(verlet_skin)
+        verlet_lists = worker_state["verlet_lists"]
+        if engine_options["neighbor_engine"] == "vmd":
+            engine_options = dict(engine_options, neighbor_engine="cell")
+
+    with profile_stage("load"):
+        read_frames(traj_frag_molid, top, traj, beg_frame, end_frame, stride)
+    with profile_stage("selections"):
+        selection_ids = create_fragment_selections(traj_frag_molid, interaction_topology, itypes, solvent_resn,
+                                                   sele_id, ligand, engine_options['neighbor_engine'],
+                                                   engine_options['hbond_engine'], solvation_shells is not None)
+        frame_queries = gen_frame_queries(itypes, ligand, engine_options['neighbor_engine'],
+                                          engine_options['hbond_engine'], solvation_shells is not None)
+        if frame_queries and worker_state.get("frame_queries") != frame_queries:
+            install_frame_proc(frame_queries)
+            worker_state["frame_queries"] = frame_queries
     fragment_contacts = []
 
+    # Aromatic ring centroids and normals are computed for all frames of the fragment at once
+    ring_geometry = None
+    if "pc" in itypes or "ps" in itypes or "ts" in itypes:
+        with profile_stage("rings"):
+            ring_geometry = calc_fragment_ring_geometry(traj_frag_molid, interaction_topology)
+
     # Compute contacts for each frame
     num_frag_frames = molecule.numframes(traj_frag_molid)
     for frame_idx in range(num_frag_frames):
         # if frame_idx > 1: break
         fragment_contacts += compute_frame_contacts(traj_frag_molid, frag_idx, frame_idx, itypes, geom_criterion_values,
-                                                    solvent_resn, sele_id, ligand, index_to_label)
-
-    # Delete trajectory fragment to clear memory
-    molecule.delete(traj_frag_molid)
-
-    # Update frame-number so it's not relative to beg_frame
+                                                    ligand, interaction_topology, ring_geometry, engine_options,
+                                                    frame_queries, solvation_shells, verlet_lists)
+
+    # Delete frames of the trajectory fragment to clear memory, but keep the topology for the next fragment
+    with profile_stage("selections"):
+        delete_fragment_selections(selection_ids)
+    molecule.delframe(traj_frag_molid)
+    count_profile("fragments")
+    count_profile("frames", num_frag_frames)
+    if profile_state["enabled"]:
+        for fc in fragment_contacts:
+            count_profile("contacts.%s" % ITYPE_NAMES[fc[1]])
+
+    # Update frame-number so it refers to the frame in the original trajectory rather than in the fragment
     for fc in fragment_contacts:
-        fc[0] = beg_frame + fc[0]
+        fc[0] = beg_frame + fc[0] * stride
 
     toc = datetime.datetime.now()
     print("Finished computing contacts for fragment %d (frames %d to %d) in %s s" %
-          (frag_idx, frag_idx * 100, frag_idx * 100 + num_frag_frames - 1, (toc-tic).total_seconds()))
+          (frag_idx, beg_frame, beg_frame + (num_frag_frames - 1) * stride, (toc-tic).total_seconds()))
 
-    # Write directly out to temporary output
-    # print("Writing output to seperate files, one for each itype ...")
-    #
-    # fd_map = {itype: open(OUTPUT + "_" + itype + "_frag_" + str(frag_idx) + ".txt", 'w') for itype in contact_types}
-    # for contact in fragment_contacts:
-    #     itype_key = contact[-1]
-    #     output_string = str(frag_idx) + "\t" + "\t".join(map(str, contact)) + "\n"
-    #     fd_map[itype_key].write(output_string)
-    #
-    # for itype in fd_map:
-    #     fd_map[itype].close()
-    #
-    # return frag_idx, num_frag_frames - 1
-
-    return fragment_contacts
+    spill_path = fragment_spill_path(spill_dir, frag_idx, output_format)
+    with profile_stage("write"):
+        write_fragment_contacts(fragment_contacts, spill_path, output_labels, output_format,
+                                contact_atom_columns(geom_criterion_values), stride)
+    return frag_idx, spill_path, collect_profile()
 
 
 def compute_fragment_contacts_helper(args):
-    return compute_fragment_contacts(*args)
-
-
-# def stitch_fragment_contacts(itype, OUTPUT_DIR, frag_contact_files, frag_idx_to_length):
-#     """
-#     Stitch together multiple fragments of non-covalent contacts into
-#     single file and delete individual fragment files.
-#
-#     Parameters
-#     ----------
-#     itype: Type of non-covalent contact
-#     OUTPUT_DIR: string
-#         Absolute path to output directory
-#     frag_contact_files: list of strings
-#         List of paths to fragment contact files
-#     frag_idx_to_length: dict from int to int
-#         Map the fragment index to length of fragment
-#     """
-#     print("Stitching %s ..." % (itype))
-#     # stitched_filename = OUTPUT_DIR + "/" + itype + ".txt"
-#     # stitched_filename = OUTPUT_DIR + full_name_dirs[contact_type] + '/' + 'raw_frame_output.txt'
-#     stitched_filename = OUTPUT_DIR + full_name_dirs[itype] + '/' + itype + '.txt'
-#     fo = open(stitched_filename, 'w')
-#
-#     num_frames = 0
-#     for frag_contact_file in frag_contact_files:
-#         frag_idx = int(frag_contact_file.split("/")[-1].strip(".txt").split("_")[2])
-#         ffrag = open(frag_contact_file, 'r')
-#         for line in ffrag:
-#             linfo = line.split("\t")
-#             frame_idx = int(linfo[1])
-#             new_frame_idx = num_frames + frame_idx - 1
-#             output_string = str(new_frame_idx) + "\t" + "\t".join(linfo[2:])
-#             fo.write(output_string)
-#         num_frames += frag_idx_to_length[frag_idx]
-#         ffrag.close()
-#         os.remove(frag_contact_file)
-#
-#     fo.close()
-#
-#     return stitched_filename
-
-
-def compute_contacts(top, traj, output, itypes, geom_criterion_values, cores, stride, solvent_resn, sele_id, ligand):
-    """ Computes non-covalent contacts across the entire trajectory and writes them to `output`.
+    replica_idx, fragment_args = args
+    return replica_idx, os.getpid(), compute_fragment_contacts(*fragment_args)
+
+
+def fragment_frame_ranges(beg_frame, end_frame, stride):
+    """
+    Split the frames beg_frame, beg_frame + stride, ... up to end_frame into fragments of
+    TRAJ_FRAG_SIZE frames. Every fragment starts on the global stride, so the computed frames
+    don't depend on how the trajectory is fragmented.
+
+    Returns
+    -------
+    frag_frame_ranges: list of tuples of (int, int)
+        First and last trajectory frame of each fragment (inclusive)
+    """
+    frag_span = TRAJ_FRAG_SIZE * stride
+    return [(frag_beg, min(frag_beg + (TRAJ_FRAG_SIZE - 1) * stride, end_frame))
+            for frag_beg in range(beg_frame, end_frame + 1, frag_span)]
+
+
+def fragment_spill_path(spill_dir, frag_idx, output_format):
+    """
+    Path of the file holding the contacts of fragment `frag_idx`
+    """
+    return os.path.join(spill_dir, "fragment_%d.%s" % (frag_idx, output_format))
+
+
+def contact_atom_columns(geom_criterion_values):
+    """
+    Number of atom columns of binary contact records, which grows beyond MAX_CONTACT_ATOMS
+    when water bridges through more than 2 waters are computed
+    """
+    return max(MAX_CONTACT_ATOMS, 2 + geom_criterion_values.get('WATER_BRIDGE_DEPTH', 2))
+
+
+def write_fragment_contacts(fragment_contacts, spill_path, output_labels, output_format,
+                            atom_columns=MAX_CONTACT_ATOMS, stride=1):
+    """
+    Write the contacts of one fragment in the final output format, so fragments can be
+    appended to the output as they are. Atom labels are only looked up here for the tsv
+    and int formats. Interval fragments are merged by `stitch_fragment_contacts` instead.
+    The byte offsets of the fragment's frames are written to a frame index next to the
+    fragment file. The file is renamed into place once complete so a partially written
+    fragment is never read.
+
+    Parameters
+    ----------
+    fragment_contacts: list of lists, [[frame_index, itype_code, atom1_index, atom2_index, ...], ...]
+        Integer encoded contacts ordered by frame
+    spill_path: str
+        Path to fragment file
+    output_labels: list of strings
+        Output label of each atom indexed by VMD index, generated by `gen_output_labels`
+    output_format: string
+        One of CONTACT_FORMATS
+    atom_columns: int, default = MAX_CONTACT_ATOMS
+        Atom columns of binary contact records, see `contact_atom_columns`
+    stride: int, default = 1
+        Step between the computed frames, which the intervals of the int format extend by
+    """
+    index_frames, index_offsets = [], []
+    with open(spill_path + ".tmp", "wb") as spill_fd:
+        if output_format == "int":
+            # Intervals are keyed by labels rather than atom indices, as atoms can share a label
+            labeled_contacts = ((contact[0], ITYPE_NAMES[contact[1]]) +
+                                tuple(output_labels[index] for index in contact[2:])
+                                for contact in fragment_contacts)
+            write_interval_contacts(spill_fd, add_contact_intervals({}, labeled_contacts, stride))
+        elif output_format == "bin":
+            if fragment_contacts:
+                index_frames.append(fragment_contacts[0][0])
+                index_offsets.append(0)
+            write_binary_contacts(spill_fd, fragment_contacts, atom_columns)
+        else:
+            offset = 0
+            for interaction in fragment_contacts:
+                if not index_frames or index_frames[-1] != interaction[0]:
+                    index_frames.append(interaction[0])
+                    index_offsets.append(offset)
+                line = format_contact(interaction, output_labels).encode("utf-8")
+                spill_fd.write(line)
+                offset += len(line)
+
+    with open(frame_index_path(spill_path), "wb") as index_fd:
+        write_frame_index_header(index_fd)
+        write_frame_index_entries(index_fd, index_frames, index_offsets)
+    os.replace(spill_path + ".tmp", spill_path)
+
+
+def stitch_fragment_contacts(output_fd, finished_spill_paths, next_frag_idx, delete_spill=True, index_fd=None,
+                             interval_contacts=None):
+    """
+    Append the contiguous run of finished fragments starting at `next_frag_idx` to the output,
+    or for the int format merge their intervals into `interval_contacts`.
+
+    Parameters
+    ----------
+    output_fd: file
+        Output file opened for writing in binary mode
+    finished_spill_paths: dict from int to str
+        Maps index of each finished fragment that is not yet written to its fragment file.
+        Written fragments are removed from the dict.
+    next_frag_idx: int
+        Index of the first fragment that is not yet written
+    delete_spill: bool, default = True
+        Whether to delete fragment files once they are written
+    index_fd: file, default = None
+        Frame index of the output opened for writing in binary mode. If given, the frame
+        index entries of each fragment are appended with offsets relative to the output.
+    interval_contacts: dict, default = None
+        Intervals of the output so far for the int format, see `add_contact_intervals`. Updated
+        in place with the intervals of each fragment, which are written once all are merged.
+
+    Returns
+    -------
+    next_frag_idx: int
+        Index of the first fragment that is still not written
+    """
+    while next_frag_idx in finished_spill_paths:
+        spill_path = finished_spill_paths.pop(next_frag_idx)
+        if index_fd is not None:
+            index_frames, index_offsets = read_frame_index(frame_index_path(spill_path))
+            write_frame_index_entries(index_fd, index_frames, index_offsets + output_fd.tell())
+        if interval_contacts is not None:
+            merge_contact_intervals(interval_contacts, read_interval_contacts(spill_path))
+        else:
+            with open(spill_path, "rb") as spill_fd:
+                shutil.copyfileobj(spill_fd, output_fd)
+        if delete_spill:
+            os.remove(spill_path)
+            os.remove(frame_index_path(spill_path))
+        next_frag_idx += 1
+    return next_frag_idx
+
+
+@contextmanager
+def open_frame_index(output, frame_index, mode):
+    """
+    Open the frame index of `output` if `frame_index` is set, otherwise yield None
+    """
+    if not frame_index:
+        yield None
+        return
+    with open(frame_index_path(output), mode) as index_fd:
+        yield index_fd
+
+
+def prepare_checkpoint(checkpoint_dir, manifest, resume):
+    """
+    Set up the checkpoint directory of a run. The manifest records everything that
+    determines the contents of the fragment files, so fragments are only reused by
+    a run with identical inputs and parameters.
+
+    Parameters
+    ----------
+    checkpoint_dir: str
+        Directory holding one file per completed fragment and the manifest
+    manifest: dict
+        Description of the current run
+    resume: bool
+        Reuse the completed fragments of an interrupted run with the same manifest
+
+    Returns
+    -------
+    finished_frag_idxs: set of ints
+        Indices of fragments that are already completed
+    """
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    manifest_path = os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST)
+
+    if resume and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as manifest_fd:
+            checkpoint_manifest = json.load(manifest_fd)
+        if checkpoint_manifest != json.loads(json.dumps(manifest)):
+            raise ValueError("Checkpoint in %s was created with different inputs or parameters" % checkpoint_dir)
+
+        num_frags = len(range(0, manifest["total_frames"], manifest["fragment_size"]))
+        finished_frag_idxs = {frag_idx for frag_idx in range(num_frags)
+                              if os.path.exists(fragment_spill_path(checkpoint_dir, frag_idx,
+                                                                    manifest["output_format"]))}
+        print("Resuming from %s with %d of %d fragments completed" %
+              (checkpoint_dir, len(finished_frag_idxs), num_frags))
+        return finished_frag_idxs
+
+    # Start a new checkpoint, discarding fragments of earlier runs
+    for spill_path in glob.glob(os.path.join(checkpoint_dir, "fragment_*")):
+        os.remove(spill_path)
+    with open(manifest_path + ".tmp", "w") as manifest_fd:
+        json.dump(manifest, manifest_fd, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return set()
+
+
+def remove_checkpoint(checkpoint_dir):
+    """
+    Delete the fragment files and manifest of a completed run, and the
+    checkpoint directory itself if nothing else is left in it.
+    """
+    for spill_path in glob.glob(os.path.join(checkpoint_dir, "fragment_*")):
+        os.remove(spill_path)
+    os.remove(os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST))
+    if not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+
+
+def compute_contacts(top, traj, output, itypes, geom_criterion_values, cores, stride, solvent_resn, sele_id, ligand,
+                     engine_options=None, checkpoint_dir=None, resume=False, output_format="tsv",
+                     frame_index=False, beg_frame=0, end_frame=None, profile=None):
+    """ Computes non-covalent contacts across a window of the trajectory and writes them to `output`.
+
+    Several replicas of the same system can be processed in one call by passing lists of
+    trajectories and outputs. Topology-derived state is then computed once and the fragments
+    of all replicas are scheduled on a single pool of workers.
 
     Parameters
     ----------
     top: Topology
         In .pdb or .mae format
-    traj: Trajectory
+    traj: Trajectory or list of Trajectories
         In .nc or .dcd format
-    output: string
-        Absolute path to output file
+    output: string or list of strings
+        Absolute path to output file, one for each trajectory
     itypes: list
         Denotes the list of non-covalent interaction types to compute contacts for 
     geom_criterion_values: dict
@@ -274,59 +542,202 @@ def compute_contacts(top, traj, output, itypes, geom_criterion_values, cores, st
     cores: int, default = 6
         Number of CPU cores to parallelize over
     stride: int, default = 1
-        Frequency to skip frames in trajectory
+        Frequency to skip frames in trajectory, counted from `beg_frame`
     solvent_resn: string, default = TIP3
         Denotes the resname of solvent in simulation
     sele_id: string, default = None
         Compute contacts on subset of atom selection based on VMD query
     ligand: list of string, default = None
         Include ligand resname if computing contacts between ligand and binding pocket residues
+    engine_options: dict, default = None
+        Dictionary containing the choice of computational engines, see DEFAULT_ENGINE_OPTIONS
+    checkpoint_dir: string, default = None
+        Directory in which completed fragments are kept until the run finishes. If None
+        fragments are kept in a temporary directory next to `output`. With several
+        replicas, each replica gets its own subdirectory.
+    resume: bool, default = False
+        Skip fragments that were completed in `checkpoint_dir` by an interrupted run
+    output_format: string, default = "tsv"
+        One of CONTACT_FORMATS. The "bin" format stores integer encoded contacts along with
+        the atom label table and the "int" format stores the frame intervals of each
+        interaction, see contact_io. Intervals are held in memory until the output is complete.
+    frame_index: bool, default = False
+        Also write a frame index next to each output (see `frame_index_path`) that lets
+        readers seek to a range of frames
+    beg_frame: int, default = 0
+        First trajectory frame to compute contacts for. Only fragments within the window are
+        read, and output frame numbers refer to the original trajectory.
+    end_frame: int, default = None
+        Last trajectory frame to compute contacts for (inclusive). If None, or beyond the end
+        of a trajectory, the window extends to the last frame.
+    profile: string, default = None
+        Path of a profiling report with the time spent in each stage and itype, summed over all
+        workers and per worker, along with evaltcl calls and candidate pairs. Written as JSON if
+        the path ends with .json and as tab separated lines otherwise.
     """
-
+    if output_format not in CONTACT_FORMATS:
+        raise ValueError("Unknown output format: %s" % output_format)
+    if output_format == "int" and frame_index:
+        raise ValueError("Interval contact files are not ordered by frame and have no frame index")
+    if stride < 1:
+        raise ValueError("Stride must be a positive integer, got %d" % stride)
+    if beg_frame < 0 or (end_frame is not None and end_frame < beg_frame):
+        raise ValueError("Invalid frame window: %s to %s" % (beg_frame, end_frame))
+    if engine_options is None:
+        engine_options = DEFAULT_ENGINE_OPTIONS
+    trajs = traj if isinstance(traj, (list, tuple)) else [traj]
+    outputs = output if isinstance(output, (list, tuple)) else [output]
+    if len(trajs) != len(outputs):
+        raise ValueError("Expected one output per trajectory, got %d outputs for %d trajectories" %
+                         (len(outputs), len(trajs)))
+
+    water_bridge_depth = geom_criterion_values.get('WATER_BRIDGE_DEPTH', 2)
+    if not 1 <= water_bridge_depth <= MAX_WATER_BRIDGE_DEPTH:
+        raise ValueError("Water bridge depth must be between 1 and %d, got %d" %
+                         (MAX_WATER_BRIDGE_DEPTH, water_bridge_depth))
     contact_types = []
     for itype in itypes:
         if itype == "hb":
-            contact_types += ["hbbb", "hbsb", "hbss", "wb", "wb2"]
+            contact_types += ["hbbb", "hbsb", "hbss"] + [water_bridge_itype(depth)
+                                                         for depth in range(1, water_bridge_depth + 1)]
         elif itype == "lhb":
-            contact_types += ["hls", "hlb", "lwb", "lwb2"]
+            contact_types += ["hls", "hlb"] + [water_bridge_itype(depth, ligand=True)
+                                               for depth in range(1, water_bridge_depth + 1)]
         else:
             contact_types += [itype]
 
-    index_to_label = gen_index_to_atom_label(top, traj)
-    sim_length = simulation_length(top, traj)
+    tic = datetime.datetime.now()
+    enable_profiling(profile is not None)
+
+    # Replicas share the topology, so labels and atom groups are generated from the first one
+    with profile_stage("topology"):
+        index_to_label = gen_index_to_atom_label(top, trajs[0])
+        interaction_topology = gen_interaction_topology(top, trajs[0], index_to_label, solvent_resn, sele_id, ligand)
+        output_labels = gen_output_labels(index_to_label)
+
+    # Generate input arguments for each trajectory piece. Fragments are ordered by replica so every
+    # replica's output is completed as early as possible, while the pool is kept busy until the last fragment.
+    replica_spill_dirs, replica_checkpoint_dirs = [], []
+    finished_spill_paths, next_frag_idxs = [], []
+    interval_contacts = [{} if output_format == "int" else None for _ in trajs]
     input_args = []
-
-    # Generate input arguments for each trajectory piece
-    print("Processing %s with %s total frames and stride %s" % (traj, str(sim_length), str(stride)))
-    for frag_idx, beg_frame in enumerate(range(0, sim_length, TRAJ_FRAG_SIZE)):
-        # if frag_idx > 0: break
-        end_frame = beg_frame + TRAJ_FRAG_SIZE - 1
-        # print("Preparing fragment %s, beg_frame:%s end_frame:%s" % (frag_idx, beg_frame, end_frame))
-        input_args.append((frag_idx, beg_frame, end_frame, top, traj, output, itypes, geom_criterion_values,
-                           stride, solvent_resn, sele_id, ligand, index_to_label))
-
-    # Parallel computation
-    pool = Pool(processes=cores)
-    contacts = pool.map(compute_fragment_contacts_helper, input_args)
-    pool.close()
-    pool.join()
-    contacts = [x for y in contacts for x in y]  # Flatten
+    for replica_idx, (replica_traj, replica_output) in enumerate(zip(trajs, outputs)):
+        sim_length = simulation_length(top, replica_traj)
+        if beg_frame >= sim_length:
+            raise ValueError("First frame %d is beyond the %d frames of %s" % (beg_frame, sim_length, replica_traj))
+        last_frame = sim_length - 1 if end_frame is None else min(end_frame, sim_length - 1)
+        frag_frame_ranges = fragment_frame_ranges(beg_frame, last_frame, stride)
+        num_frames = len(range(beg_frame, last_frame + 1, stride))
+        if checkpoint_dir is None:
+            spill_dir = tempfile.mkdtemp(prefix=".contacts_", dir=os.path.dirname(os.path.abspath(replica_output)))
+            replica_checkpoint_dirs.append(None)
+            finished_frag_idxs = set()
+        else:
+            spill_dir = checkpoint_dir if len(trajs) == 1 else os.path.join(checkpoint_dir, "replica_%d" % replica_idx)
+            replica_checkpoint_dirs.append(spill_dir)
+            manifest = {"topology": os.path.abspath(top),
+                        "trajectory": None if replica_traj is None else os.path.abspath(replica_traj),
+                        "itypes": itypes,
+                        "geom_criterion_values": geom_criterion_values,
+                        "stride": stride,
+                        "solvent_resn": solvent_resn,
+                        "sele_id": sele_id,
+                        "ligand": ligand,
+                        "beg_frame": beg_frame,
+                        "end_frame": last_frame,
+                        "total_frames": num_frames,
+                        "fragment_size": TRAJ_FRAG_SIZE,
+                        "output_format": output_format}
+            finished_frag_idxs = prepare_checkpoint(spill_dir, manifest, resume)
+        replica_spill_dirs.append(spill_dir)
+        finished_spill_paths.append({frag_idx: fragment_spill_path(spill_dir, frag_idx, output_format)
+                                     for frag_idx in finished_frag_idxs})
+
+        print("Processing %s with %s total frames, frames %d to %d and stride %s" %
+              (replica_traj, str(sim_length), beg_frame, last_frame, str(stride)))
+        for frag_idx, (frag_beg_frame, frag_end_frame) in enumerate(frag_frame_ranges):
+            # if frag_idx > 0: break
+            if frag_idx in finished_frag_idxs:
+                continue
+            # print("Preparing fragment %s, beg_frame:%s end_frame:%s" % (frag_idx, frag_beg_frame, frag_end_frame))
+            input_args.append((replica_idx, (frag_idx, frag_beg_frame, frag_end_frame, top, replica_traj, spill_dir,
+                                             itypes, geom_criterion_values, stride, solvent_resn, sele_id, ligand,
+                                             engine_options, output_format)))
+
+        # Write header and fragments that were completed before resuming. A frame index left
+        # over from an earlier run would no longer match the output.
+        if not frame_index and os.path.exists(frame_index_path(replica_output)):
+            os.remove(frame_index_path(replica_output))
+        with open(replica_output, "wb") as output_fd, open_frame_index(replica_output, frame_index, "wb") as index_fd:
+            if output_format == "int":
+                write_interval_header(output_fd, num_frames, itypes, beg_frame, stride)
+            elif output_format == "bin":
+                write_binary_header(output_fd, num_frames, itypes, ITYPE_NAMES, output_labels, beg_frame, stride,
+                                    contact_atom_columns(geom_criterion_values))
+            else:
+                header = "# total_frames:%d interaction_types:%s" % (num_frames, ",".join(itypes))
+                if beg_frame != 0 or stride != 1:
+                    header += " first_frame:%d stride:%d" % (beg_frame, stride)
+                output_fd.write((header + "\n").encode())
+                output_fd.write(b"# Columns: frame, interaction_type, atom_1, atom_2[, atom_3[, atom_4]]\n")
+            if index_fd is not None:
+                write_frame_index_header(index_fd)
+            with profile_stage("stitch"):
+                next_frag_idxs.append(stitch_fragment_contacts(output_fd, finished_spill_paths[replica_idx], 0,
+                                                               checkpoint_dir is None, index_fd,
+                                                               interval_contacts[replica_idx]))
+
+    # Parallel computation: fragments are written to output as soon as all preceding fragments are done, so
+    # memory is bounded by the fragments being computed rather than by the trajectory. Fragment files in a
+    # checkpoint are kept until the output is complete, so a run interrupted while writing can still resume.
+    worker_profiles = {}
+    pool = Pool(processes=cores, initializer=init_worker,
+                initargs=(top, output_labels, interaction_topology, profile is not None))
+    try:
+        for replica_idx, worker, (frag_idx, spill_path, fragment_profile) in \
+                pool.imap_unordered(compute_fragment_contacts_helper, input_args):
+            if fragment_profile is not None:
+                merge_profile(worker_profiles.setdefault(worker, {}), fragment_profile)
+            finished_spill_paths[replica_idx][frag_idx] = spill_path
+            with open(outputs[replica_idx], "ab") as output_fd, \
+                    open_frame_index(outputs[replica_idx], frame_index, "ab") as index_fd, \
+                    profile_stage("stitch"):
+                next_frag_idxs[replica_idx] = stitch_fragment_contacts(output_fd, finished_spill_paths[replica_idx],
+                                                                       next_frag_idxs[replica_idx],
+                                                                       checkpoint_dir is None, index_fd,
+                                                                       interval_contacts[replica_idx])
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if checkpoint_dir is None:
+            for spill_dir in replica_spill_dirs:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # Intervals can only be written once every fragment has been merged
+    if output_format == "int":
+        for replica_output, replica_interval_contacts in zip(outputs, interval_contacts):
+            with open(replica_output, "ab") as output_fd, profile_stage("stitch"):
+                write_interval_contacts(output_fd, replica_interval_contacts)
+
+    if checkpoint_dir is not None:
+        for replica_checkpoint_dir in replica_checkpoint_dirs:
+            remove_checkpoint(replica_checkpoint_dir)
+        if os.path.isdir(checkpoint_dir) and not os.listdir(checkpoint_dir):
+            os.rmdir(checkpoint_dir)
+
+    if profile is not None:
+        report = collect_profile()
+        for worker_profile in worker_profiles.values():
+            merge_profile(report, worker_profile)
+        report.update({"wall_time": (datetime.datetime.now() - tic).total_seconds(),
+                       "num_fragments": len(input_args),
+                       "workers": worker_profiles})
+        write_profile_report(report, profile)
+        enable_profiling(False)
 
     # Serial computation: Use this mode to debug since multiprocessing module doesn't trace back to bugs. 
-    # contacts = compute_fragment_contacts_helper(input_args[0])
-
-    # Sort and write to output-file
-    contacts.sort(key=lambda i: i[0])
-    with open(output, "w") as output_fd:
-        output_fd.write("# total_frames:%d interaction_types:%s\n" % (sim_length, ",".join(itypes)))
-        output_fd.write("# Columns: frame, interaction_type, atom_1, atom_2[, atom_3[, atom_4]]\n")
-        for interaction in contacts:
-            # Strip vmd ID from atom strings
-            for a in range(2, len(interaction)):
-                atom_str = interaction[a]
-                interaction[a] = atom_str[0:atom_str.rfind(":")]
-
-            # Write to file
-            output_fd.write("\t".join(map(str, interaction)))
-            output_fd.write("\n")
-
+    # init_worker(top, output_labels, interaction_topology)
+    # compute_fragment_contacts_helper(input_args[0])
@@ -0,0 +1,812 @@
+############################################################################
+# Copyright 2018 Anthony Ma & Stanford University                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+"""
+Reading and writing of contact files. Besides the tab separated format with one line per
+contact and frame, contacts can be stored in a binary columnar format:
+
+    magic        8 bytes, BINARY_MAGIC
+    header_size  uint32, little endian
+    header       UTF-8 encoded JSON object with the keys
+                     total_frames: number of frames the contacts were computed for
+                     first_frame: trajectory frame number of the first computed frame
+                     stride: step between computed frames in the trajectory
+                     interaction_types: interaction types requested when computing the contacts
+                     itype_names: name of each interaction type code
+                     atom_labels: "chain:resname:resid:name" label of each atom index
+                     atom_columns: atom columns of each contact record, MAX_CONTACT_ATOMS unless
+                                   water bridges through more than 2 waters were computed
+    blocks       until end of file, each holding one trajectory fragment:
+                     num_contacts  uint64
+                     frames        int64[num_contacts]
+                     itypes        uint8[num_contacts], codes into itype_names
+                     atoms         int32[num_contacts, atom_columns], indices into atom_labels,
+                                   padded with -1
+
+Blocks are ordered by frame and every frame is contained in a single block. Frame numbers
+always refer to the original trajectory, so the computed frames are first_frame,
+first_frame + stride, ... up to total_frames frames. Tab separated files record first_frame and
+stride in their header line only when they differ from 0 and 1.
+
+The interval format is tab separated like the tsv format, but holds one line per atom level
+interaction with all frames in which it is present:
+
+    header       "# total_frames:N interaction_types:... first_frame:N stride:N format:intervals"
+                 and a "# Columns:" line
+    lines        interaction_type, atom_1, atom_2[, ...], intervals
+                 where intervals is a comma separated list of start:end frame numbers. Like Python
+                 slices, end is exclusive, so 10:40 with stride 10 means frames 10, 20 and 30.
+                 An interval is written start:end:count if the interaction occurs count times in
+                 each of its frames, which happens when atom labels collide, e.g. two water
+                 bridges through different waters with the same label.
+
+An interaction that persists for many frames takes a single line. Converting to and from the tsv
+format (`add_contact_intervals`, `iter_interval_contacts`) keeps every contact line of every
+frame, but contacts within a frame are ordered by the position of their interaction in the
+file rather than as in the tsv file.
+
+Tsv and bin contact files can have a sidecar frame index (`frame_index_path`) that
+allows reading a range of frames without scanning the file from the start:
+
+    magic        8 bytes, FRAME_INDEX_MAGIC
+    entries      until end of file, int64 pairs (frame, byte offset) ordered by frame. For
+                 tsv files there is one entry per frame with contacts pointing at its first
+                 line, for bin files one entry per block pointing at the block.
+
+This module only depends on numpy so that downstream tools can read contact files
+without VMD.
+"""
+
+##############################################################################
+# Imports
+##############################################################################
+
+import heapq
+import io
+import itertools
+import json
+import os
+import re
+import struct
+import numpy as np
+
+__all__ = ['CONTACT_FORMATS', 'MAX_CONTACT_ATOMS', 'MAX_WATER_BRIDGE_DEPTH', 'write_binary_header', 'write_binary_contacts',
+           'is_binary_contact_file', 'read_binary_header', 'iter_binary_blocks', 'read_contact_header',
+           'read_contacts', 'iter_contact_lines', 'contact_file_chunks', 'frame_index_path', 'write_frame_index_header',
+           'write_frame_index_entries', 'read_frame_index', 'seek_to_frame', 'count_frames_in_range',
+           'write_interval_header', 'is_interval_contact_file', 'add_contact_intervals', 'merge_contact_intervals',
+           'write_interval_contacts', 'read_interval_contacts', 'iter_interval_contacts']
+
+##############################################################################
+# Globals
+##############################################################################
+
+# tsv: one tab separated line per contact
+# bin: binary columnar format described above
+# int: frame intervals of each interaction described above
+CONTACT_FORMATS = ["tsv", "bin", "int"]
+INTERVAL_FORMAT_TOKEN = "format:intervals"
+BINARY_MAGIC = b"GCBIN01\n"
+FRAME_INDEX_MAGIC = b"GCIDX01\n"
+# Atom columns of binary contact records when no header says otherwise. wb2 and lwb2 have the most atoms.
+MAX_CONTACT_ATOMS = 4
+# Deepest water bridges (wb6, lwb6), whose contacts have 2 + MAX_WATER_BRIDGE_DEPTH atoms
+MAX_WATER_BRIDGE_DEPTH = 6
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def write_binary_header(output_fd, total_frames, interaction_types, itype_names, atom_labels, first_frame=0,
+                        stride=1, atom_columns=MAX_CONTACT_ATOMS):
+    """
+    Write the magic number and header of a binary contact file
+
+    Parameters
+    ----------
+    output_fd: file
+        Output file opened for writing in binary mode
+    total_frames: int
+        Number of frames the contacts were computed for
+    interaction_types: list of str
+        Interaction types requested when computing the contacts
+    itype_names: list of str
+        Name of each interaction type code used in the contact records
+    atom_labels: list of str
+        Label "chain:resname:resid:name" of each atom index used in the contact records
+    first_frame: int, default = 0
+        Trajectory frame number of the first computed frame
+    stride: int, default = 1
+        Step between computed frames in the trajectory
+    atom_columns: int, default = MAX_CONTACT_ATOMS
+        Atom columns of each contact record, at least the number of atoms of the longest contact
+    """
+    header = json.dumps({"total_frames": total_frames,
+                         "first_frame": first_frame,
+                         "stride": stride,
+                         "interaction_types": list(interaction_types),
+                         "itype_names": list(itype_names),
+                         "atom_labels": list(atom_labels),
+                         "atom_columns": atom_columns}).encode("utf-8")
+    output_fd.write(BINARY_MAGIC)
+    output_fd.write(struct.pack("<I", len(header)))
+    output_fd.write(header)
+
+
+def write_binary_contacts(output_fd, contacts, atom_columns=MAX_CONTACT_ATOMS):
+    """
+    Write a block of integer encoded contacts to a binary contact file
+
+    Parameters
+    ----------
+    output_fd: file
+        Output file opened for writing in binary mode
+    contacts: list of lists, [[frame_index, itype_code, atom1_index, atom2_index, ...], ...]
+        Contacts ordered by frame
+    atom_columns: int, default = MAX_CONTACT_ATOMS
+        Atom columns of each contact record, the atom_columns of the header
+    """
+    frames = np.array([contact[0] for contact in contacts], dtype="<i8")
+    itypes = np.array([contact[1] for contact in contacts], dtype="u1")
+    atoms = np.full((len(contacts), atom_columns), -1, dtype="<i4")
+    for row, contact in enumerate(contacts):
+        atoms[row, 0:len(contact) - 2] = contact[2:]
+
+    output_fd.write(struct.pack("<Q", len(contacts)))
+    output_fd.write(frames.tobytes())
+    output_fd.write(itypes.tobytes())
+    output_fd.write(atoms.tobytes())
+
+
+def is_binary_contact_file(contact_path):
+    """
+    Check whether the file at `contact_path` starts with the magic number of binary contact files
+    """
+    with open(contact_path, "rb") as contact_fd:
+        return contact_fd.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def read_binary_header(contact_fd):
+    """
+    Read the header of a binary contact file
+
+    Parameters
+    ----------
+    contact_fd: file
+        Binary contact file opened for reading in binary mode and positioned at its start
+
+    Returns
+    -------
+    header: dict
+        total_frames, first_frame, stride, interaction_types, itype_names, atom_labels and
+        atom_columns, see `write_binary_header`
+    """
+    if contact_fd.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError("%s is not a binary contact file" % getattr(contact_fd, "name", "Input"))
+    return _read_binary_header_fields(contact_fd)
+
+
+def _read_binary_header_fields(contact_fd):
+    """
+    Read the header of a binary contact file that follows its magic number
+    """
+    header_size = struct.unpack("<I", contact_fd.read(4))[0]
+    header = json.loads(contact_fd.read(header_size).decode("utf-8"))
+    header.setdefault("first_frame", 0)
+    header.setdefault("stride", 1)
+    header.setdefault("atom_columns", MAX_CONTACT_ATOMS)
+    return header
+
+
+def iter_binary_blocks(contact_fd, frame_range=None, atom_columns=MAX_CONTACT_ATOMS, end_offset=None):
+    """
+    Iterate over the blocks of a binary contact file from the current position, which is
+    after the header or at a block, up to the end of the file or `end_offset`.
+
+    Parameters
+    ----------
+    contact_fd: file
+        Binary contact file opened for reading in binary mode
+    frame_range: tuple of (int, int), default = None
+        Only yield contacts with frames from the first to the last value (inclusive)
+    atom_columns: int, default = MAX_CONTACT_ATOMS
+        Atom columns of each contact record, the atom_columns of the header
+    end_offset: int, default = None
+        Byte offset of a block at which to stop, see `contact_file_chunks`
+
+    Yields
+    ------
+    frames: np.array of ints with shape (num_contacts,)
+    itypes: np.array of ints with shape (num_contacts,)
+        Interaction type codes, see the itype_names of the header
+    atoms: np.array of ints with shape (num_contacts, atom_columns)
+        Atom indices into the atom_labels of the header, padded with -1
+    """
+    while end_offset is None or contact_fd.tell() < end_offset:
+        block_size = contact_fd.read(8)
+        if len(block_size) < 8:
+            return
+        num_contacts = struct.unpack("<Q", block_size)[0]
+        frames = np.frombuffer(contact_fd.read(num_contacts * 8), dtype="<i8")
+        itypes = np.frombuffer(contact_fd.read(num_contacts), dtype="u1")
+        atoms = np.frombuffer(contact_fd.read(num_contacts * atom_columns * 4), dtype="<i4")
+        if len(atoms) != num_contacts * atom_columns:
+            raise ValueError("Binary contact file %s is truncated" % getattr(contact_fd, "name", ""))
+        atoms = atoms.reshape(num_contacts, atom_columns)
+
+        if frame_range is not None and num_contacts > 0:
+            if frames[0] > frame_range[1]:
+                return
+            rows = (frames >= frame_range[0]) & (frames <= frame_range[1])
+            if not rows.all():
+                frames, itypes, atoms = frames[rows], itypes[rows], atoms[rows]
+        yield frames, itypes, atoms
+
+
+def frame_index_path(contact_path):
+    """
+    Path of the sidecar frame index of a contact file
+    """
+    return contact_path + ".idx"
+
+
+def write_frame_index_header(index_fd):
+    """
+    Write the magic number of a frame index to a file opened for writing in binary mode
+    """
+    index_fd.write(FRAME_INDEX_MAGIC)
+
+
+def write_frame_index_entries(index_fd, frames, offsets):
+    """
+    Append (frame, byte offset) entries to a frame index opened for writing in binary mode
+    """
+    entries = np.stack([np.asarray(frames, dtype="<i8"), np.asarray(offsets, dtype="<i8")], axis=1)
+    index_fd.write(entries.tobytes())
+
+
+def read_frame_index(index_path):
+    """
+    Read a frame index written by `write_frame_index_header` and `write_frame_index_entries`
+
+    Returns
+    -------
+    frames: np.array of ints
+        Indexed frames in increasing order
+    offsets: np.array of ints
+        Byte offset of each indexed frame in the contact file
+    """
+    with open(index_path, "rb") as index_fd:
+        if index_fd.read(len(FRAME_INDEX_MAGIC)) != FRAME_INDEX_MAGIC:
+            raise ValueError("%s is not a frame index" % index_path)
+        entries = np.frombuffer(index_fd.read(), dtype="<i8").reshape(-1, 2)
+    return entries[:, 0], entries[:, 1]
+
+
+def seek_to_frame(contact_fd, contact_path, frame):
+    """
+    Move `contact_fd` to the last indexed position at or before the first contact of `frame`. The
+    position is left unchanged if the contact file has no frame index or `frame` precedes all entries.
+
+    Returns
+    -------
+    seeked: bool
+        Whether `contact_fd` was moved
+    """
+    index_path = frame_index_path(contact_path)
+    if not os.path.exists(index_path):
+        return False
+    frames, offsets = read_frame_index(index_path)
+    entry = np.searchsorted(frames, frame, side="right") - 1
+    if entry < 0:
+        return False
+    contact_fd.seek(int(offsets[entry]))
+    return True
+
+
+def contact_file_chunks(contact_path, chunk_bytes):
+    """
+    Split a tsv or bin contact file into byte ranges of roughly `chunk_bytes` that start and end
+    at frame boundaries, so the contacts of every frame are in a single range. The first range
+    starts at the beginning of a tsv file and after the header of a bin file, and the ranges
+    can be read with the byte_range of `iter_contact_lines` and the end_offset of
+    `iter_binary_blocks`.
+
+    Parameters
+    ----------
+    contact_path: str
+    chunk_bytes: int
+
+    Returns
+    -------
+    chunks: list of tuples of (int, int)
+        Consecutive [begin, end) byte offsets covering the contacts of the file
+    """
+    file_size = os.path.getsize(contact_path)
+    if is_binary_contact_file(contact_path):
+        with open(contact_path, "rb") as contact_fd:
+            header = read_binary_header(contact_fd)
+            # Blocks never share frames, so chunks are built from whole blocks
+            record_bytes = 8 + 1 + 4 * header["atom_columns"]
+            boundaries = [contact_fd.tell()]
+            offset = boundaries[0]
+            while offset < file_size:
+                contact_fd.seek(offset)
+                block_size = contact_fd.read(8)
+                if len(block_size) < 8:
+                    break
+                offset += 8 + struct.unpack("<Q", block_size)[0] * record_bytes
+                if offset - boundaries[-1] >= chunk_bytes:
+                    boundaries.append(offset)
+    else:
+        boundaries = [0]
+        with open(contact_path, "rb") as contact_fd:
+            while boundaries[-1] + chunk_bytes < file_size:
+                # Skip the partial line at the target offset and the rest of the frame it is in
+                contact_fd.seek(boundaries[-1] + chunk_bytes)
+                contact_fd.readline()
+                chunk_frame = None
+                offset = contact_fd.tell()
+                line = contact_fd.readline()
+                while line:
+                    if line.strip() and not line.startswith(b"#"):
+                        frame = int(line[0:line.index(b"\t")])
+                        if chunk_frame is not None and frame != chunk_frame:
+                            break
+                        chunk_frame = frame
+                    offset = contact_fd.tell()
+                    line = contact_fd.readline()
+                if not line:
+                    break
+                boundaries.append(offset)
+    if boundaries[-1] < file_size:
+        boundaries.append(file_size)
+    return list(zip(boundaries[0:-1], boundaries[1:]))
+
+
+def read_contact_header(contact_path):
+    """
+    Read the header of a contact file in any of the CONTACT_FORMATS
+
+    Returns
+    -------
+    header: dict
+        total_frames (None if not specified), first_frame (0 if not specified), stride (1 if not
+        specified) and interaction_types (empty if not specified)
+    """
+    if is_binary_contact_file(contact_path):
+        with open(contact_path, "rb") as contact_fd:
+            header = read_binary_header(contact_fd)
+        return {key: header[key] for key in ("total_frames", "first_frame", "stride", "interaction_types")}
+
+    header = {"total_frames": None, "first_frame": 0, "stride": 1, "interaction_types": []}
+    with open(contact_path, "r") as contact_fd:
+        for line in contact_fd:
+            if not line.startswith("#"):
+                break
+            total_frames_match = re.search(r'total_frames:(\d+)', line)
+            if total_frames_match:
+                header["total_frames"] = int(total_frames_match.group(1))
+            for key in ("first_frame", "stride"):
+                value_match = re.search(key + r':(\d+)', line)
+                if value_match:
+                    header[key] = int(value_match.group(1))
+            itypes_match = re.search(r'interaction_types:(\S+)', line)
+            if itypes_match:
+                header["interaction_types"] = itypes_match.group(1).split(",")
+    return header
+
+
+def count_frames_in_range(header, frame_range):
+    """
+    Number of computed frames of a contact file with frame numbers from the first to the last
+    value of `frame_range` (inclusive)
+
+    Parameters
+    ----------
+    header: dict
+        Header of the contact file with total_frames, first_frame and stride, see `read_contact_header`
+    frame_range: tuple of (int, int)
+
+    Returns
+    -------
+    num_frames: int
+    """
+    first_frame, stride = header["first_frame"], header["stride"]
+    first_step = max(0, -((first_frame - frame_range[0]) // stride))
+    last_step = min(header["total_frames"] - 1, (frame_range[1] - first_frame) // stride)
+    return max(0, last_step - first_step + 1)
+
+
+def iter_contact_lines(contact_path, frame_range=None, byte_range=None):
+    """
+    Iterate over the lines of a tsv contact file. The header lines are always yielded. If
+    `frame_range` is given, only contact lines with frames from the first to the last value
+    (inclusive) are yielded, and the frame index is used to skip to the first one. If
+    `byte_range` is given, only the lines from its first up to its second byte offset are read,
+    see `contact_file_chunks`, and header lines are yielded only if they are in the range.
+    """
+    if byte_range is not None:
+        with open(contact_path, "rb") as contact_fd:
+            contact_fd.seek(byte_range[0])
+            offset = byte_range[0]
+            while offset < byte_range[1]:
+                line = contact_fd.readline()
+                if not line:
+                    return
+                offset += len(line)
+                line = line.decode("utf-8")
+                if frame_range is not None and line.strip() and not line.startswith("#"):
+                    frame = int(line[0:line.index("\t")])
+                    if frame > frame_range[1]:
+                        return
+                    if frame < frame_range[0]:
+                        continue
+                yield line
+        return
+
+    if frame_range is None:
+        with open(contact_path, "r") as contact_fd:
+            for line in contact_fd:
+                yield line
+        return
+
+    # Byte offsets of the frame index require reading in binary mode
+    with open(contact_path, "rb") as contact_fd:
+        line = contact_fd.readline().decode("utf-8")
+        while line.startswith("#"):
+            yield line
+            line = contact_fd.readline().decode("utf-8")
+
+        if seek_to_frame(contact_fd, contact_path, frame_range[0]):
+            line = contact_fd.readline().decode("utf-8")
+        while line:
+            if line.strip():
+                frame = int(line[0:line.index("\t")])
+                if frame > frame_range[1]:
+                    return
+                if frame >= frame_range[0]:
+                    yield line
+            line = contact_fd.readline().decode("utf-8")
+
+
+def read_contacts(contact_path, itypes=None, frame_range=None):
+    """
+    Iterate over the contacts of a contact file in any of the CONTACT_FORMATS
+
+    Parameters
+    ----------
+    contact_path: str or file
+        Path to a contact file generated by get_dynamic_contacts.py, or a file opened on one. File
+        objects are read from their current position without using a frame index, and are not closed.
+    itypes: collection of str, default = None
+        Only yield contacts of these interaction types, all contacts if None
+    frame_range: tuple of (int, int), default = None
+        Only yield contacts with frames from the first to the last value (inclusive). Uses the
+        frame index of the contact file if it has one.
+
+    Yields
+    ------
+    contact: tuple of (int, str, str, str[, str, ...])
+        Frame, interaction type and 2 or more atom labels, e.g. (0, "hbbb", "A:ARG:4:H", "A:PHE:22:O")
+    """
+    if hasattr(contact_path, "read"):
+        for contact in _read_contacts_from_file(contact_path, itypes, frame_range):
+            yield contact
+        return
+
+    if is_interval_contact_file(contact_path):
+        for contact in iter_interval_contacts(contact_path, itypes, frame_range):
+            yield contact
+        return
+
+    if not is_binary_contact_file(contact_path):
+        for contact in _parse_contact_lines(iter_contact_lines(contact_path, frame_range), itypes):
+            yield contact
+        return
+
+    with open(contact_path, "rb") as contact_fd:
+        header = read_binary_header(contact_fd)
+        if frame_range is not None:
+            seek_to_frame(contact_fd, contact_path, frame_range[0])
+        for contact in _iter_binary_contacts(contact_fd, header, itypes, frame_range):
+            yield contact
+
+
+def _read_contacts_from_file(contact_fd, itypes=None, frame_range=None):
+    """
+    Iterate over the contacts of a file object opened on a contact file, see `read_contacts`.
+    Binary contact files must be opened in binary mode, tsv and interval files in either mode.
+    """
+    lines = contact_fd
+    if not isinstance(contact_fd, io.TextIOBase):
+        magic = contact_fd.read(len(BINARY_MAGIC))
+        if magic == BINARY_MAGIC:
+            header = _read_binary_header_fields(contact_fd)
+            for contact in _iter_binary_contacts(contact_fd, header, itypes, frame_range):
+                yield contact
+            return
+        lines = (line.decode("utf-8") for line in itertools.chain([magic + contact_fd.readline()], contact_fd))
+
+    first_line = next(lines, "")
+    lines = itertools.chain([first_line], lines)
+    if first_line.startswith("#") and INTERVAL_FORMAT_TOKEN in first_line:
+        stride = 1
+        stride_match = re.search(r'stride:(\d+)', first_line)
+        if stride_match:
+            stride = int(stride_match.group(1))
+        for contact in _expand_interval_contacts(_parse_interval_lines(lines, itypes), stride, frame_range):
+            yield contact
+        return
+
+    for contact in _parse_contact_lines(lines, itypes, frame_range):
+        if frame_range is not None and contact[0] > frame_range[1]:
+            return
+        yield contact
+
+
+def _parse_contact_lines(lines, itypes=None, frame_range=None):
+    """
+    Parse the lines of a tsv contact file into contacts, skipping empty and header lines and
+    contacts before the first frame of `frame_range`
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue  # Ignore empty and commented lines
+        columns = line.split("\t")
+        if itypes is not None and columns[1] not in itypes:
+            continue
+        frame = int(columns[0])
+        if frame_range is not None and frame < frame_range[0]:
+            continue
+        yield (frame, columns[1]) + tuple(columns[2:])
+
+
+def _iter_binary_contacts(contact_fd, header, itypes=None, frame_range=None):
+    """
+    Iterate over the contacts of the blocks of a binary contact file from the current position of
+    `contact_fd`, labelled using its `header`
+    """
+    itype_names = header["itype_names"]
+    atom_labels = header["atom_labels"]
+    selected_codes = [code for code, itype in enumerate(itype_names) if itypes is None or itype in itypes]
+    for frames, itype_codes, atoms in iter_binary_blocks(contact_fd, frame_range, header["atom_columns"]):
+        rows = np.nonzero(np.isin(itype_codes, selected_codes))[0]
+        for frame, itype_code, contact_atoms in zip(frames[rows].tolist(), itype_codes[rows].tolist(),
+                                                    atoms[rows].tolist()):
+            yield (frame, itype_names[itype_code]) + tuple(atom_labels[atom] for atom in contact_atoms
+                                                          if atom >= 0)
+
+
+def write_interval_header(output_fd, total_frames, interaction_types, first_frame=0, stride=1):
+    """
+    Write the header lines of an interval contact file to a file opened for writing in binary mode.
+    Unlike tsv files, first_frame and stride are always recorded.
+    """
+    output_fd.write(("# total_frames:%d interaction_types:%s first_frame:%d stride:%d %s\n" %
+                     (total_frames, ",".join(interaction_types), first_frame, stride,
+                      INTERVAL_FORMAT_TOKEN)).encode())
+    output_fd.write(b"# Columns: interaction_type, atom_1, atom_2[, ...], intervals\n")
+
+
+def is_interval_contact_file(contact_path):
+    """
+    Check whether the header line of the file at `contact_path` marks it as an interval contact file
+    """
+    with open(contact_path, "rb") as contact_fd:
+        first_line = contact_fd.readline(4096)
+    return first_line.startswith(b"#") and INTERVAL_FORMAT_TOKEN.encode() in first_line
+
+
+def add_contact_intervals(interval_contacts, contacts, stride=1):
+    """
+    Add contacts ordered by frame to the frame intervals of their interactions. A contact extends
+    the last interval of its interaction if it is in the next computed frame, otherwise it opens a
+    new interval. Contacts repeated within a frame increase the count of the interval.
+
+    Parameters
+    ----------
+    interval_contacts: dict mapping tuple to list of [int, int, int]
+        Maps each interaction, the contact without its frame, to its [start, end, count]
+        intervals in order of first appearance. Updated in place.
+    contacts: iterable of tuples or lists, [(frame, interaction_type, atom_1, atom_2, ...), ...]
+    stride: int, default = 1
+        Step between computed frames
+
+    Returns
+    -------
+    interval_contacts: dict mapping tuple to list of [int, int, int]
+    """
+    for contact in contacts:
+        frame, interaction = contact[0], tuple(contact[1:])
+        intervals = interval_contacts.get(interaction)
+        if intervals is None:
+            interval_contacts[interaction] = [[frame, frame + stride, 1]]
+            continue
+
+        last = intervals[-1]
+        if last[1] == frame + stride:
+            # Repeated within the frame, so only the frame itself gets a higher count
+            if last[0] == frame:
+                last[2] += 1
+            else:
+                last[1] = frame
+                intervals.append([frame, frame + stride, last[2] + 1])
+            if len(intervals) > 1 and intervals[-2][1] == frame and intervals[-2][2] == intervals[-1][2]:
+                repeated = intervals.pop()
+                intervals[-1][1] = repeated[1]
+        elif last[1] == frame and last[2] == 1:
+            last[1] = frame + stride
+        elif last[1] <= frame:
+            intervals.append([frame, frame + stride, 1])
+    return interval_contacts
+
+
+def merge_contact_intervals(interval_contacts, later_interval_contacts):
+    """
+    Append later intervals to `interval_contacts` (see `add_contact_intervals`) in place, joining
+    intervals that touch and have the same count
+
+    Parameters
+    ----------
+    interval_contacts: dict mapping tuple to list of [int, int, int]
+    later_interval_contacts: iterable of (tuple, list of (int, int, int))
+        Interactions and their intervals, ie from `read_interval_contacts`, that all start at or
+        after the intervals of the same interaction in `interval_contacts` end
+    """
+    for interaction, later_intervals in later_interval_contacts:
+        intervals = interval_contacts.get(interaction)
+        if intervals is None:
+            interval_contacts[interaction] = [list(interval) for interval in later_intervals]
+            continue
+        later_intervals = [list(interval) for interval in later_intervals]
+        if intervals[-1][1] == later_intervals[0][0] and intervals[-1][2] == later_intervals[0][2]:
+            intervals[-1][1] = later_intervals[0][1]
+            later_intervals = later_intervals[1:]
+        intervals.extend(later_intervals)
+
+
+def write_interval_contacts(output_fd, interval_contacts):
+    """
+    Write one line per interaction of `interval_contacts` (see `add_contact_intervals`) with its
+    interaction type, atom labels and intervals to a file opened for writing in binary mode
+    """
+    for interaction, intervals in interval_contacts.items():
+        output_fd.write(("%s\t%s\n" % ("\t".join(interaction),
+                                        ",".join(_format_interval(interval) for interval in intervals))).encode("utf-8"))
+
+
+def _format_interval(interval):
+    """
+    Format a [start, end, count] interval as start:end, or start:end:count if count is not 1
+    """
+    start, end, count = interval
+    if count == 1:
+        return "%d:%d" % (start, end)
+    return "%d:%d:%d" % (start, end, count)
+
+
+def read_interval_contacts(contact_path, itypes=None):
+    """
+    Iterate over the interactions of an interval contact file
+
+    Parameters
+    ----------
+    contact_path: str
+    itypes: collection of str, default = None
+        Only yield interactions of these interaction types, all interactions if None
+
+    Yields
+    ------
+    interaction: tuple of (str, str, str[, str, ...])
+        Interaction type and atom labels
+    intervals: list of tuples of (int, int, int)
+        [start, end) frame intervals in which the interaction is present, and the number of times
+        it occurs in each of their frames
+    """
+    with open(contact_path, "r") as contact_fd:
+        for interaction, intervals in _parse_interval_lines(contact_fd, itypes):
+            yield interaction, intervals
+
+
+def _parse_interval_lines(lines, itypes=None):
+    """
+    Parse the lines of an interval contact file into interactions and their intervals, see
+    `read_interval_contacts`
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+        columns = line.split("\t")
+        if itypes is not None and columns[0] not in itypes:
+            continue
+        intervals = [_parse_interval(interval) for interval in columns[-1].split(",")]
+        yield tuple(columns[0:-1]), intervals
+
+
+def _parse_interval(interval_str):
+    """
+    Parse an interval written by `_format_interval` into a tuple of (start, end, count)
+    """
+    values = [int(value) for value in interval_str.split(":")]
+    if len(values) == 2:
+        values.append(1)
+    return tuple(values)
+
+
+def iter_interval_contacts(contact_path, itypes=None, frame_range=None):
+    """
+    Expand an interval contact file into per-frame contacts like those of a tsv file, ordered by
+    frame and within a frame by the order of the interactions in the file. The interactions of the
+    file are kept in memory, but not their frames.
+
+    Parameters
+    ----------
+    contact_path: str
+    itypes: collection of str, default = None
+        Only yield contacts of these interaction types, all contacts if None
+    frame_range: tuple of (int, int), default = None
+        Only yield contacts with frames from the first to the last value (inclusive)
+
+    Yields
+    ------
+    contact: tuple of (int, str, str, str[, str, ...])
+        Frame, interaction type and atom labels
+    """
+    stride = read_contact_header(contact_path)["stride"]
+    for contact in _expand_interval_contacts(read_interval_contacts(contact_path, itypes), stride, frame_range):
+        yield contact
+
+
+def _expand_interval_contacts(interval_contacts, stride, frame_range=None):
+    """
+    Expand interactions and their intervals into per-frame contacts, see `iter_interval_contacts`
+    """
+    interactions, interaction_intervals = [], []
+    # Heap of (next frame, interaction position, interval position) with one entry per interaction
+    upcoming = []
+    for interaction, intervals in interval_contacts:
+        if frame_range is not None:
+            # Move starts before the range to the first frame of the interval within it
+            intervals = [(max(start, start - ((start - frame_range[0]) // stride) * stride), end, count)
+                         for start, end, count in intervals]
+            intervals = [(start, end, count) for start, end, count in intervals
+                         if start < end and start <= frame_range[1]]
+            if not intervals:
+                continue
+        interactions.append(interaction)
+        interaction_intervals.append(intervals)
+        upcoming.append((intervals[0][0], len(interactions) - 1, 0))
+    heapq.heapify(upcoming)
+
+    while upcoming:
+        frame, interaction_pos, interval_pos = upcoming[0]
+        if frame_range is not None and frame > frame_range[1]:
+            return
+        intervals = interaction_intervals[interaction_pos]
+        contact = (frame,) + interactions[interaction_pos]
+        for _ in range(intervals[interval_pos][2]):
+            yield contact
+
+        if frame + stride < intervals[interval_pos][1]:
+            heapq.heapreplace(upcoming, (frame + stride, interaction_pos, interval_pos))
+        elif interval_pos + 1 < len(intervals):
+            heapq.heapreplace(upcoming, (intervals[interval_pos + 1][0], interaction_pos, interval_pos + 1))
+        else:
+            heapq.heappop(upcoming)
@@ -19,12 +19,47 @@
 ############################################################################
 
 from vmd import *
+from vmd import vmdnumpy
 import numpy as np
 import math
 import re
 import sys
 import os
+import struct
 from contextlib import contextmanager
+from .profiling import *
+from .contact_io import MAX_WATER_BRIDGE_DEPTH
+
+############################################################################
+# Globals
+############################################################################
+
+# Interaction types in the order of their integer codes. Contacts are passed around as
+# [frame_idx, itype_code, atom_index, ...] and only converted to labels when written
+# Water bridges through 3 or more waters (wb3, lwb3, ...) are only computed when requested with
+# the WATER_BRIDGE_DEPTH criterion, up to MAX_WATER_BRIDGE_DEPTH, and take codes after all other interaction types
+ITYPE_NAMES = ["sb", "pc", "ps", "ts", "vdw", "hb", "lhb", "hbss", "hbsb", "hbbb", "wb", "wb2",
+               "hls", "hlb", "lwb", "lwb2"] + \
+              ["wb%d" % depth for depth in range(3, MAX_WATER_BRIDGE_DEPTH + 1)] + \
+              ["lwb%d" % depth for depth in range(3, MAX_WATER_BRIDGE_DEPTH + 1)]
+ITYPE_CODES = {itype: code for code, itype in enumerate(ITYPE_NAMES)}
+
+# VMD's evaltcl, wrapped by `evaltcl` below. Modules that star-import contact_utils after vmd
+# pick up the wrapper, so every Tcl round trip is counted when profiling.
+vmd_evaltcl = evaltcl
+
+############################################################################
+# Functions
+############################################################################
+
+
+def evaltcl(command):
+    """
+    Evaluate a Tcl command in VMD. When profiling is enabled the call is counted for the
+    running profile stage.
+    """
+    count_profile("evaltcl_calls", per_stage=True)
+    return vmd_evaltcl(command)
 
 
 def atoi(text):
@@ -72,6 +107,46 @@ def suppress_stdout():
             os.dup2(old_stdout, 1)
 
 
+def load_topology(top):
+    """
+    Loads in topology into VMD without any frames
+
+    Parameters
+    ----------
+    top: MD Topology
+
+    Returns
+    -------
+    molid: int
+        molid of the topology
+    """
+    with suppress_stdout():
+        molid = molecule.load(get_file_type(top), top)
+        molecule.delframe(molid)  # Ensure topology doesn't count as a frame
+
+    return molid
+
+
+def read_frames(molid, top, traj, beg_frame, end_frame, stride):
+    """
+    Reads a range of trajectory frames into a molecule that was loaded with `load_topology`
+
+    Parameters
+    ----------
+    molid: int
+    top: MD Topology
+    traj: MD Trajectory
+    beg_frame: int
+    end_frame: int
+    stride: int
+    """
+    with suppress_stdout():
+        if traj is not None:
+            molecule.read(molid, get_file_type(traj), traj, beg=beg_frame, end=end_frame, skip=stride, waitfor=-1)
+        else:
+            molecule.read(molid, get_file_type(top), top, beg=beg_frame, end=end_frame, skip=stride, waitfor=-1)
+
+
 def load_traj(top, traj, beg_frame, end_frame, stride):
     """
     Loads in topology and trajectory into VMD
@@ -89,34 +164,119 @@ def load_traj(top, traj, beg_frame, end_frame, stride):
     trajid: int
         simulation molid object
     """
-    with suppress_stdout():
-        top_file_type = get_file_type(top)
-        traj_file_type = get_file_type(traj)
-        trajid = molecule.load(top_file_type, top)
-        molecule.delframe(trajid)  # Ensure topology doesn't count as a frame
-        if traj is not None:
-            molecule.read(trajid, traj_file_type, traj, beg=beg_frame, end=end_frame, skip=stride, waitfor=-1)
+    trajid = load_topology(top)
+    read_frames(trajid, top, traj, beg_frame, end_frame, stride)
+    return trajid
+
+
+def dcd_length(traj):
+    """
+    Computes the number of frames of a DCD file from its header and file size.
+    The frame count stored in the header is not used, as it is stale for
+    trajectories that were appended to or are still being written.
+
+    Returns
+    -------
+    num_frames: int or None
+        None if the header can't be interpreted (ie fixed atoms)
+    """
+    with open(traj, "rb") as traj_fd:
+        header = traj_fd.read(92)
+        if len(header) < 92:
+            return None
+
+        # The first Fortran record is 84 bytes long, which also tells the byte order
+        for endian in ("<", ">"):
+            if struct.unpack(endian + "i", header[0:4])[0] == 84 and header[4:8] == b"CORD":
+                break
         else:
-            molecule.read(trajid, top_file_type, top, beg=beg_frame, end=end_frame, skip=stride, waitfor=-1)
+            return None
 
-    return trajid
+        icntrl = struct.unpack(endian + "20i", header[8:88])
+        num_fixed_atoms = icntrl[8]
+        is_charmm = icntrl[19] != 0
+        has_unitcell = is_charmm and icntrl[10] != 0
+        has_4d = is_charmm and icntrl[11] != 0
+        if num_fixed_atoms != 0:
+            return None
 
+        # Skip the title record and read the number of atoms
+        title_length = struct.unpack(endian + "i", traj_fd.read(4))[0]
+        traj_fd.seek(title_length + 4, os.SEEK_CUR)
+        num_atoms = struct.unpack(endian + "3i", traj_fd.read(12))[1]
+        header_size = traj_fd.tell()
 
-def simulation_length(top, traj):
+    frame_size = (3 + has_4d) * (4 * num_atoms + 8) + has_unitcell * (48 + 8)
+    return (os.path.getsize(traj) - header_size) // frame_size
+
+
+def netcdf_length(traj):
     """
-    Computes the simulation length efficiently
+    Computes the number of frames of a classic (CDF-1 and CDF-2) NetCDF file, such as
+    AMBER trajectories, from the number of records in its header.
+
+    Returns
+    -------
+    num_frames: int or None
+        None for NetCDF-4/HDF5 files, files that are still being streamed and files whose
+        header records no frames, ie without a record dimension or never synced
     """
+    with open(traj, "rb") as traj_fd:
+        header = traj_fd.read(8)
+    if len(header) < 8 or header[0:3] != b"CDF" or header[3:4] not in (b"\x01", b"\x02"):
+        return None
 
+    num_records = struct.unpack(">I", header[4:8])[0]
+    if num_records == 0xFFFFFFFF or num_records == 0:
+        return None
+    return num_records
+
+
+def vmd_simulation_length(top, traj):
+    """
+    Computes the simulation length by loading the trajectory in VMD, which
+    works for every format VMD can read but has to scan the whole file.
+    """
     trajid = load_traj(top, traj, 0, -1, 100)
     num_frags = molecule.numframes(trajid)
+    molecule.delete(trajid)
 
     # There are between (num_frags-1)*100 and num_frags*100 frames.
     # Read all frames of the last fragment to determine the exact amount
     trajid = load_traj(top, traj, (num_frags-1)*100, -1, 1)
     last_frag_frames = molecule.numframes(trajid)
+    molecule.delete(trajid)
     return (num_frags - 1) * 100 + last_frag_frames
 
 
+def simulation_length(top, traj):
+    """
+    Computes the simulation length efficiently. DCD and NetCDF frame counts are read
+    from the file headers, other formats fall back to loading the trajectory in VMD.
+
+    Parameters
+    ----------
+    top: MD Topology
+    traj: MD Trajectory
+        A single trajectory file. Replicas are measured one at a time, as compute_contacts
+        treats them as independent trajectories rather than one concatenated trajectory.
+
+    Returns
+    -------
+    num_frames: int
+    """
+    num_frames = None
+    traj_file_type = get_file_type(traj)
+    if traj_file_type == "dcd":
+        num_frames = dcd_length(traj)
+    elif traj_file_type == "netcdf":
+        num_frames = netcdf_length(traj)
+
+    if num_frames is None:
+        num_frames = vmd_simulation_length(top, traj)
+    return num_frames
+
+
 def get_atom_selection_labels(selection_id):
     """
     Returns list of atom labels for each atom in selection_id
@@ -202,6 +362,36 @@ def gen_index_to_atom_label(top, traj):
     return index_to_label
 
 
+def gen_output_labels(index_to_label):
+    """
+    Generate the label that is written to the output for each atom
+
+    Parameters
+    ----------
+    index_to_label: dict
+        Maps VMD atom index to label "chain:resname:resid:name:index"
+        {11205: "A:ASP:114:CA:11205, ...}
+
+    Returns
+    -------
+    output_labels: list of strings
+        output_labels[index] is the label "chain:resname:resid:name" of the atom with VMD index `index`
+    """
+    output_labels = [""] * (max(index_to_label) + 1 if index_to_label else 0)
+    for index, atom_label in index_to_label.items():
+        # Strip vmd ID from atom strings
+        output_labels[index] = atom_label[0:atom_label.rfind(":")]
+    return output_labels
+
+
+def format_contact(contact, output_labels):
+    """
+    Format an integer encoded contact [frame_idx, itype_code, atom_index, ...] as an output line
+    """
+    atom_labels = "\t".join([output_labels[index] for index in contact[2:]])
+    return "%d\t%s\t%s\n" % (contact[0], ITYPE_NAMES[contact[1]], atom_labels)
+
+
 def get_anion_atoms(traj_frag_molid, frame_idx, sele_id):
     """
     Get list of anion atoms that can form salt bridges
@@ -313,62 +503,104 @@ def get_aromatic_atom_triplets(traj_frag_molid, frame_idx, chain_id):
     return aromatic_atom_triplet_list
 
 
-def convert_to_single_atom_aromatic_string(aromatic_atom_label):
+def water_bridge_itype(depth, ligand=False):
     """
-    Replaces any aromatic ring atom with CG label
-
-    Returns
-    -------
-    aromatic_CG_atom_label: The CG atom label for an aromatic ring (ie C:PHE:49:CG)
+    Name of the interaction type of water bridges through `depth` waters, ie "wb", "wb2", "wb3"
+    or "lwb", "lwb2", "lwb3" for ligands
     """
-
-    aromatic_CG_atom_label = ":".join(aromatic_atom_label.split(":")[0:3]) + ":CG:vmd_idx"
-    return aromatic_CG_atom_label
+    prefix = "lwb" if ligand else "wb"
+    return prefix if depth == 1 else "%s%d" % (prefix, depth)
 
 
-def calc_water_to_residues_map(water_hbonds, solvent_resn):
+def calc_water_graph(water_hbonds, solvent_mask):
     """
+    Build the hydrogen bond graph of the waters in a single frame. It is built once per frame and
+    all water bridges, whatever their depth, are derived from it.
+
+    Parameters
+    ----------
+    water_hbonds: list, [[frame_idx, atom1_index, atom2_index, itype_code], ...]
+        Hydrogen bonds of a single frame that involve at least one solvent atom
+    solvent_mask: np.array of bools
+        Boolean mask of solvent atoms indexed by VMD index
+
     Returns
     -------
     frame_idx: int
         Specify frame index with respect to the smaller trajectory fragment
-    water_to_residues: dict mapping string to list of strings
-        Map each water molecule to the list of residues it forms
-        contacts with (ie {"W:TIP3:8719:OH2:29279" : ["A:PHE:159:N:52441", ...]})
-    solvent_bridges: list
-        List of hbond interactions between two water molecules
-        [("W:TIP3:757:OH2:2312", "W:TIP3:8719:OH2:29279"), ...]
+    water_to_residues: dict mapping int to set of ints
+        Map each water atom to the set of residue (or ligand) atoms it forms
+        contacts with (ie {29279 : {52441, ...}})
+    water_neighbors: dict mapping int to set of ints
+        Map each water atom to the water atoms it forms hydrogen bonds with,
+        in both directions (ie {2312: {29279}, 29279: {2312}})
+    water_bonds: set of tuples of (int, int)
+        Hydrogen bonds between two water atoms in the direction they were first
+        reported, w1--w2 and w2--w1 being the same (ie {(29279, 2312)})
     """
     frame_idx = 0
     water_to_residues = {}
-    _solvent_bridges = []
-    for frame_idx, atom1_label, atom2_label, itype in water_hbonds:
-        if solvent_resn in atom1_label and solvent_resn in atom2_label:
-            _solvent_bridges.append((atom1_label, atom2_label))
+    water_neighbors = {}
+    water_bonds = set()
+    for frame_idx, atom1, atom2, itype in water_hbonds:
+        atom1_is_water, atom2_is_water = solvent_mask[atom1], solvent_mask[atom2]
+        if atom1_is_water and atom2_is_water:
+            if atom2 not in water_neighbors.get(atom1, ()):
+                water_bonds.add((atom1, atom2))
+            water_neighbors.setdefault(atom1, set()).add(atom2)
+            water_neighbors.setdefault(atom2, set()).add(atom1)
             continue
-        elif solvent_resn in atom1_label and solvent_resn not in atom2_label:
-            water = atom1_label
-            protein = atom2_label
-        elif solvent_resn not in atom1_label and solvent_resn in atom2_label:
-            water = atom2_label
-            protein = atom1_label
+        elif atom1_is_water and not atom2_is_water:
+            water = atom1
+            protein = atom2
+        elif not atom1_is_water and atom2_is_water:
+            water = atom2
+            protein = atom1
         else:
             raise ValueError("Solvent residue name can't be resolved")
 
-        if water not in water_to_residues:
-            water_to_residues[water] = set()
-        water_to_residues[water].add(protein)
+        water_to_residues.setdefault(water, set()).add(protein)
 
-    # Remove duplicate solvent bridges (w1--w2 and w2--w1 are the same)
-    solvent_bridges = set()
-    for water1, water2 in _solvent_bridges:
-        key1 = (water1, water2)
-        key2 = (water2, water1)
-        if key1 not in solvent_bridges and key2 not in solvent_bridges:
-            solvent_bridges.add(key1)
-    solvent_bridges = sorted(list(solvent_bridges))
+    return frame_idx, water_to_residues, water_neighbors, water_bonds
+
+
+def calc_water_paths(water_to_residues, water_neighbors, water_bonds, max_depth):
+    """
+    Find chains of hydrogen bonded waters whose first and last water both form hydrogen bonds
+    with residue (or ligand) atoms, using a breadth first search over `water_neighbors` that
+    stops at `max_depth` waters. Chains start only at waters that touch residues and never
+    visit a water twice. A chain and its reverse are the same bridge, so chains of two waters
+    are only returned in the direction of their hydrogen bond in `water_bonds`, and longer
+    chains with the lower atom index first.
+
+    Parameters
+    ----------
+    water_to_residues: dict mapping int to set of ints
+        Generated by `calc_water_graph`
+    water_neighbors: dict mapping int to set of ints
+        Generated by `calc_water_graph`
+    water_bonds: set of tuples of (int, int)
+        Generated by `calc_water_graph`
+    max_depth: int
+        Largest number of waters in a chain
 
-    return frame_idx, water_to_residues, solvent_bridges
+    Returns
+    -------
+    water_paths: list of lists of tuples
+        water_paths[depth - 1] holds the chains of `depth` water atoms, ie [[(29279,), ...], [(2312, 29279), ...]]
+    """
+    water_paths = []
+    frontier = [(water,) for water in sorted(water_to_residues)]
+    for depth in range(1, max_depth + 1):
+        if depth > 1:
+            frontier = [path + (water,) for path in frontier
+                        for water in sorted(water_neighbors.get(path[-1], ())) if water not in path]
+        if depth == 2:
+            paths = [path for path in frontier if path in water_bonds]
+        else:
+            paths = [path for path in frontier if depth == 1 or path[0] < path[-1]]
+        water_paths.append([path for path in paths if path[-1] in water_to_residues])
+    return water_paths
 
 
 def compute_distance(molid, frame_idx, atom1_label, atom2_label):
@@ -591,6 +823,44 @@ def parse_contacts(contact_string):
 
 
 # Geometry Tools
+def get_frame_coords(traj_frag_molid, frame_idx):
+    """
+    Get x, y, z coordinates of every atom in a frame with a single bulk call into VMD
+
+    Parameters
+    ----------
+    traj_frag_molid: int
+        Denotes trajectory id in VMD
+    frame_idx: int
+        Frame of simulation in trajectory fragment
+
+    Returns
+    -------
+    coords: np.array of shape (num_atoms, 3) and dtype float32
+        Contiguous coordinate array indexed by VMD atom index. The array is a copy of VMD's
+        timestep, so it stays valid after the frame is unloaded and writing to it does not
+        move the atoms in VMD.
+    """
+    coords = vmdnumpy.timestep(traj_frag_molid, frame_idx)
+    return np.array(coords, dtype=np.float32, order="C")
+
+
+def get_atom_index(atom_label):
+    """
+    Extract VMD atom index from an atom label
+
+    Parameters
+    ----------
+    atom_label: string
+        Atom label (ie "A:GLU:323:OE2:55124")
+
+    Returns
+    -------
+    index: int (ie 55124)
+    """
+    return int(atom_label[atom_label.rfind(":")+1:])
+
+
 def get_coord(traj_frag_molid, frame_idx, atom_label):
     """
     Get x, y, z coordinate of an atom specified by its label
@@ -659,6 +929,25 @@ def calc_geom_distance(point1, point2):
     return distance
 
 
+def calc_distance_matrix(points1, points2):
+    """
+    Compute all pairwise distances between two sets of points. Leading dimensions
+    (ie frames) are broadcast so a whole block of frames can be handled at once.
+
+    Parameters
+    ----------
+    points1: np.array of shape (..., n1, 3)
+    points2: np.array of shape (..., n2, 3)
+
+    Returns
+    -------
+    distances: np.array of shape (..., n1, n2)
+    """
+    diff = points1[..., :, np.newaxis, :] - points2[..., np.newaxis, :, :]
+    distances = np.sqrt(np.einsum('...k,...k->...', diff, diff))
+    return distances
+
+
 def calc_geom_centroid(point1, point2, point3):
     """
     Compute centroid between three points
@@ -686,6 +975,57 @@ def calc_geom_normal_vector(point1, point2, point3):
     return normal_vector
 
 
+def calc_run_positions(run_begs, run_lengths):
+    """
+    Expand runs of consecutive positions, given by their first position and length,
+    into one array of positions
+
+    Returns
+    -------
+    positions: np.array of ints with shape (sum(run_lengths),)
+    """
+    run_offsets = np.arange(run_lengths.sum()) - np.repeat(np.cumsum(run_lengths) - run_lengths, run_lengths)
+    return np.repeat(run_begs, run_lengths) + run_offsets
+
+
+def calc_ring_geometry(ring_atom_coords):
+    """
+    Compute centroid and normal vector of rings that are each given by three atoms, as
+    calc_geom_centroid and calc_geom_normal_vector do. Leading dimensions (ie frames and rings)
+    are broadcast.
+
+    Parameters
+    ----------
+    ring_atom_coords: np.array of shape (..., 3, 3)
+        Coordinates of the three atoms of each ring
+
+    Returns
+    -------
+    centroids: np.array of shape (..., 3)
+    normal_vectors: np.array of shape (..., 3)
+    """
+    point1, point2, point3 = ring_atom_coords[..., 0, :], ring_atom_coords[..., 1, :], ring_atom_coords[..., 2, :]
+    centroids = (point1 + point2 + point3) / 3
+    normal_vectors = np.cross(point3 - point1, point2 - point1)
+    return centroids, normal_vectors
+
+
+def calc_angles_between_vectors(vectors1, vectors2):
+    """
+    Compute angles between vectors as calc_angle_between_vectors does, broadcasting over leading dimensions.
+    Angles involving zero-length vectors are NaN.
+
+    Returns
+    -------
+    angles: np.array of floats
+        Degrees between each pair of vectors
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cosines = np.einsum('...k,...k->...', vectors1, vectors2) / \
+                  (np.linalg.norm(vectors1, axis=-1) * np.linalg.norm(vectors2, axis=-1))
+    return np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0)))
+
+
 def calc_geom_psi_angle(center1, center2, normal_vector):
     """
     Parameters
@@ -26,6 +26,7 @@ There are three subtypes of flare objects:
 import json
 import re
 import sys
+from .contact_io import read_contacts, MAX_WATER_BRIDGE_DEPTH
 
 __all__ = ['parse_contacts', 'parse_residuelabels', 'create_flare', 'compose_flares', 'write_json',
            'compose_frequencytable']
@@ -227,19 +228,23 @@ def parse_residuelabels(label_file):
     return ret
 
 
-def parse_contacts(contact_file, itypes):
+def parse_contacts(contact_file, itypes, frame_range=None):
     """
     Parses the contact file and returns it a list of atomic contacts. Atom strings are converted to tuples by splitting
     on ":".
 
     Parameters
     ----------
-    contact_file: file
-        Contact-file generated by dynamic_contacts.py
+    contact_file: str or file
+        Path to a contact-file generated by get_dynamic_contacts.py, or a file opened on one. File objects
+        are left open; bin contact-files must be opened in binary mode.
 
     itypes: set of str
         A set of interaction types to retain.
 
+    frame_range: tuple of (int, int), default = None
+        Only retain contacts with frames from the first to the last value (inclusive).
+
     Returns
     -------
     list of tuples of (str, str, tuple, tuple [[, tuple], tuple])
@@ -251,29 +256,13 @@ def parse_contacts(contact_file, itypes):
         return tuple(atom_tokens)
 
     ret = []
-    for line in contact_file:
-        line = line.strip()
-        if not line or line[0] == "#":
-            continue  # Ignore empty and commented lines
-
-        # Check number of columns is correct and skip if interaction type is not specified
-        columns = line.split("\t")
-        if not len(columns) in range(4, 7):
-            raise AssertionError("Invalid interaction line: '"+line+"'")
-        if not columns[1] in itypes:
-            continue
+    for contact in read_contacts(contact_file, itypes, frame_range):
+        # Check number of columns is correct
+        if not len(contact) in range(4, 5 + MAX_WATER_BRIDGE_DEPTH):
+            raise AssertionError("Invalid interaction line: '"+"\t".join(map(str, contact))+"'")
 
         # Parse atoms
-        columns[2] = parse_atom(columns[2])
-        columns[3] = parse_atom(columns[3])
-        if len(columns) >= 5:
-            columns[4] = parse_atom(columns[4])
-        if len(columns) == 6:
-            columns[5] = parse_atom(columns[5])
-
-        ret.append(tuple(columns))
-
-    contact_file.close()
+        ret.append((str(contact[0]), contact[1]) + tuple(parse_atom(atom) for atom in contact[2:]))
 
     return ret
 
@@ -19,10 +19,13 @@
 ##############################################################################
 
 from vmd import *
+from .contact_utils import *
 from .stratify_hbonds import *
 from .stratify_ligand_hbonds import *
+from .neighbor_search import *
+from .solvation_shell import *
 
-__all__ = ['compute_hydrogen_bonds']
+__all__ = ['HBOND_ENGINES', 'compute_hydrogen_bonds', 'calc_hbond_candidates']
 
 ##############################################################################
 # Globals
@@ -30,6 +33,10 @@ __all__ = ['compute_hydrogen_bonds']
 WATER_TO_PROTEIN_DIST = 5
 WATER_TO_LIGAND_DIST = 12
 
+# vmd: `measure hbonds` on Tcl selections
+# native: donor hydrogens from topology bonds and geometric criteria in NumPy
+HBOND_ENGINES = ["vmd", "native"]
+
 ##############################################################################
 # Functions
 ##############################################################################
@@ -50,77 +57,23 @@ def filter_duplicates(donors, acceptors):
     return new_donors, new_acceptors
 
 
-def calc_ligand_donor_acceptor_pairs(traj_frag_molid, frame_idx, solvent_resn, sele_id, ligands,
-                                     HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE):
-    """
-    Compute donor and acceptor atom pairs for hydrogen bonds in terms of numeric VMD indices
+def parse_donor_acceptor_indices(donor_acceptor_indices):
     """
-    donors, acceptors = [], []
-    for ligand in ligands:
-        if sele_id is None:
-            measure_hbonds_command = "measure hbonds %s %s [atomselect %s \"" \
-                                     "(resname %s and within %s of resname %s) or " \
-                                     "(not carbon and not sulfur and protein within %s of resname %s) or " \
-                                     "(not carbon and not sulfur and resname %s) and (not lipid)\" frame %s]" % \
-                                     (HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, traj_frag_molid, solvent_resn,
-                                      WATER_TO_LIGAND_DIST, ligand, WATER_TO_LIGAND_DIST, ligand, ligand, frame_idx)
-        else:
-            measure_hbonds_command = "measure hbonds %s %s [atomselect %s \"" \
-                                     "(resname %s and within %s of resname %s) or " \
-                                     "((not carbon and not sulfur and protein and (%s)) and within %s of resname %s) or " \
-                                     "(not carbon and not sulfur and resname %s) and (not lipid)\" frame %s]" % \
-                                     (HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, traj_frag_molid, solvent_resn,
-                                      WATER_TO_LIGAND_DIST, ligand, sele_id, WATER_TO_LIGAND_DIST, ligand, ligand,
-                                      frame_idx)
-
-        # donor_acceptor_indices should be of format "{106 91 85 99 120 130} {91 55 55 69 105 69} {107 92 86 100 121 131}"
-        donor_acceptor_indices = evaltcl(measure_hbonds_command)
-
-        # Parse atom indices
-        donor_acceptor_lists = donor_acceptor_indices.split("}")
-
-        # Filter out improperly parsed coordinates
-        if len(donor_acceptor_lists) != 4:
-            continue
-        donor_list = donor_acceptor_lists[0].split("{")[1].split(" ")
-        acceptor_list = donor_acceptor_lists[1].split("{")[1].split(" ")
-
-        for idx, d in enumerate(donor_list):
-            a = acceptor_list[idx]
-            if d == "" or a == "":
-                continue
-            donors.append(int(d))
-            acceptors.append(int(a))
-
-    return donors, acceptors
+    Parse output of `measure hbonds` into lists of numeric VMD indices
 
+    Parameters
+    ----------
+    donor_acceptor_indices: string
+        Should be of format "{106 91 85 99 120 130} {91 55 55 69 105 69} {107 92 86 100 121 131}"
 
-def calc_donor_acceptor_pairs(traj_frag_molid, frame_idx, solvent_resn, sele_id,
-                              HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE):
-    """
-    Compute donor and acceptor atom pairs for hydrogen bonds in terms of numeric VMD indices
+    Returns
+    -------
+    donors: list of ints
+    acceptors: list of ints
     """
-    # Measure Hbonds command
-    if sele_id is None:
-        measure_hbonds_command = "measure hbonds %s %s [atomselect %s \"" \
-                                 "(resname %s and within %s of protein) or " \
-                                 "protein and not lipid and not carbon and not sulfur\" frame %s]" % \
-                                 (HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, traj_frag_molid, solvent_resn,
-                                  WATER_TO_PROTEIN_DIST, frame_idx)
-    else:
-        measure_hbonds_command = "measure hbonds %s %s [atomselect %s \"" \
-                                 "(resname %s and within %s of (protein and (%s))) or " \
-                                 "protein and (%s) and not lipid and not carbon and not sulfur\" frame %s]" % \
-                                 (HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, traj_frag_molid, solvent_resn,
-                                  WATER_TO_PROTEIN_DIST, sele_id, sele_id, frame_idx)
-
-    # donor_acceptor_indices should be of format "{106 91 85 99 120 130} {91 55 55 69 105 69} {107 92 86 100 121 131}"
-    donor_acceptor_indices = evaltcl(measure_hbonds_command)
-
-    # Parse atom indices
     donor_acceptor_lists = donor_acceptor_indices.split("}")
 
-    # Filter out improperly parsed coordinates 
+    # Filter out improperly parsed coordinates
     if len(donor_acceptor_lists) != 4:
         return [], []
     donor_list = donor_acceptor_lists[0].split("{")[1].split(" ")
@@ -137,8 +90,157 @@ def calc_donor_acceptor_pairs(traj_frag_molid, frame_idx, solvent_resn, sele_id,
     return donors, acceptors
 
 
-def compute_hydrogen_bonds(traj_frag_molid, frame_idx, index_to_label, solvent_resn, sele_id, ligand=None,
-                           HBOND_CUTOFF_DISTANCE=3.5, HBOND_CUTOFF_ANGLE=70):
+def calc_ligand_donor_acceptor_pairs(traj_frag_molid, frame_idx, ligands, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE,
+                                     neighbor_cache=None):
+    """
+    Compute donor and acceptor atom pairs for hydrogen bonds in terms of numeric VMD indices. Uses
+    the `ligand_hbond_atoms_<idx>` fragment selections which are updated to the current frame,
+    unless the pairs were prefetched into `neighbor_cache`.
+    """
+    donors, acceptors = [], []
+    for ligand_idx in range(len(ligands)):
+        selection_id = "ligand_hbond_atoms_%d" % ligand_idx
+        if neighbor_cache is not None and ("hbonds", selection_id) in neighbor_cache:
+            ligand_donors, ligand_acceptors = neighbor_cache[("hbonds", selection_id)]
+            donors += ligand_donors
+            acceptors += ligand_acceptors
+            continue
+        evaltcl("$%s frame %s" % (selection_id, frame_idx))
+        evaltcl("$%s update" % selection_id)
+        donor_acceptor_indices = evaltcl("measure hbonds %s %s $%s" %
+                                         (HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, selection_id))
+        ligand_donors, ligand_acceptors = parse_donor_acceptor_indices(donor_acceptor_indices)
+        donors += ligand_donors
+        acceptors += ligand_acceptors
+
+    return donors, acceptors
+
+
+def calc_donor_acceptor_pairs(traj_frag_molid, frame_idx, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE,
+                              neighbor_cache=None):
+    """
+    Compute donor and acceptor atom pairs for hydrogen bonds in terms of numeric VMD indices. Uses
+    the `hbond_atoms` fragment selection which is updated to the current frame, unless the pairs
+    were prefetched into `neighbor_cache`.
+    """
+    if neighbor_cache is not None and ("hbonds", "hbond_atoms") in neighbor_cache:
+        return neighbor_cache[("hbonds", "hbond_atoms")]
+    evaltcl("$hbond_atoms frame %s" % frame_idx)
+    evaltcl("$hbond_atoms update")
+    donor_acceptor_indices = evaltcl("measure hbonds %s %s $hbond_atoms" % (HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE))
+    return parse_donor_acceptor_indices(donor_acceptor_indices)
+
+
+def calc_native_donor_acceptor_pairs(coords, interaction_topology, candidate_atoms, HBOND_CUTOFF_DISTANCE,
+                                     HBOND_CUTOFF_ANGLE, neighbor_engine):
+    """
+    Compute donor and acceptor atom pairs among `candidate_atoms` with the criteria of `measure hbonds`.
+    Donor and acceptor are heavy atoms within HBOND_CUTOFF_DISTANCE, and the angle between donor,
+    a hydrogen bonded to the donor and acceptor deviates less than HBOND_CUTOFF_ANGLE from 180 degrees.
+
+    Parameters
+    ----------
+    coords: np.array of shape (num_atoms, 3)
+        Coordinates of all atoms in the frame, indexed by VMD atom index
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
+    candidate_atoms: np.array of ints
+        VMD indices of atoms that may act as donor or acceptor
+    HBOND_CUTOFF_DISTANCE: float
+    HBOND_CUTOFF_ANGLE: float
+    neighbor_engine: string, "cell" or "kdtree"
+
+    Returns
+    -------
+    donors: list of ints
+    acceptors: list of ints
+    """
+    candidate_atoms = candidate_atoms[~interaction_topology["hydrogen_mask"][candidate_atoms]]
+    positions1, positions2 = calc_neighbor_pairs(coords[candidate_atoms], None, HBOND_CUTOFF_DISTANCE,
+                                                 neighbor_engine)
+    count_profile("candidate_pairs", len(positions1), per_stage=True)
+
+    # Either atom of a pair may be the donor
+    atoms1, atoms2 = candidate_atoms[positions1], candidate_atoms[positions2]
+    donors, acceptors = np.concatenate([atoms1, atoms2]), np.concatenate([atoms2, atoms1])
+
+    # Expand each donor acceptor pair into one triplet per hydrogen bonded to the donor
+    donor_hydrogens = interaction_topology["donor_hydrogens"]
+    run_begs = np.searchsorted(donor_hydrogens[:, 0], donors, side="left")
+    run_ends = np.searchsorted(donor_hydrogens[:, 0], donors, side="right")
+    num_hydrogens = run_ends - run_begs
+    hydrogens = donor_hydrogens[calc_run_positions(run_begs, num_hydrogens), 1]
+    donors, acceptors = np.repeat(donors, num_hydrogens), np.repeat(acceptors, num_hydrogens)
+
+    dha_angles = calc_angles_between_vectors(coords[donors] - coords[hydrogens], coords[acceptors] - coords[hydrogens])
+    hbonded = 180 - dha_angles < HBOND_CUTOFF_ANGLE
+    return donors[hbonded].tolist(), acceptors[hbonded].tolist()
+
+
+def atoms_within(coords, atoms, reference_atoms, cutoff, neighbor_engine):
+    """
+    Equivalent of the VMD selection `atoms and within cutoff of reference_atoms`
+    """
+    positions, _ = calc_neighbor_pairs(coords[atoms], coords[reference_atoms], cutoff, neighbor_engine)
+    return atoms[np.unique(positions)]
+
+
+def shell_atoms_within(coords, atoms, reference_atoms, cutoff, neighbor_engine, solvation_shells=None,
+                       shell_key=None):
+    """
+    `atoms_within` from the shell tracked under `shell_key` if `solvation_shells` is given,
+    otherwise from scratch
+    """
+    if solvation_shells is None:
+        return atoms_within(coords, atoms, reference_atoms, cutoff, neighbor_engine)
+    return track_atoms_within(solvation_shells, shell_key, coords, atoms, reference_atoms, cutoff, neighbor_engine)
+
+
+def calc_hbond_candidates(coords, interaction_topology, ligand, neighbor_engine, solvation_shells=None):
+    """
+    Atoms considered for hydrogen bonds, matching the `hbond_atoms` and `ligand_hbond_atoms_<idx>`
+    fragment selections of the vmd engine. Used by the native hbond engine, and by the vmd engine
+    when solvation shells are tracked.
+
+    Parameters
+    ----------
+    coords: np.array of shape (num_atoms, 3)
+        Coordinates of all atoms in the frame, indexed by VMD atom index
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
+    ligand: list of string
+        Resnames of ligands, protein hydrogen bonds if None
+    neighbor_engine: string, "cell" or "kdtree"
+    solvation_shells: dict, default = None
+        Tracked shells from `init_solvation_shells`. Shells are computed from scratch if None.
+
+    Returns
+    -------
+    candidate_atom_groups: list of np.array of ints
+        One group of VMD indices for protein hbonds, or one group per ligand
+    """
+    solvent_atoms = interaction_topology["solvent_atoms"]
+    hbond_atoms = interaction_topology["hbond_atoms"]
+    if not ligand:
+        solvent_shell = shell_atoms_within(coords, solvent_atoms, interaction_topology["protein_atoms"],
+                                           WATER_TO_PROTEIN_DIST, neighbor_engine, solvation_shells, ("solvent", None))
+        return [np.concatenate([solvent_shell, hbond_atoms])]
+
+    candidate_atom_groups = []
+    for ligand_resn in ligand:
+        ligand_atoms = interaction_topology["ligand_atoms"][ligand_resn]
+        solvent_shell = shell_atoms_within(coords, solvent_atoms, ligand_atoms, WATER_TO_LIGAND_DIST, neighbor_engine,
+                                           solvation_shells, ("solvent", ligand_resn))
+        pocket_atoms = shell_atoms_within(coords, hbond_atoms, ligand_atoms, WATER_TO_LIGAND_DIST, neighbor_engine,
+                                          solvation_shells, ("pocket", ligand_resn))
+        ligand_hbond_atoms = interaction_topology["ligand_hbond_atoms"][ligand_resn]
+        candidate_atom_groups.append(np.unique(np.concatenate([solvent_shell, pocket_atoms, ligand_hbond_atoms])))
+    return candidate_atom_groups
+
+
+def compute_hydrogen_bonds(traj_frag_molid, frame_idx, coords, interaction_topology, ligand=None,
+                           HBOND_CUTOFF_DISTANCE=3.5, HBOND_CUTOFF_ANGLE=70, hbond_engine="vmd",
+                           neighbor_engine="cell", neighbor_cache=None, WATER_BRIDGE_DEPTH=2, solvation_shells=None):
     """
     Compute hydrogen bonds involving protein for a single frame of simulation
 
@@ -148,40 +250,64 @@ def compute_hydrogen_bonds(traj_frag_molid, frame_idx, index_to_label, solvent_r
         Specifies which trajectory fragment in VMD to perform computations upon
     frame_idx: int
         Specify frame index with respect to the smaller trajectory fragment
-    solvent_resn: string, default = TIP3
-        Denotes the resname of solvent in simulation
-    sele_id: string, default = None
-        Compute contacts on subset of atom selection based on VMD query
+    coords: np.array of shape (num_atoms, 3)
+        Coordinates of all atoms in the frame, indexed by VMD atom index
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
     ligand: list of string
-        ???
+        Resnames of ligands to compute ligand hydrogen bonds for, protein hydrogen bonds if None
     HBOND_CUTOFF_DISTANCE: float, default = 3.5 Angstroms
     HBOND_CUTOFF_ANGLE: float, default = 70 degrees
+    hbond_engine: string, default = "vmd"
+        One of HBOND_ENGINES
+    neighbor_engine: string, default = "cell"
+        Neighbor search used by the native hbond engine. The "vmd" neighbor engine falls back to "cell".
+    neighbor_cache: dict, default = None
+        Per-frame cache holding donor acceptor pairs of the "vmd" hbond engine prefetched by
+        `prefetch_frame_queries`
+    WATER_BRIDGE_DEPTH: int, default = 2
+        Largest number of waters in a water bridge, ie 3 adds wb3 or lwb3 bridges
+    solvation_shells: dict, default = None
+        Tracked shells from `init_solvation_shells` used by the native hbond engine. The vmd
+        engine picks up tracked shells through `neighbor_cache`.
 
     Return
     ------
-    hbonds: list of tuples, [(frame_idx, atom1_label, atom2_label, itype), ...]
+    hbonds: list of lists, [[frame_idx, itype_code, atom1_index, atom2_index, ...], ...]
+        Hydrogen bond subtypes from `stratify_hbond_subtypes` or `stratify_ligand_hbond_subtypes`
     """
-    itype = "hb"
-    if ligand:
-        itype = "lhb"
-        donors, acceptors = calc_ligand_donor_acceptor_pairs(traj_frag_molid, frame_idx, solvent_resn, sele_id, ligand,
-                                                             HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE)
+    itype = "hb" if not ligand else "lhb"
+    if hbond_engine == "native":
+        if neighbor_engine not in ("cell", "kdtree"):
+            neighbor_engine = "cell"
+        donors, acceptors = [], []
+        for candidate_atoms in calc_hbond_candidates(coords, interaction_topology, ligand, neighbor_engine,
+                                                     solvation_shells):
+            group_donors, group_acceptors = calc_native_donor_acceptor_pairs(coords, interaction_topology,
+                                                                             candidate_atoms, HBOND_CUTOFF_DISTANCE,
+                                                                             HBOND_CUTOFF_ANGLE, neighbor_engine)
+            donors += group_donors
+            acceptors += group_acceptors
+    elif ligand:
+        donors, acceptors = calc_ligand_donor_acceptor_pairs(traj_frag_molid, frame_idx, ligand,
+                                                             HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, neighbor_cache)
     else:
-        donors, acceptors = calc_donor_acceptor_pairs(traj_frag_molid, frame_idx, solvent_resn, sele_id,
-                                                      HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE)
+        donors, acceptors = calc_donor_acceptor_pairs(traj_frag_molid, frame_idx,
+                                                      HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, neighbor_cache)
 
     donors, acceptors = filter_duplicates(donors, acceptors)
+    count_profile("donor_acceptor_pairs", len(donors), per_stage=True)
 
     hbonds = []
     for idx, donor in enumerate(donors):
         acceptor = acceptors[idx]
-        donor_label, acceptor_label = index_to_label[donor], index_to_label[acceptor]
-        hbonds.append([frame_idx, donor_label, acceptor_label, itype])
+        hbonds.append([frame_idx, donor, acceptor, ITYPE_CODES[itype]])
 
     # Perform post processing on hbonds list to stratify into different subtypes
-    if itype == "hb":
-        hbond_subtypes = stratify_hbond_subtypes(hbonds, solvent_resn)
-    elif itype == "lhb":
-        hbond_subtypes = stratify_ligand_hbond_subtypes(hbonds, solvent_resn, ligand)
+    with profile_stage("stratify"):
+        if itype == "hb":
+            hbond_subtypes = stratify_hbond_subtypes(hbonds, interaction_topology, WATER_BRIDGE_DEPTH)
+        elif itype == "lhb":
+            hbond_subtypes = stratify_ligand_hbond_subtypes(hbonds, interaction_topology, WATER_BRIDGE_DEPTH)
 
     return hbond_subtypes
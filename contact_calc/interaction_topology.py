@@ -0,0 +1,422 @@
+############################################################################
+# Copyright 2018 Anthony Ma & Stanford University                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+##############################################################################
+# Imports
+##############################################################################
+
+from .contact_utils import *
+from .hbonds import WATER_TO_PROTEIN_DIST, WATER_TO_LIGAND_DIST, parse_donor_acceptor_indices, calc_hbond_candidates
+from .vanderwaals import ATOM_RADIUS, SOFT_VDW_CUTOFF
+from .neighbor_search import parse_contact_pairs
+
+__all__ = ['gen_interaction_topology', 'create_fragment_selections', 'delete_fragment_selections',
+           'gen_frame_queries', 'install_frame_proc', 'gen_shell_selections', 'prefetch_frame_queries']
+
+##############################################################################
+# Globals
+##############################################################################
+
+AROMATIC_RING_SELECTION = "((resname PHE) and (name CG CE1 CE2)) or " \
+                          "((resname TRP) and (name CD2 CZ2 CZ3)) or " \
+                          "((resname TYR) and (name CG CE1 CE2))"
+AROMATIC_RESIDUE_SELECTION = "resname PHE TRP TYR"
+BACKBONE_HBOND_ATOMS = ["N", "O"]
+FRAME_PROC = "getcontacts_frame"
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def get_selection_indices(molid, selection):
+    """
+    Evaluate a VMD atom selection query and return the VMD indices of the selected atoms
+
+    Returns
+    -------
+    indices: np.array of ints
+    """
+    evaltcl("set topology_sel [atomselect %s \" %s \" frame 0]" % (molid, selection))
+    indices = evaltcl("$topology_sel get index")
+    evaltcl("$topology_sel delete")
+    return np.array([int(index) for index in indices.split()], dtype=np.int64)
+
+
+def get_bonds(molid):
+    """
+    Retrieve all covalent bonds of the topology with a single `getbonds` call
+
+    Returns
+    -------
+    bonds: np.array of ints with shape (num_bonds, 2)
+        VMD indices of bonded atoms, lower index first
+    """
+    evaltcl("set topology_sel [atomselect %s \" all \" frame 0]" % molid)
+    indices = evaltcl("$topology_sel get index").split()
+    bond_lists = evaltcl("$topology_sel getbonds")
+    evaltcl("$topology_sel delete")
+
+    # getbonds returns a Tcl list with one (possibly unbraced) list of bonded partners per atom
+    bonds = []
+    for atom_idx, (braced, bare) in enumerate(re.findall(r"\{([^{}]*)\}|([^\s{}]+)", bond_lists)):
+        index = int(indices[atom_idx])
+        for partner in (braced or bare).split():
+            if index < int(partner):
+                bonds.append((index, int(partner)))
+
+    return np.array(bonds, dtype=np.int64).reshape(-1, 2)
+
+
+def restrict_to_sele(selection, sele_id):
+    """
+    Append the user specified `--sele` query to an atom selection
+    """
+    if sele_id is None:
+        return selection
+    return "(%s) and (%s)" % (selection, sele_id)
+
+
+def gen_aromatic_triplets(molid, index_to_label, sele_id):
+    """
+    Group the three equidistant ring atoms of each PHE, TRP and TYR residue
+
+    Returns
+    -------
+    aromatic_triplets: np.array of ints with shape (num_rings, 3)
+        VMD indices of the three ring atoms of each aromatic residue that
+        has at least one ring atom in the `--sele` query
+    ring_cg_atoms: np.array of ints with shape (num_rings,)
+        VMD index of the CG atom of each aromatic residue, which represents the
+        ring in the output. The first ring atom if the residue has no CG atom.
+    """
+    residue_to_atoms = {}
+    for index in get_selection_indices(molid, AROMATIC_RING_SELECTION):
+        residue_key = ":".join(index_to_label[index].split(":")[0:3])
+        residue_to_atoms.setdefault(residue_key, []).append(index)
+
+    residue_to_cg = {}
+    for index in get_selection_indices(molid, "(%s) and name CG" % AROMATIC_RESIDUE_SELECTION):
+        residue_to_cg[":".join(index_to_label[index].split(":")[0:3])] = index
+
+    selected_atoms = set(get_selection_indices(molid, restrict_to_sele(AROMATIC_RING_SELECTION, sele_id)))
+    aromatic_triplets, ring_cg_atoms = [], []
+    for residue_key in sorted(residue_to_atoms, key=natural_keys):
+        ring_atoms = residue_to_atoms[residue_key]
+        if len(ring_atoms) != 3 or not selected_atoms.intersection(ring_atoms):
+            continue
+        aromatic_triplets.append(ring_atoms)
+        ring_cg_atoms.append(residue_to_cg.get(residue_key, ring_atoms[0]))
+    return np.array(aromatic_triplets, dtype=np.int64).reshape(-1, 3), np.array(ring_cg_atoms, dtype=np.int64)
+
+
+def gen_donor_hydrogens(bonds, hydrogen_mask):
+    """
+    List the hydrogens covalently bonded to each heavy atom, which `measure hbonds`
+    considers when the heavy atom acts as donor
+
+    Returns
+    -------
+    donor_hydrogens: np.array of ints with shape (num_hydrogen_bonds, 2)
+        VMD indices of (heavy atom, hydrogen) pairs, sorted by heavy atom
+    """
+    hydrogen1, hydrogen2 = hydrogen_mask[bonds[:, 0]], hydrogen_mask[bonds[:, 1]]
+    donor_hydrogens = np.concatenate([bonds[~hydrogen1 & hydrogen2], bonds[hydrogen1 & ~hydrogen2][:, ::-1]])
+    return donor_hydrogens[np.argsort(donor_hydrogens[:, 0], kind="stable")]
+
+
+def gen_atom_property_arrays(index_to_label, num_atoms):
+    """
+    Convert the chain, resid, name and element of each atom label into arrays indexed by VMD index
+
+    Returns
+    -------
+    chain_codes: np.array of ints with shape (num_atoms,)
+        Integer code of the chain of each atom, equal codes denote equal chains
+    resids: np.array of ints with shape (num_atoms,)
+    vdw_radii: np.array of floats with shape (num_atoms,)
+        ATOM_RADIUS of the element of each atom (first letter of its name), NaN if unknown
+    backbone_mask: np.array of bools with shape (num_atoms,)
+        Boolean mask of backbone atoms that can form hydrogen bonds (N and O)
+    """
+    chains = [""] * num_atoms
+    resids = np.zeros(num_atoms, dtype=np.int64)
+    vdw_radii = np.full(num_atoms, np.nan)
+    backbone_mask = np.zeros(num_atoms, dtype=bool)
+    for index, atom_label in index_to_label.items():
+        chain, _, resid, name = atom_label.split(":")[0:4]
+        chains[index] = chain
+        resids[index] = int(resid)
+        vdw_radii[index] = ATOM_RADIUS.get(name[0], np.nan)
+        backbone_mask[index] = name in BACKBONE_HBOND_ATOMS
+
+    chain_codes = np.unique(chains, return_inverse=True)[1].astype(np.int64)
+    return chain_codes, resids, vdw_radii, backbone_mask
+
+
+def gen_interaction_topology(top, traj, index_to_label, solvent_resn, sele_id, ligands):
+    """
+    Evaluate all atom selections that only depend on the topology once, so that
+    workers can restrict themselves to per-frame geometry.
+
+    Parameters
+    ----------
+    top: MD Topology
+    traj: MD Trajectory
+    index_to_label: dict
+        Maps VMD atom index to label "chain:resname:resid:name:index"
+        {11205: "A:ASP:114:CA:11205, ...}
+    solvent_resn: string, default = TIP3
+        Denotes the resname of solvent in simulation
+    sele_id: string, default = None
+        Compute contacts on subset of atom selection based on VMD query
+    ligands: list of string
+        Resnames of ligand molecules
+
+    Returns
+    -------
+    interaction_topology: dict mapping string to np.array
+        num_atoms: number of atoms in the topology
+        bonds: (num_bonds, 2) indices of covalently bonded atoms
+        bonded_pair_keys: sorted `index1 * num_atoms + index2` keys of bonded atoms (index1 < index2)
+        anions: indices of ASP and GLU atoms that can form salt bridges
+        cations: indices of LYS, ARG and HIS atoms that can form salt bridges or pi-cation contacts
+        aromatic_triplets: (num_rings, 3) indices of three equidistant atoms on each aromatic ring
+        ring_cg_atoms: index of the CG atom that represents each aromatic ring in the output
+        heavy_protein_atoms: indices of protein heavy atoms considered for vdw contacts
+        hbond_atoms: indices of protein atoms that can act as donors or acceptors
+        ligand_hbond_atoms: dict mapping each ligand resname to indices of its donor and acceptor atoms
+        solvent_atoms: indices of solvent atoms
+        protein_atoms: indices of protein atoms inside `--sele`
+        ligand_atoms: dict mapping each ligand resname to indices of its atoms
+        hydrogen_mask: boolean mask of hydrogen atoms
+        donor_hydrogens: (num_hydrogen_bonds, 2) indices of heavy atoms and their bonded hydrogens
+        chain_codes: integer code of the chain of each atom
+        resids: resid of each atom
+        vdw_radii: van der Waals radius of each atom, NaN for elements without a radius
+        backbone_mask: boolean mask of backbone N and O atoms
+        solvent_mask: boolean mask of solvent atoms
+        sele_mask: boolean mask of atoms inside `--sele`
+        ligand_mask: boolean mask of ligand atoms
+    """
+    molid = load_traj(top, traj, 1, 2, 1)
+    num_atoms = molecule.numatoms(molid)
+
+    anion_list = get_anion_atoms(molid, 0, sele_id)
+    cation_list = get_cation_atoms(molid, 0, sele_id)
+    aromatic_triplets, ring_cg_atoms = gen_aromatic_triplets(molid, index_to_label, sele_id)
+
+    sele_mask = np.zeros(num_atoms, dtype=bool)
+    sele_mask[get_selection_indices(molid, restrict_to_sele("all", sele_id))] = True
+    solvent_atoms = get_selection_indices(molid, "resname %s" % solvent_resn)
+    solvent_mask = np.zeros(num_atoms, dtype=bool)
+    solvent_mask[solvent_atoms] = True
+    ligand_mask = np.zeros(num_atoms, dtype=bool)
+    if ligands:
+        ligand_mask[get_selection_indices(molid, "resname %s" % " ".join(ligands))] = True
+
+    bonds = get_bonds(molid)
+    hydrogen_mask = np.zeros(num_atoms, dtype=bool)
+    hydrogen_mask[get_selection_indices(molid, "hydrogen")] = True
+    chain_codes, resids, vdw_radii, backbone_mask = gen_atom_property_arrays(index_to_label, num_atoms)
+
+    interaction_topology = {
+        "num_atoms": num_atoms,
+        "bonds": bonds,
+        "bonded_pair_keys": np.unique(bonds[:, 0] * num_atoms + bonds[:, 1]),
+        "anions": np.array([get_atom_index(atom) for atom in anion_list], dtype=np.int64),
+        "cations": np.array([get_atom_index(atom) for atom in cation_list], dtype=np.int64),
+        "aromatic_triplets": aromatic_triplets,
+        "ring_cg_atoms": ring_cg_atoms,
+        "heavy_protein_atoms": get_selection_indices(molid, restrict_to_sele("noh and protein", sele_id)),
+        "hbond_atoms": get_selection_indices(molid, restrict_to_sele("protein and not lipid and not carbon and "
+                                                                     "not sulfur", sele_id)),
+        "ligand_hbond_atoms": {ligand: get_selection_indices(molid, "resname %s and not carbon and not sulfur and "
+                                                                    "not lipid" % ligand) for ligand in ligands},
+        "solvent_atoms": solvent_atoms,
+        "protein_atoms": get_selection_indices(molid, restrict_to_sele("protein", sele_id)),
+        "ligand_atoms": {ligand: get_selection_indices(molid, "resname %s" % ligand) for ligand in ligands},
+        "hydrogen_mask": hydrogen_mask,
+        "donor_hydrogens": gen_donor_hydrogens(bonds, hydrogen_mask),
+        "chain_codes": chain_codes,
+        "resids": resids,
+        "vdw_radii": vdw_radii,
+        "backbone_mask": backbone_mask,
+        "solvent_mask": solvent_mask,
+        "sele_mask": sele_mask,
+        "ligand_mask": ligand_mask
+    }
+
+    molecule.delete(molid)
+    return interaction_topology
+
+
+def index_selection_string(indices):
+    """
+    Compose a VMD selection query that matches exactly the atoms in `indices`
+    """
+    if len(indices) == 0:
+        return "none"
+    return "index " + " ".join(map(str, indices))
+
+
+def create_fragment_selections(traj_frag_molid, interaction_topology, itypes, solvent_resn, sele_id, ligands,
+                               neighbor_engine="vmd", hbond_engine="vmd", track_shells=False):
+    """
+    Create the Tcl atom selections used by `measure contacts` and `measure hbonds` once per
+    trajectory fragment. Itype modules only move them to the current frame with `$sel frame`.
+    Selections for `measure contacts` are named after their interaction topology group and
+    are only needed by the "vmd" neighbor engine. Selections for `measure hbonds` are only
+    needed by the "vmd" hbond engine, and not when solvation shells are tracked, as those
+    selections are then created from `gen_shell_selections` every frame.
+
+    Returns
+    -------
+    selection_ids: list of strings
+        Tcl variable names of the created selections
+    """
+    selections = {}
+    if "vdw" in itypes and neighbor_engine == "vmd":
+        selections["heavy_protein_atoms"] = index_selection_string(interaction_topology["heavy_protein_atoms"])
+    if "hb" in itypes and hbond_engine == "vmd" and not track_shells:
+        # Solvent shell depends on the frame, so this selection is updated before use
+        protein_sele = "protein" if sele_id is None else "(protein and (%s))" % sele_id
+        selections["hbond_atoms"] = "(resname %s and within %s of %s) or (%s)" % \
+                                    (solvent_resn, WATER_TO_PROTEIN_DIST, protein_sele,
+                                     index_selection_string(interaction_topology["hbond_atoms"]))
+    if "lhb" in itypes and hbond_engine == "vmd" and not track_shells:
+        for ligand_idx, ligand in enumerate(ligands):
+            selections["ligand_hbond_atoms_%d" % ligand_idx] = \
+                "(resname %s and within %s of resname %s) or " \
+                "((%s) and within %s of resname %s) or " \
+                "(%s)" % (solvent_resn, WATER_TO_LIGAND_DIST, ligand,
+                          index_selection_string(interaction_topology["hbond_atoms"]), WATER_TO_LIGAND_DIST, ligand,
+                          index_selection_string(interaction_topology["ligand_hbond_atoms"][ligand]))
+
+    for selection_id, selection in selections.items():
+        evaltcl("set %s [atomselect %s \" %s \" frame 0]" % (selection_id, traj_frag_molid, selection))
+
+    return list(selections.keys())
+
+
+def delete_fragment_selections(selection_ids):
+    """
+    Delete the Tcl atom selections created by `create_fragment_selections`
+    """
+    for selection_id in selection_ids:
+        evaltcl("$%s delete" % selection_id)
+
+
+def gen_frame_queries(itypes, ligands, neighbor_engine="vmd", hbond_engine="vmd", track_shells=False):
+    """
+    List the `measure` queries that are evaluated on the selections of `create_fragment_selections`
+    for every frame
+
+    Returns
+    -------
+    frame_queries: list of tuples
+        ("contacts", cutoff, selection_id) for `measure contacts` within a selection,
+        ("hbonds", selection_id) for `measure hbonds` and, when solvation shells are tracked,
+        ("shell_hbonds", selection_id, ligand) for `measure hbonds` on the atoms from
+        `gen_shell_selections`. Ligand is None for protein hydrogen bonds.
+    """
+    frame_queries = []
+    hbond_selections = []
+    if "vdw" in itypes and neighbor_engine == "vmd":
+        frame_queries.append(("contacts", SOFT_VDW_CUTOFF, "heavy_protein_atoms"))
+    if "hb" in itypes and hbond_engine == "vmd":
+        hbond_selections.append(("hbond_atoms", None))
+    if "lhb" in itypes and hbond_engine == "vmd":
+        hbond_selections += [("ligand_hbond_atoms_%d" % ligand_idx, ligand) for ligand_idx, ligand in enumerate(ligands)]
+    for selection_id, ligand in hbond_selections:
+        if track_shells:
+            frame_queries.append(("shell_hbonds", selection_id, ligand))
+        else:
+            frame_queries.append(("hbonds", selection_id))
+    return frame_queries
+
+
+def install_frame_proc(frame_queries):
+    """
+    Define the Tcl procedure FRAME_PROC, which moves the fragment selections to a frame, evaluates
+    all `frame_queries` there and joins their results with "|". A frame then takes a single round
+    trip between Python and Tcl. Selections are looked up as Tcl globals when the procedure runs, so
+    it only has to be installed once per worker. The atoms of "shell_hbonds" queries are passed as
+    trailing arguments, one selection string per query, and selected for the frame only.
+    """
+    body = ["set results {}"]
+    shell_idx = 0
+    for query in frame_queries:
+        if query[0] == "contacts":
+            _, cutoff, selection_id = query
+            body += ["$::%s frame $frame" % selection_id,
+                     "lappend results [measure contacts %s $::%s]" % (cutoff, selection_id)]
+        elif query[0] == "shell_hbonds":
+            body += ["set sel [atomselect $molid [lindex $args %d] frame $frame]" % shell_idx,
+                     "lappend results [measure hbonds $hbond_distance $hbond_angle $sel]",
+                     "$sel delete"]
+            shell_idx += 1
+        else:
+            selection_id = query[1]
+            body += ["$::%s frame $frame" % selection_id,
+                     "$::%s update" % selection_id,
+                     "lappend results [measure hbonds $hbond_distance $hbond_angle $::%s]" % selection_id]
+    body.append('return [join $results "|"]')
+    evaltcl("proc %s {frame hbond_distance hbond_angle molid args} {\n    %s\n}" % (FRAME_PROC, "\n    ".join(body)))
+
+
+def gen_shell_selections(frame_queries, coords, interaction_topology, neighbor_engine, solvation_shells):
+    """
+    Selection strings of the atoms considered for hydrogen bonds in a frame, one for each
+    "shell_hbonds" query in `frame_queries`. Solvent shells come from the tracked `solvation_shells`
+    instead of a `within` query in VMD.
+
+    Returns
+    -------
+    shell_selections: list of strings
+    """
+    if neighbor_engine not in ("cell", "kdtree"):
+        neighbor_engine = "cell"
+    shell_selections = []
+    for query in frame_queries:
+        if query[0] != "shell_hbonds":
+            continue
+        ligand = None if query[2] is None else [query[2]]
+        candidate_atoms = calc_hbond_candidates(coords, interaction_topology, ligand, neighbor_engine,
+                                                solvation_shells)[0]
+        shell_selections.append(index_selection_string(candidate_atoms))
+    return shell_selections
+
+
+def prefetch_frame_queries(traj_frag_molid, frame_idx, frame_queries, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE,
+                           neighbor_cache, shell_selections=()):
+    """
+    Evaluate `frame_queries` for a frame with one call of the procedure installed by
+    `install_frame_proc`, and store the parsed results in the per-frame `neighbor_cache`. There
+    `find_contact_pairs` and `compute_hydrogen_bonds` pick them up instead of querying VMD.
+    `shell_selections` from `gen_shell_selections` hold the atoms of the "shell_hbonds" queries.
+    """
+    if not frame_queries:
+        return
+    results = evaltcl("%s %s %s %s %s %s" % (FRAME_PROC, frame_idx, HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE,
+                                             traj_frag_molid, " ".join("{%s}" % sele for sele in shell_selections)))
+    for query, result in zip(frame_queries, results.split("|")):
+        if query[0] == "contacts":
+            _, cutoff, selection_id = query
+            atom1_indices, atom2_indices = parse_contact_pairs(result)
+            neighbor_cache[(selection_id, None)] = (cutoff, atom1_indices, atom2_indices)
+        else:
+            neighbor_cache[("hbonds", query[1])] = parse_donor_acceptor_indices(result)
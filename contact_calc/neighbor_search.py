@@ -0,0 +1,299 @@
+############################################################################
+# Copyright 2018 Anthony Ma & Stanford University                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+##############################################################################
+# Imports
+##############################################################################
+
+import itertools
+from .contact_utils import *
+
+__all__ = ['NEIGHBOR_ENGINES', 'calc_neighbor_pairs', 'calc_max_displacement', 'find_contact_pairs',
+           'parse_contact_pairs', 'init_verlet_lists']
+
+##############################################################################
+# Globals
+##############################################################################
+
+# vmd: `measure contacts` on Tcl selections
+# cell: cell list implemented in NumPy
+# kdtree: scipy.spatial.cKDTree (requires scipy)
+NEIGHBOR_ENGINES = ["vmd", "cell", "kdtree"]
+CELL_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=np.int64)
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def cell_list_pairs(coords1, coords2, cutoff):
+    """
+    Find all pairs of points from two sets within cutoff of each other by
+    binning coords2 into cubic cells of side length cutoff and only comparing
+    each point in coords1 with points in the 27 surrounding cells.
+
+    Returns
+    -------
+    positions1, positions2: np.array of ints
+        Positions into coords1 and coords2 of each pair
+    """
+    origin = np.minimum(coords1.min(axis=0), coords2.min(axis=0))
+    cells1 = np.floor((coords1 - origin) / cutoff).astype(np.int64)
+    cells2 = np.floor((coords2 - origin) / cutoff).astype(np.int64)
+    dims = np.maximum(cells1.max(axis=0), cells2.max(axis=0)) + 1
+
+    def cell_keys(cells):
+        return (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+    # Sort coords2 by cell so each cell is a contiguous run
+    order2 = np.argsort(cell_keys(cells2), kind="stable")
+    sorted_keys2 = cell_keys(cells2)[order2]
+
+    cutoff2 = cutoff * cutoff
+    positions1, positions2 = [], []
+    for offset in CELL_OFFSETS:
+        neighbor_cells = cells1 + offset
+        valid = np.all((neighbor_cells >= 0) & (neighbor_cells < dims), axis=1)
+        neighbor_keys = cell_keys(neighbor_cells)
+        run_begs = np.searchsorted(sorted_keys2, neighbor_keys, side="left")
+        run_ends = np.searchsorted(sorted_keys2, neighbor_keys, side="right")
+        counts = np.where(valid, run_ends - run_begs, 0)
+        total = counts.sum()
+        if total == 0:
+            continue
+
+        # Expand each run into explicit candidate pairs
+        candidates1 = np.repeat(np.arange(len(coords1)), counts)
+        candidates2 = order2[calc_run_positions(run_begs, counts)]
+
+        diff = coords1[candidates1] - coords2[candidates2]
+        within = np.einsum('ij,ij->i', diff, diff) <= cutoff2
+        positions1.append(candidates1[within])
+        positions2.append(candidates2[within])
+
+    if not positions1:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(positions1), np.concatenate(positions2)
+
+
+def kdtree_pairs(coords1, coords2, cutoff):
+    """
+    Find all pairs of points from two sets within cutoff of each other using scipy's cKDTree
+
+    Returns
+    -------
+    positions1, positions2: np.array of ints
+        Positions into coords1 and coords2 of each pair
+    """
+    from scipy.spatial import cKDTree
+    pairs = cKDTree(coords1).sparse_distance_matrix(cKDTree(coords2), cutoff, output_type="ndarray")
+    return pairs["i"].astype(np.int64), pairs["j"].astype(np.int64)
+
+
+def calc_neighbor_pairs(coords1, coords2, cutoff, neighbor_engine="cell"):
+    """
+    Find all pairs of points within cutoff of each other
+
+    Parameters
+    ----------
+    coords1: np.array of shape (n1, 3)
+    coords2: np.array of shape (n2, 3) or None
+        If None, pairs are formed within coords1 and each pair is only reported once
+    cutoff: float
+    neighbor_engine: string, "cell" or "kdtree"
+
+    Returns
+    -------
+    positions1, positions2: np.array of ints
+        Positions into coords1 and coords2 (or coords1 twice) of each pair
+    """
+    self_pairs = coords2 is None
+    if self_pairs:
+        coords2 = coords1
+    if len(coords1) == 0 or len(coords2) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    if neighbor_engine == "kdtree":
+        positions1, positions2 = kdtree_pairs(coords1, coords2, cutoff)
+    elif neighbor_engine == "cell":
+        positions1, positions2 = cell_list_pairs(coords1, coords2, cutoff)
+    else:
+        raise ValueError("Unknown neighbor engine: %s" % neighbor_engine)
+
+    if self_pairs:
+        upper = positions1 < positions2
+        positions1, positions2 = positions1[upper], positions2[upper]
+    return positions1, positions2
+
+
+def remove_bonded_pairs(atom1_indices, atom2_indices, interaction_topology):
+    """
+    Remove pairs of atoms that are covalently bonded, as `measure contacts` does
+    """
+    num_atoms = interaction_topology["num_atoms"]
+    pair_keys = np.minimum(atom1_indices, atom2_indices) * num_atoms + np.maximum(atom1_indices, atom2_indices)
+    unbonded = ~np.isin(pair_keys, interaction_topology["bonded_pair_keys"]) & (atom1_indices != atom2_indices)
+    return atom1_indices[unbonded], atom2_indices[unbonded]
+
+
+def calc_max_displacement(old_coords, new_coords):
+    """
+    Largest distance moved by any of the points
+    """
+    if len(old_coords) == 0:
+        return 0.0
+    diff = new_coords - old_coords
+    return float(np.sqrt(np.einsum('ij,ij->i', diff, diff).max()))
+
+
+def parse_contact_pairs(contact_string):
+    """
+    Parse output of `measure contacts` into arrays of VMD indices
+
+    Returns
+    -------
+    atom1_indices, atom2_indices: np.array of ints
+    """
+    contact_index_pairs = np.array(parse_contacts(contact_string), dtype=np.int64).reshape(-1, 2)
+    return contact_index_pairs[:, 0], contact_index_pairs[:, 1]
+
+
+def search_contact_pairs(coords, interaction_topology, group1, group2, cutoff, neighbor_engine):
+    """
+    Search the pairs of `find_contact_pairs` with the "cell" or "kdtree" engine. Pairs are
+    ordered by atom indices, so the order doesn't depend on the engine or the cutoff.
+    """
+    indices1 = interaction_topology[group1]
+    indices2 = None if group2 is None else interaction_topology[group2]
+    positions1, positions2 = calc_neighbor_pairs(coords[indices1], None if indices2 is None else coords[indices2],
+                                                 cutoff, neighbor_engine)
+    atom1_indices = indices1[positions1]
+    atom2_indices = (indices1 if indices2 is None else indices2)[positions2]
+    atom1_indices, atom2_indices = remove_bonded_pairs(atom1_indices, atom2_indices, interaction_topology)
+    order = np.lexsort((atom2_indices, atom1_indices))
+    return atom1_indices[order], atom2_indices[order]
+
+
+def init_verlet_lists(skin):
+    """
+    Create the state of the Verlet lists of a process
+
+    Parameters
+    ----------
+    skin: float
+        Margin in angstroms added to the cutoff of each list
+
+    Returns
+    -------
+    verlet_lists: dict
+        "skin" and "lists" mapping a pair of groups to the list built at its last rebuild
+    """
+    return {"skin": skin, "lists": {}}
+
+
+def find_verlet_pairs(verlet_lists, coords, interaction_topology, group1, group2, cutoff, neighbor_engine):
+    """
+    Search the pairs of `find_contact_pairs` through a Verlet list of the pairs within cutoff + skin.
+    The list holds every pair that is within cutoff as long as no atom of the groups moved more than
+    half the skin since it was built, and is rebuilt otherwise.
+    """
+    skin = verlet_lists["skin"]
+    list_key = (group1, group2)
+    verlet_list = verlet_lists["lists"].get(list_key)
+    if verlet_list is None or verlet_list["cutoff"] != cutoff or \
+            calc_max_displacement(verlet_list["coords"], coords[verlet_list["atoms"]]) > skin / 2:
+        group_atoms = interaction_topology[group1]
+        if group2 is not None:
+            group_atoms = np.union1d(group_atoms, interaction_topology[group2])
+        atom1_indices, atom2_indices = search_contact_pairs(coords, interaction_topology, group1, group2,
+                                                            cutoff + skin, neighbor_engine)
+        verlet_list = {"cutoff": cutoff,
+                       "atoms": group_atoms,
+                       "coords": np.array(coords[group_atoms], copy=True),
+                       "atom1_indices": atom1_indices,
+                       "atom2_indices": atom2_indices}
+        verlet_lists["lists"][list_key] = verlet_list
+        count_profile("verlet_rebuilds")
+
+    atom1_indices, atom2_indices = verlet_list["atom1_indices"], verlet_list["atom2_indices"]
+    diff = coords[atom1_indices] - coords[atom2_indices]
+    within = np.einsum('ij,ij->i', diff, diff) <= cutoff * cutoff
+    return atom1_indices[within], atom2_indices[within]
+
+
+def find_contact_pairs(traj_frag_molid, frame_idx, coords, interaction_topology, group1, group2, cutoff,
+                       neighbor_engine, neighbor_cache=None, verlet_lists=None):
+    """
+    Find candidate atom pairs between two groups of the interaction topology that are
+    within cutoff of each other and not covalently bonded.
+
+    Parameters
+    ----------
+    traj_frag_molid: int
+        Identifier to simulation fragment in VMD
+    frame_idx: int
+        Frame number to query
+    coords: np.array of shape (num_atoms, 3)
+        Coordinates of all atoms in the frame, indexed by VMD atom index
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
+    group1: string
+        Key of interaction_topology holding the first atom group (ie "heavy_protein_atoms")
+    group2: string or None
+        Key of the second atom group. If None pairs are formed within group1
+    cutoff: float
+        Soft distance cutoff in angstroms
+    neighbor_engine: string
+        One of NEIGHBOR_ENGINES. The "vmd" engine relies on the Tcl selections with
+        the same names as group1 and group2 created by `create_fragment_selections`
+    neighbor_cache: dict, default = None
+        Per-frame cache of earlier searches, including those prefetched by `prefetch_frame_queries`.
+        A search over the same groups with a larger cutoff is reused by filtering its pairs on distance.
+    verlet_lists: dict, default = None
+        Verlet lists from `init_verlet_lists` that are reused across frames by the "cell" and
+        "kdtree" engines. Pairs are searched from scratch every frame if None.
+
+    Returns
+    -------
+    atom1_indices, atom2_indices: np.array of ints
+        VMD indices of each candidate pair
+    """
+    cache_key = (group1, group2)
+    if neighbor_cache is not None and cache_key in neighbor_cache:
+        cached_cutoff, atom1_indices, atom2_indices = neighbor_cache[cache_key]
+        if cached_cutoff >= cutoff:
+            diff = coords[atom1_indices] - coords[atom2_indices]
+            within = np.einsum('ij,ij->i', diff, diff) <= cutoff * cutoff
+            count_profile("candidate_pairs", within.sum(), per_stage=True)
+            return atom1_indices[within], atom2_indices[within]
+
+    if neighbor_engine == "vmd":
+        selections = "$%s" % group1 if group2 is None else "$%s $%s" % (group1, group2)
+        for group in (group1, group2):
+            if group is not None:
+                evaltcl("$%s frame %s" % (group, frame_idx))
+        atom1_indices, atom2_indices = parse_contact_pairs(evaltcl("measure contacts %s %s" % (cutoff, selections)))
+    elif verlet_lists is not None:
+        atom1_indices, atom2_indices = find_verlet_pairs(verlet_lists, coords, interaction_topology, group1, group2,
+                                                         cutoff, neighbor_engine)
+    else:
+        atom1_indices, atom2_indices = search_contact_pairs(coords, interaction_topology, group1, group2, cutoff,
+                                                            neighbor_engine)
+
+    if neighbor_cache is not None:
+        neighbor_cache[cache_key] = (cutoff, atom1_indices, atom2_indices)
+    count_profile("candidate_pairs", len(atom1_indices), per_stage=True)
+    return atom1_indices, atom2_indices
@@ -32,22 +32,21 @@ SOFT_DISTANCE_CUTOFF = 10.0  # Angstroms
 ##############################################################################
 
 
-def compute_pi_cation(traj_frag_molid, frame_idx, index_to_label, sele_id,
+def compute_pi_cation(frame_idx, coords, ring_geometry, interaction_topology,
                       PI_CATION_CUTOFF_DISTANCE=6.0, PI_CATION_CUTOFF_ANGLE=60):
     """
     Compute pi-cation interactions in a frame of simulation
 
     Parameters
     ----------
-    traj_frag_molid: int
-        Identifier to simulation fragment in VMD
     frame_idx: int
         Frame number to query
-    index_to_label: dict
-        Maps VMD atom index to label "chain:resname:resid:name:index"
-        {11205: "A:ASP:114:CA:11205, ...}
-    sele_id: string, default = None
-        Compute contacts on subset of atom selection based on VMD query
+    coords: np.array of shape (num_atoms, 3)
+        Coordinates of all atoms in the frame, indexed by VMD atom index
+    ring_geometry: dict
+        Ring coordinates, centroids and normal vectors of the fragment from `calc_fragment_ring_geometry`
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
     PI_CATION_CUTOFF_DISTANCE: float, default = 6.0 angstroms
         cutoff for distance between cation and centroid of aromatic ring
     PI_CATION_CUTOFF_ANGLE: float, default = 60 degrees
@@ -55,91 +54,48 @@ def compute_pi_cation(traj_frag_molid, frame_idx, index_to_label, sele_id,
         from aromatic plane and vector from aromatic center
         to cation atom
 
-
     Returns
     -------
-    pi_cations = list of tuples, [(frame_index, itype, atom1_label, atom2_label), ...]
+    pi_cations = list of lists, [[frame_index, itype_code, cation_index, ring_cg_index], ...]
         itype = "pc"
     """
     pi_cations = []
+    cation_indices = interaction_topology["cations"]
+    aromatic_triplets = interaction_topology["aromatic_triplets"]
+    if len(cation_indices) == 0 or len(aromatic_triplets) == 0:
+        return pi_cations
 
-    if sele_id is None:
-        cation_atom_sel = "set cation_atoms [atomselect %s \" " \
-                          "((resname LYS) and (name NZ)) or " \
-                          "((resname ARG) and (name NH1 NH2)) or " \
-                          "((resname HIS HSD HSE HSP HIE HIP HID) and (name ND1 NE2)) \" frame %s]" % \
-                          (traj_frag_molid, frame_idx)
-        aromatic_atom_sel = "set aromatic_atoms [atomselect %s \" " \
-                            "((resname PHE) and (name CG CE1 CE2)) or " \
-                            "((resname TRP) and (name CD2 CZ2 CZ3)) or " \
-                            "((resname TYR) and (name CG CE1 CE2)) \" frame %s]" % (traj_frag_molid, frame_idx)
-    else:
-        cation_atom_sel = "set cation_atoms [atomselect %s \" " \
-                          "((resname LYS) and (name NZ) and (%s)) or " \
-                          "((resname ARG) and (name NH1 NH2) and (%s)) or " \
-                          "((resname HIS HSD HSE HSP HIE HIP HID) and (name ND1 NE2) and (%s))\" frame %s]" % \
-                          (traj_frag_molid, sele_id, sele_id, sele_id, frame_idx)
-        aromatic_atom_sel = "set aromatic_atoms [atomselect %s \" " \
-                            "((resname PHE) and (name CG CE1 CE2) and (%s)) or " \
-                            "((resname TRP) and (name CD2 CZ2 CZ3) and (%s)) or " \
-                            "((resname TYR) and (name CG CE1 CE2) and (%s))\" frame %s]" % \
-                            (traj_frag_molid, sele_id, sele_id, sele_id, frame_idx)
-
-    evaltcl(cation_atom_sel)
-    evaltcl(aromatic_atom_sel)
-    contacts = evaltcl("measure contacts %s $cation_atoms $aromatic_atoms" % SOFT_DISTANCE_CUTOFF)
-    evaltcl("$cation_atoms delete")
-    evaltcl("$aromatic_atoms delete")
+    cation_coords = coords[cation_indices].astype(np.float64)
+    ring_atom_coords = ring_geometry["ring_atom_coords"][frame_idx]
+    centroids = ring_geometry["centroids"][frame_idx]
+    normal_vectors = ring_geometry["normal_vectors"][frame_idx]
 
     # Evaluate geometric criterion if all three points of an aromatic
-    # residue are sufficiently close to a cation atom
-    contact_index_pairs = parse_contacts(contacts)
-    pi_cation_aromatic_grouping = {}
-    for cation_index, aromatic_index in contact_index_pairs:
-        cation_label = index_to_label[cation_index]
-        aromatic_label = index_to_label[aromatic_index]
-        pi_cation_aromatic_res_key = cation_label + ":" + ":".join(aromatic_label.split(":")[2])
-        if pi_cation_aromatic_res_key not in pi_cation_aromatic_grouping:
-            pi_cation_aromatic_grouping[pi_cation_aromatic_res_key] = set()
-        pi_cation_aromatic_grouping[pi_cation_aromatic_res_key].add(aromatic_label)
-
-    # Apply strict geometric criterion
-    for pi_cation_aromatic_res_key in pi_cation_aromatic_grouping:
-        cation_atom_label = ":".join(pi_cation_aromatic_res_key.split(":")[0:5])
-        aromatic_atom_labels = pi_cation_aromatic_grouping[pi_cation_aromatic_res_key]
-        if len(aromatic_atom_labels) != 3:
-            continue
-        aromatic_atom_labels = sorted(list(aromatic_atom_labels))
-        arom_atom1_label, arom_atom2_label, arom_atom3_label = aromatic_atom_labels
-
-        # Compute coordinates of cation and aromatic atoms
-        cation_coord = get_coord(traj_frag_molid, frame_idx, cation_atom_label)
-        arom_atom1_coord = get_coord(traj_frag_molid, frame_idx, arom_atom1_label)
-        arom_atom2_coord = get_coord(traj_frag_molid, frame_idx, arom_atom2_label)
-        arom_atom3_coord = get_coord(traj_frag_molid, frame_idx, arom_atom3_label)
-
-        # Perform distance criterion
-        aromatic_centroid = calc_geom_centroid(arom_atom1_coord, arom_atom2_coord, arom_atom3_coord)
-        cation_to_centroid_distance = calc_geom_distance(cation_coord, aromatic_centroid)
-        if cation_to_centroid_distance > PI_CATION_CUTOFF_DISTANCE:
-            continue
-
-        # Perform angle criterion
-        aromatic_plane_norm_vec = calc_geom_normal_vector(arom_atom1_coord, arom_atom2_coord, arom_atom3_coord)
-        aromatic_center_to_cation_vec = points_to_vector(aromatic_centroid, cation_coord)
-        cation_norm_offset_angle = calc_angle_between_vectors(aromatic_plane_norm_vec, aromatic_center_to_cation_vec)
-        cation_norm_offset_angle = min(math.fabs(cation_norm_offset_angle - 0), math.fabs(cation_norm_offset_angle - 180))
-        if cation_norm_offset_angle > PI_CATION_CUTOFF_ANGLE:
-            continue
-
-        
-        # Append just the CG atom of the aromatic ring 
-        single_arom_atom_label = convert_to_single_atom_aromatic_string(arom_atom1_label)
-        pi_cations.append([frame_idx, "pc", cation_atom_label, single_arom_atom_label])
-
-        # Append three of the aromatic atoms
-        # pi_cations.append([frame_idx, "pc", cation_atom_label, arom_atom1_label])
-        # pi_cations.append([frame_idx, "pc", cation_atom_label, arom_atom2_label])
-        # pi_cations.append([frame_idx, "pc", cation_atom_label, arom_atom3_label])
+    # residue are inside `--sele` and sufficiently close to a cation atom
+    ring_atom_in_sele = interaction_topology["sele_mask"][aromatic_triplets]
+    cation_to_ring_atom_distances = calc_distance_matrix(cation_coords[:, np.newaxis, np.newaxis],
+                                                         ring_atom_coords[np.newaxis, :])
+    candidate_pairs = np.all((cation_to_ring_atom_distances[:, :, 0, :] <= SOFT_DISTANCE_CUTOFF) &
+                             ring_atom_in_sele[np.newaxis, :, :], axis=2)
+    count_profile("candidate_pairs", candidate_pairs.sum(), per_stage=True)
+
+    # Perform distance criterion, shape (num_cations, num_rings)
+    cation_to_centroid_distances = calc_distance_matrix(cation_coords, centroids)
+
+    # Perform angle criterion
+    center_to_cation_vectors = cation_coords[:, np.newaxis] - centroids[np.newaxis, :]
+    cation_norm_offset_angles = calc_angles_between_vectors(normal_vectors[np.newaxis, :], center_to_cation_vectors)
+    cation_norm_offset_angles = np.minimum(np.fabs(cation_norm_offset_angles - 0),
+                                           np.fabs(cation_norm_offset_angles - 180))
+
+    pi_cation_pairs = candidate_pairs & (cation_to_centroid_distances <= PI_CATION_CUTOFF_DISTANCE) & \
+                      (cation_norm_offset_angles <= PI_CATION_CUTOFF_ANGLE)
+
+    # Append just the CG atom of the aromatic ring, ordered by cation index and ring
+    cation_rows, ring_idxs = np.nonzero(pi_cation_pairs)
+    order = np.lexsort((ring_idxs, cation_indices[cation_rows]))
+    ring_cg_atoms = interaction_topology["ring_cg_atoms"]
+    for cation_row, ring_idx in zip(cation_rows[order], ring_idxs[order]):
+        pi_cations.append([frame_idx, ITYPE_CODES["pc"], int(cation_indices[cation_row]), int(ring_cg_atoms[ring_idx])])
 
     return pi_cations
@@ -0,0 +1,160 @@
+############################################################################
+# Copyright 2018 Anthony Ma & Stanford University                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+"""
+Lightweight profiling of the contact engine. Each process keeps its own stage timings and
+counters in `profile_state`. Workers collect them per fragment with `collect_profile` and
+the main process merges them into a report.
+
+Stages:
+    topology     label table and interaction topology (main process)
+    load         reading a trajectory fragment into VMD
+    selections   creating and deleting the Tcl selections of a fragment
+    rings        aromatic ring geometry of a fragment
+    coords       copying the coordinates of a frame
+    shells       updating tracked solvation shells for the vmd hbond engine
+    tcl          evaluating the VMD queries of a frame in one Tcl call
+    sb ... lhb   computing an interaction type, see ITYPE_NAMES
+    stratify     stratifying hydrogen bonds into subtypes, part of hb and lhb
+    write        writing the contacts of a fragment to its spill file
+    stitch       appending finished fragments to the output (main process)
+"""
+
+##############################################################################
+# Imports
+##############################################################################
+
+import json
+import time
+from contextlib import contextmanager
+
+__all__ = ['profile_state', 'enable_profiling', 'profile_stage', 'count_profile', 'collect_profile',
+           'merge_profile', 'write_profile_report']
+
+##############################################################################
+# Globals
+##############################################################################
+
+# Timings and counters of the current process. `stage` is the innermost running stage,
+# which `count_profile` can attribute counts to.
+profile_state = {"enabled": False, "stage": None, "stages": {}, "counts": {}}
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def enable_profiling(enabled=True):
+    """
+    Turn profiling of the current process on or off and discard earlier measurements
+    """
+    profile_state["enabled"] = enabled
+    profile_state["stage"] = None
+    profile_state["stages"] = {}
+    profile_state["counts"] = {}
+
+
+@contextmanager
+def profile_stage(stage):
+    """
+    Add the time spent in the body of the with statement to `stage`. Does nothing unless
+    profiling is enabled.
+    """
+    if not profile_state["enabled"]:
+        yield
+        return
+
+    outer_stage = profile_state["stage"]
+    profile_state["stage"] = stage
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = profile_state["stages"]
+        stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - tic
+        profile_state["stage"] = outer_stage
+
+
+def count_profile(counter, amount=1, per_stage=False):
+    """
+    Add `amount` to `counter` if profiling is enabled. With `per_stage` the count is kept
+    separately for the running stage, ie "evaltcl_calls.hb".
+    """
+    if not profile_state["enabled"]:
+        return
+    if per_stage:
+        counter = "%s.%s" % (counter, profile_state["stage"] or "other")
+    counts = profile_state["counts"]
+    counts[counter] = counts.get(counter, 0) + int(amount)
+
+
+def collect_profile():
+    """
+    Return the timings and counters of the current process and reset them, or None if
+    profiling is not enabled
+
+    Returns
+    -------
+    profile: dict
+        "stages" maps stage to seconds and "counts" maps counter to count
+    """
+    if not profile_state["enabled"]:
+        return None
+    profile = {"stages": profile_state["stages"], "counts": profile_state["counts"]}
+    profile_state["stages"] = {}
+    profile_state["counts"] = {}
+    return profile
+
+
+def merge_profile(total_profile, profile):
+    """
+    Add the timings and counters of `profile` to `total_profile` in place
+    """
+    for key in ("stages", "counts"):
+        totals = total_profile.setdefault(key, {})
+        for name, value in profile[key].items():
+            totals[name] = totals.get(name, 0) + value
+
+
+def write_profile_report(report, report_path):
+    """
+    Write a profiling report as JSON if `report_path` ends with .json and as tab separated
+    lines otherwise.
+
+    Parameters
+    ----------
+    report: dict
+        Holds "wall_time", "num_fragments", the merged "stages" and "counts" of all
+        processes, and "workers" mapping each worker to its own merged profile
+    report_path: str
+    """
+    if report_path.endswith(".json"):
+        with open(report_path, "w") as report_fd:
+            json.dump(report, report_fd, indent=2, sort_keys=True)
+        return
+
+    with open(report_path, "w") as report_fd:
+        report_fd.write("# wall_time:%.3f num_fragments:%d\n" % (report["wall_time"], report["num_fragments"]))
+        report_fd.write("# Columns: scope, kind, name, value\n")
+        scopes = [("total", report)] + [("worker_%s" % worker, report["workers"][worker])
+                                        for worker in sorted(report["workers"])]
+        for scope, profile in scopes:
+            stages = profile.get("stages", {})
+            for stage in sorted(stages, key=stages.get, reverse=True):
+                report_fd.write("%s\tseconds\t%s\t%.6f\n" % (scope, stage, stages[stage]))
+            counts = profile.get("counts", {})
+            for counter in sorted(counts):
+                report_fd.write("%s\tcount\t%s\t%d\n" % (scope, counter, counts[counter]))
@@ -20,32 +20,35 @@
 
 from .contact_utils import *
 
-__all__ = ['prep_salt_bridge_computation', 'compute_salt_bridges']
+__all__ = ['calc_salt_bridge_mask', 'compute_salt_bridges']
 
 ##############################################################################
 # Functions
 ##############################################################################
 
 
-def prep_salt_bridge_computation(traj_frag_molid, frame_idx, sele_id):
+def calc_salt_bridge_mask(anion_coords, cation_coords, SALT_BRIDGE_CUTOFF_DISTANCE=4.0):
     """
-    Compute all possible anion and cation atoms from first frame of simulation
+    Evaluate the salt bridge distance criterion for every anion and cation pair at once
+
+    Parameters
+    ----------
+    anion_coords: np.array of shape (..., num_anions, 3)
+        Coordinates of anion atoms, optionally for a block of frames
+    cation_coords: np.array of shape (..., num_cations, 3)
+        Coordinates of cation atoms, optionally for a block of frames
+    SALT_BRIDGE_CUTOFF_DISTANCE: float, default = 4.0 angstroms
+        cutoff for distance between anion and cation atoms
 
     Returns
     -------
-    anion_list: list of strings
-        List of atom labels for atoms in ASP or GLU that
-        can form salt bridges
-    cation_list: list of strings
-        List of atom labels for atoms in LYS, ARG, HIS that
-        can form salt bridges
+    salt_bridge_mask: np.array of bools with shape (..., num_anions, num_cations)
+        True where the anion and cation atom form a salt bridge
     """
-    anion_list = get_anion_atoms(traj_frag_molid, frame_idx, sele_id)
-    cation_list = get_cation_atoms(traj_frag_molid, frame_idx, sele_id)
-    return anion_list, cation_list
+    return calc_distance_matrix(anion_coords, cation_coords) < SALT_BRIDGE_CUTOFF_DISTANCE
 
 
-def compute_salt_bridges(traj_frag_molid, frame_idx, sele_id, SALT_BRIDGE_CUTOFF_DISTANCE=4.0):
+def compute_salt_bridges(traj_frag_molid, frame_idx, coords, interaction_topology, SALT_BRIDGE_CUTOFF_DISTANCE=4.0):
     """
     Compute salt bridges in a frame of simulation
 
@@ -55,22 +58,28 @@ def compute_salt_bridges(traj_frag_molid, frame_idx, sele_id, SALT_BRIDGE_CUTOFF
         Identifier to simulation fragment in VMD
     frame_idx: int
         Frame number to query
-    sele_id: string, default = None
-        Compute contacts on subset of atom selection based on VMD query
+    coords: np.array of shape (num_atoms, 3)
+        Coordinates of all atoms in the frame, indexed by VMD atom index
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
     SALT_BRIDGE_CUTOFF_DISTANCE: float, default = 4.0 angstroms
         cutoff for distance between anion and cation atoms
 
     Returns
     -------
-    salt_bridges: list of tuples, [(frame_index, itype, atom1_label, atom2_label), ...]
+    salt_bridges: list of lists, [[frame_index, itype_code, anion_index, cation_index], ...]
         itype = "sb"
     """
-    anion_list, cation_list = prep_salt_bridge_computation(traj_frag_molid, frame_idx, sele_id)
+    anion_indices = interaction_topology["anions"]
+    cation_indices = interaction_topology["cations"]
+    count_profile("candidate_pairs", len(anion_indices) * len(cation_indices), per_stage=True)
+    salt_bridge_mask = calc_salt_bridge_mask(coords[anion_indices], coords[cation_indices],
+                                             SALT_BRIDGE_CUTOFF_DISTANCE)
+
+    # np.nonzero walks the mask in row-major order, same as looping over anions then cations
     salt_bridges = []
-    for anion_atom in anion_list:
-        for cation_atom in cation_list:
-            dist = compute_distance(traj_frag_molid, frame_idx, anion_atom, cation_atom)
-            if dist < SALT_BRIDGE_CUTOFF_DISTANCE:
-                salt_bridges.append([frame_idx, "sb", anion_atom, cation_atom])
+    for anion_idx, cation_idx in zip(*np.nonzero(salt_bridge_mask)):
+        salt_bridges.append([frame_idx, ITYPE_CODES["sb"], int(anion_indices[anion_idx]),
+                             int(cation_indices[cation_idx])])
 
     return salt_bridges
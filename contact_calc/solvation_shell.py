@@ -0,0 +1,120 @@
+############################################################################
+# Copyright 2018 Anthony Ma & Stanford University                          #
+#                                                                          #
+# Licensed under the Apache License, Version 2.0 (the "License");          #
+# you may not use this file except in compliance with the License.         #
+# You may obtain a copy of the License at                                  #
+#                                                                          #
+#     http://www.apache.org/licenses/LICENSE-2.0                           #
+#                                                                          #
+# Unless required by applicable law or agreed to in writing, software      #
+# distributed under the License is distributed on an "AS IS" BASIS,        #
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. #
+# See the License for the specific language governing permissions and      #
+# limitations under the License.                                           #
+############################################################################
+
+##############################################################################
+# Imports
+##############################################################################
+
+from .contact_utils import *
+from .neighbor_search import *
+
+__all__ = ['DEFAULT_SHELL_SKIN', 'init_solvation_shells', 'track_atoms_within']
+
+##############################################################################
+# Globals
+##############################################################################
+
+DEFAULT_SHELL_SKIN = 2.0
+
+##############################################################################
+# Functions
+##############################################################################
+
+
+def init_solvation_shells(skin=DEFAULT_SHELL_SKIN):
+    """
+    Create the state of the tracked shells of a process
+
+    Parameters
+    ----------
+    skin: float, default = DEFAULT_SHELL_SKIN
+        Margin in angstroms around the cutoff of each shell
+
+    Returns
+    -------
+    solvation_shells: dict
+        "skin" and "shells" mapping a shell key to the state of the shell at its last rebuild
+    """
+    return {"skin": skin, "shells": {}}
+
+
+def rebuild_shell(coords, atoms, reference_atoms, cutoff, skin, neighbor_engine):
+    """
+    Split `atoms` by their distance to the closest of `reference_atoms` into core atoms
+    (at most cutoff - skin) and boundary atoms (up to cutoff + skin). Until the largest
+    displacement of the atoms plus that of the reference atoms exceeds the skin, core atoms
+    stay within cutoff and atoms beyond the boundary stay outside it, so only boundary atoms
+    have to be measured again.
+    """
+    atom_coords, reference_coords = coords[atoms], coords[reference_atoms]
+    positions, reference_positions = calc_neighbor_pairs(atom_coords, reference_coords, cutoff + skin,
+                                                         neighbor_engine)
+    diff = atom_coords[positions] - reference_coords[reference_positions]
+    min_distances = np.full(len(atoms), np.inf)
+    np.minimum.at(min_distances, positions, np.sqrt(np.einsum('ij,ij->i', diff, diff)))
+
+    core = min_distances <= cutoff - skin
+    boundary = np.isfinite(min_distances) & ~core
+    count_profile("shell_rebuilds")
+    return {"cutoff": cutoff,
+            "atoms": atoms,
+            "reference_atoms": reference_atoms,
+            "atom_coords": np.array(atom_coords, copy=True),
+            "reference_coords": np.array(reference_coords, copy=True),
+            "core": atoms[core],
+            "boundary": atoms[boundary]}
+
+
+def track_atoms_within(solvation_shells, shell_key, coords, atoms, reference_atoms, cutoff, neighbor_engine="cell"):
+    """
+    Equivalent of the VMD selection `atoms and within cutoff of reference_atoms`, computed from the
+    shell tracked under `shell_key`. The shell is rebuilt when it is new, its atoms or cutoff changed,
+    or atoms moved too far since the last rebuild. Otherwise only its boundary atoms are measured.
+
+    Parameters
+    ----------
+    solvation_shells: dict
+        Generated by `init_solvation_shells`, updated in place
+    shell_key: hashable
+        Identifies the shell, ie "protein" or the resname of a ligand
+    coords: np.array of shape (num_atoms, 3)
+        Coordinates of all atoms in the frame, indexed by VMD atom index
+    atoms: np.array of ints
+        VMD indices of the atoms that may be in the shell, ie the solvent atoms
+    reference_atoms: np.array of ints
+        VMD indices of the atoms the shell surrounds
+    cutoff: float
+    neighbor_engine: string, default = "cell"
+        "cell" or "kdtree"
+
+    Returns
+    -------
+    shell_atoms: np.array of ints
+        Sorted VMD indices of `atoms` within cutoff of any of `reference_atoms`
+    """
+    skin = solvation_shells["skin"]
+    shell = solvation_shells["shells"].get(shell_key)
+    if shell is None or shell["cutoff"] != cutoff or not np.array_equal(shell["atoms"], atoms) or \
+            not np.array_equal(shell["reference_atoms"], reference_atoms) or \
+            calc_max_displacement(shell["atom_coords"], coords[atoms]) + \
+            calc_max_displacement(shell["reference_coords"], coords[reference_atoms]) > skin:
+        shell = rebuild_shell(coords, atoms, reference_atoms, cutoff, skin, neighbor_engine)
+        solvation_shells["shells"][shell_key] = shell
+
+    boundary = shell["boundary"]
+    count_profile("shell_boundary_atoms", len(boundary))
+    positions, _ = calc_neighbor_pairs(coords[boundary], coords[reference_atoms], cutoff, neighbor_engine)
+    return np.union1d(shell["core"], boundary[np.unique(positions)])
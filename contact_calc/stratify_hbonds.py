@@ -30,14 +30,14 @@ __all__ = ["stratify_hbond_subtypes"]
 ##############################################################################
 
 
-def residue_vs_water_hbonds(hbonds, solvent_resn):
+def residue_vs_water_hbonds(hbonds, solvent_mask):
     """
     Split hbonds into those involving residues only and those mediated by water.
     """
     residue_hbonds, water_hbonds = [], []
     for hbond in hbonds:
-        frame_idx, atom1_label, atom2_label, itype = hbond
-        if solvent_resn in atom1_label or solvent_resn in atom2_label:
+        frame_idx, atom1, atom2, itype = hbond
+        if solvent_mask[atom1] or solvent_mask[atom2]:
             water_hbonds.append(hbond)
         else:
             residue_hbonds.append(hbond)
@@ -45,101 +45,85 @@ def residue_vs_water_hbonds(hbonds, solvent_resn):
     return residue_hbonds, water_hbonds
 
 
-def stratify_residue_hbonds(residue_hbonds):
+def stratify_residue_hbonds(residue_hbonds, backbone_mask):
     """
     Stratify residue to residue hbonds into those between sidechain-sidechain,
     sidechain-backbone, and backbone-backbone
     """
-    backbone_atoms = ['N', 'O']
     hbss, hbsb, hbbb = [], [], []
 
     # Iterate through each residue hbond and bin into appropriate subtype
-    for frame_idx, atom1_label, atom2_label, itype in residue_hbonds:
-        atom1 = atom1_label.split(":")[3]
-        atom2 = atom2_label.split(":")[3]
-
-        if atom1 not in backbone_atoms and atom2 not in backbone_atoms:
-            hbss.append([frame_idx, "hbss", atom1_label, atom2_label])
-
-        if (atom1 not in backbone_atoms and atom2 in backbone_atoms) or \
-                (atom1 in backbone_atoms and atom2 not in backbone_atoms):
-            hbsb.append([frame_idx, "hbsb", atom1_label, atom2_label])
-
-        if atom1 in backbone_atoms and atom2 in backbone_atoms:
-            hbbb.append([frame_idx, "hbbb", atom1_label, atom2_label])
+    for frame_idx, atom1, atom2, itype in residue_hbonds:
+        atom1_is_backbone = backbone_mask[atom1]
+        atom2_is_backbone = backbone_mask[atom2]
+
+        if not atom1_is_backbone and not atom2_is_backbone:
+            hbss.append([frame_idx, ITYPE_CODES["hbss"], atom1, atom2])
+        elif atom1_is_backbone and atom2_is_backbone:
+            hbbb.append([frame_idx, ITYPE_CODES["hbbb"], atom1, atom2])
+        else:
+            hbsb.append([frame_idx, ITYPE_CODES["hbsb"], atom1, atom2])
 
     return hbss, hbsb, hbbb
 
 
-def stratify_water_bridge(water_hbonds, solvent_resn):
+def stratify_water_bridges(water_hbonds, solvent_mask, water_bridge_depth=2):
     """
-    Infer direct water bridges between residues that both have hbond
-    with the same water (ie res1 -- water -- res2)
+    Infer water bridges between residues from a single water graph of the frame. Direct
+    water bridges (wb) connect residues that both have hbond with the same water
+    (ie res1 -- water -- res2), extended water bridges (wb2) residues that form hbond with
+    water molecules that also have hbond between them (ie res1 -- water1 -- water2 -- res2),
+    and so on up to `water_bridge_depth` waters (wb3, ...).
     """
-    frame_idx, water_to_residues, _ = calc_water_to_residues_map(water_hbonds, solvent_resn)
+    frame_idx, water_to_residues, water_neighbors, water_bonds = calc_water_graph(water_hbonds, solvent_mask)
+    water_paths = calc_water_paths(water_to_residues, water_neighbors, water_bonds, water_bridge_depth)
+
     water_bridges = set()
-    # Infer direct water bridges
-    for water in water_to_residues:
+    for (water,) in water_paths[0]:
         protein_atoms = sorted(list(water_to_residues[water]))
-        for res_atom_pair in itertools.combinations(protein_atoms, 2):
-            res_atom1, res_atom2 = res_atom_pair
-            if res_atom1 != res_atom2:
-                water_bridges.add((frame_idx, "wb", res_atom1, res_atom2, water))
-
+        for res_atom1, res_atom2 in itertools.combinations(protein_atoms, 2):
+            water_bridges.add((frame_idx, ITYPE_CODES["wb"], res_atom1, res_atom2, water))
     wb = sorted([list(entry) for entry in water_bridges])
-    return wb
 
+    # Bridges through several waters connect the residues of the first and the last water
+    for depth in range(2, water_bridge_depth + 1):
+        itype_code = ITYPE_CODES[water_bridge_itype(depth)]
+        extended_water_bridges = set()
+        for waters in water_paths[depth - 1]:
+            for atom1 in water_to_residues[waters[0]]:
+                for atom2 in water_to_residues[waters[-1]]:
+                    extended_water_bridges.add((frame_idx, itype_code, atom1, atom2) + waters)
+        wb += sorted([list(entry) for entry in extended_water_bridges])
 
-def stratify_extended_water_bridge(water_hbonds, solvent_resn):
-    """
-    Infer extended water bridges between residues that form hbond with
-    water molecules that also have hbond between them.
-    (ie res1 -- water1 -- water2 -- res2)
-    """
-    frame_idx, water_to_residues, solvent_bridges = calc_water_to_residues_map(water_hbonds, solvent_resn)
-    extended_water_bridges = set()
-    for water1, water2 in solvent_bridges:
-        if water1 not in water_to_residues or water2 not in water_to_residues:
-            continue
-        res_atom1_list, res_atom2_list = water_to_residues[water1], water_to_residues[water2]
-
-        for atom1 in res_atom1_list:
-            for atom2 in res_atom2_list:
-                extended_water_bridges.add((frame_idx, "wb2", atom1, atom2, water1, water2))
-
-    extended_water_bridges = sorted(list(extended_water_bridges))
-
-    wb2 = []
-    for frame_idx, atom1, water1, water2, atom2, itype in extended_water_bridges:
-        wb2.append([frame_idx, atom1, water1, water2, atom2, itype])
-
-    return wb2
+    return wb
 
 
-def stratify_hbond_subtypes(hbonds, solvent_resn):
+def stratify_hbond_subtypes(hbonds, interaction_topology, water_bridge_depth=2):
     """
     Stratify the full hbonds list into the following subtypes: sidechain-sidechain,
-    sidechain-backbone, backbone-backbone, water-bridge, and extended water-bridge
+    sidechain-backbone, backbone-backbone, water-bridge, and extended water-bridges
 
     Parameters
     ----------
-    hbonds: list, [[frame_idx, atom1_label, atom2_label, itype], ...]
+    hbonds: list, [[frame_idx, atom1_index, atom2_index, itype_code], ...]
         List of all hydrogen bond contacts in a single frame. itype = "hb"
-
-    solvent_resn: string, default = TIP3
-        Denotes the resname of solvent in simulation
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`, provides the
+        solvent and backbone masks
+    water_bridge_depth: int, default = 2
+        Largest number of waters in a water bridge, at most MAX_WATER_BRIDGE_DEPTH
 
     Returns
     -------
-    hbond_subtypes: list, [[frame_idx, atom1_label, atom2_label, itype], ...]
-        List of all hydrogen contacts with itype = "hbss", "hbsb", "hbbb", "wb", or "wb2"
+    hbond_subtypes: list, [[frame_idx, itype_code, atom1_index, atom2_index, ...], ...]
+        List of all hydrogen contacts with itype = "hbss", "hbsb", "hbbb", "wb", "wb2", ...
         corresponding to sidechain-sidechain, sidechain-backbone, backbone-backbone,
-        water bridge and extended water bridge respectively.
+        water bridge and extended water bridges through 2 or more waters respectively.
     """
-    residue_hbonds, water_hbonds = residue_vs_water_hbonds(hbonds, solvent_resn)
-    hbss, hbsb, hbbb = stratify_residue_hbonds(residue_hbonds)
-    wb = stratify_water_bridge(water_hbonds, solvent_resn)
-    wb2 = stratify_extended_water_bridge(water_hbonds, solvent_resn)
-    hbonds = hbss + hbsb + hbbb + wb + wb2
+    solvent_mask = interaction_topology["solvent_mask"]
+    residue_hbonds, water_hbonds = residue_vs_water_hbonds(hbonds, solvent_mask)
+    hbss, hbsb, hbbb = stratify_residue_hbonds(residue_hbonds, interaction_topology["backbone_mask"])
+    water_bridges = stratify_water_bridges(water_hbonds, solvent_mask, water_bridge_depth)
+    hbonds = hbss + hbsb + hbbb + water_bridges
 
     return hbonds
@@ -27,15 +27,15 @@ __all__ = ["stratify_ligand_hbond_subtypes"]
 ############################################################################
 
 
-def ligand_residue_vs_water_hbonds(hbonds, solvent_resn, ligand):
+def ligand_residue_vs_water_hbonds(hbonds, solvent_mask):
     """
     Split hbonds into those involving residue and ligand directly and those
     mediated by water molecules.
     """
     ligand_residue_hbonds, water_hbonds = [], []
     for hbond in hbonds:
-        frame_idx, atom1_label, atom2_label, itype = hbond
-        if solvent_resn in atom1_label or solvent_resn in atom2_label:
+        frame_idx, atom1, atom2, itype = hbond
+        if solvent_mask[atom1] or solvent_mask[atom2]:
             water_hbonds.append(hbond)
         else:
             ligand_residue_hbonds.append(hbond)
@@ -43,121 +43,115 @@ def ligand_residue_vs_water_hbonds(hbonds, solvent_resn, ligand):
     return ligand_residue_hbonds, water_hbonds
 
 
-def stratify_ligand_residue_hbonds(ligand_residue_hbonds, ligands):
+def stratify_ligand_residue_hbonds(ligand_residue_hbonds, ligand_mask, backbone_mask):
     """
     Stratify ligand to residue hbonds into those involving sidechain
     or backbone atoms.
     """
-    backbone_atoms = ['N', 'O']
     hls, hlb = [], []
 
     # Iterate through each ligand residue hbond and bin into appropriate subtype
-    for frame_idx, atom1_label, atom2_label, itype in ligand_residue_hbonds:
-        a1_is_ligand = any([l in atom1_label for l in ligands])
-        a2_is_ligand = any([l in atom2_label for l in ligands])
+    for frame_idx, atom1, atom2, itype in ligand_residue_hbonds:
+        a1_is_ligand = ligand_mask[atom1]
+        a2_is_ligand = ligand_mask[atom2]
 
         if a1_is_ligand and a2_is_ligand:
             continue
         elif not a1_is_ligand and not a2_is_ligand:
             continue
         elif a1_is_ligand:
-            lig_atom = atom1_label
-            res_atom = atom2_label
+            lig_atom = atom1
+            res_atom = atom2
         elif a2_is_ligand:
-            lig_atom = atom2_label
-            res_atom = atom1_label
+            lig_atom = atom2
+            res_atom = atom1
 
-        res_atom_name = res_atom.split(":")[3]
-        if res_atom_name in backbone_atoms:
-            hlb.append([frame_idx, "hlb", lig_atom, res_atom])
+        if backbone_mask[res_atom]:
+            hlb.append([frame_idx, ITYPE_CODES["hlb"], lig_atom, res_atom])
         else:
-            hls.append([frame_idx, "hls", lig_atom, res_atom])
+            hls.append([frame_idx, ITYPE_CODES["hls"], lig_atom, res_atom])
 
     return hls, hlb
 
 
-def stratify_ligand_vs_protein(atom_list, ligands):
+def stratify_ligand_vs_protein(atom_list, ligand_mask):
     ligand_atoms, protein_atoms = [], []
     for atom in atom_list:
-        atom_is_ligand = any([l in atom for l in ligands])
-        if atom_is_ligand:
+        if ligand_mask[atom]:
             ligand_atoms.append(atom)
         else:
             protein_atoms.append(atom)
     return ligand_atoms, protein_atoms
 
 
-def stratify_ligand_water_bridge(water_hbonds, solvent_resn, ligand):
+def stratify_ligand_water_bridges(water_hbonds, solvent_mask, ligand_mask, water_bridge_depth=2):
     """
-    Compute water bridges between ligand and binding pocket residue
+    Compute water bridges between ligand and binding pocket residues through 1 (lwb),
+    2 (lwb2) and up to `water_bridge_depth` waters from a single water graph of the frame.
+    Waters are listed in order from the ligand to the residue.
     """
-    frame_idx, water_to_ligand_residues, _ = calc_water_to_residues_map(water_hbonds, solvent_resn)
-    ligand_water_bridges = set()
+    frame_idx, water_to_ligand_residues, water_neighbors, water_bonds = calc_water_graph(water_hbonds, solvent_mask)
+    water_paths = calc_water_paths(water_to_ligand_residues, water_neighbors, water_bonds, water_bridge_depth)
+    water_partners = {water: stratify_ligand_vs_protein(atoms, ligand_mask)
+                      for water, atoms in water_to_ligand_residues.items()}
 
-    for water in water_to_ligand_residues:
-        ligand_atoms, protein_atoms = stratify_ligand_vs_protein(water_to_ligand_residues[water], ligand)
+    ligand_water_bridges = set()
+    for (water,) in water_paths[0]:
+        ligand_atoms, protein_atoms = water_partners[water]
 
         # Form ligand -- water -- protein pairs
         for lig_atom in ligand_atoms:
             for res_atom in protein_atoms:
-                ligand_water_bridges.add((frame_idx, "lwb", lig_atom, res_atom, water))
-
+                ligand_water_bridges.add((frame_idx, ITYPE_CODES["lwb"], lig_atom, res_atom, water))
     lwb = sorted([list(entry) for entry in ligand_water_bridges])
-    return lwb
 
+    # Either end of a chain of waters can be the one next to the ligand
+    for depth in range(2, water_bridge_depth + 1):
+        itype_code = ITYPE_CODES[water_bridge_itype(depth, ligand=True)]
+        extended_ligand_water_bridges = set()
+        for waters in water_paths[depth - 1]:
+            ligand_atoms1, protein_atoms1 = water_partners[waters[0]]
+            ligand_atoms2, protein_atoms2 = water_partners[waters[-1]]
 
-def stratify_extended_ligand_water_bridge(water_hbonds, solvent_resn, ligand):
-    """
-    Compute extended water bridges between ligand and binding pocket residues
-    """
-    frame_idx, water_to_ligand_residues, solvent_bridges = calc_water_to_residues_map(water_hbonds, solvent_resn)
+            for lig_atom1 in ligand_atoms1:
+                for res_atom2 in protein_atoms2:
+                    extended_ligand_water_bridges.add((frame_idx, itype_code, lig_atom1, res_atom2) + waters)
 
-    extended_ligand_water_bridges = set()
-    for water1, water2 in solvent_bridges:
-        if water1 not in water_to_ligand_residues or water2 not in water_to_ligand_residues:
-            continue
-        lig_res_atom1_list, lig_res_atom2_list = water_to_ligand_residues[water1], water_to_ligand_residues[water2]
-        ligand_atoms1, protein_atoms1 = stratify_ligand_vs_protein(lig_res_atom1_list, ligand)
-        ligand_atoms2, protein_atoms2 = stratify_ligand_vs_protein(lig_res_atom2_list, ligand)
-
-        for lig_atom1 in ligand_atoms1:
-            for res_atom2 in protein_atoms2:
-                extended_ligand_water_bridges.add((frame_idx, "lwb2", lig_atom1, res_atom2, water1, water2))
-
-        for lig_atom2 in ligand_atoms2:
-            for res_atom1 in protein_atoms1:
-                extended_ligand_water_bridges.add((frame_idx, "lwb2", lig_atom2, res_atom1, water2, water1))
+            for lig_atom2 in ligand_atoms2:
+                for res_atom1 in protein_atoms1:
+                    extended_ligand_water_bridges.add((frame_idx, itype_code, lig_atom2, res_atom1) + waters[::-1])
+        lwb += sorted([list(entry) for entry in extended_ligand_water_bridges])
 
-    lwb2 = sorted([list(entry) for entry in extended_ligand_water_bridges])
-    return lwb2
+    return lwb
 
 
-def stratify_ligand_hbond_subtypes(hbonds, solvent_resn, ligand):
+def stratify_ligand_hbond_subtypes(hbonds, interaction_topology, water_bridge_depth=2):
     """
     Stratify the full ligand hbonds list into the following subtypes: ligand-sidechain,
-    ligand-backbone, ligand water-bridge, and extended ligand water-bridge
+    ligand-backbone, ligand water-bridge, and extended ligand water-bridges
 
     Parameters
     ----------
-    hbonds: list, [[frame_idx, atom1_label, atom2_label, itype], ...]
+    hbonds: list, [[frame_idx, atom1_index, atom2_index, itype_code], ...]
         List of all hydrogen bond contacts in a single frame. itype = "lhb"
-
-    solvent_resn: string, default = TIP3
-        Denotes the resname of solvent in simulation
-    ligand: list of string
-        Denotes the resname of ligand molecule
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`, provides the
+        solvent, ligand and backbone masks
+    water_bridge_depth: int, default = 2
+        Largest number of waters in a water bridge, at most MAX_WATER_BRIDGE_DEPTH
 
     Returns
     -------
-    hbond_subtypes: list, [[frame_idx, atom1_label, atom2_label, itype], ...]
-        List of all hydrogen contacts with itype = "hls", "hlb", "lwb", or "lwb2"
+    hbond_subtypes: list, [[frame_idx, itype_code, atom1_index, atom2_index, ...], ...]
+        List of all hydrogen contacts with itype = "hls", "hlb", "lwb", "lwb2", ...
         corresponding to ligand-sidechain, ligand-backbone, ligand water bridge,
-        and extended ligand water bridge respectively.
+        and extended ligand water bridges through 2 or more waters respectively.
     """
-    ligand_residue_hbonds, water_hbonds = ligand_residue_vs_water_hbonds(hbonds, solvent_resn, ligand)
-    hls, hlb = stratify_ligand_residue_hbonds(ligand_residue_hbonds, ligand)
-    lwb = stratify_ligand_water_bridge(water_hbonds, solvent_resn, ligand)
-    lwb2 = stratify_extended_ligand_water_bridge(water_hbonds, solvent_resn, ligand)
-    hbonds = hls + hlb + lwb + lwb2
+    solvent_mask = interaction_topology["solvent_mask"]
+    ligand_mask = interaction_topology["ligand_mask"]
+    ligand_residue_hbonds, water_hbonds = ligand_residue_vs_water_hbonds(hbonds, solvent_mask)
+    hls, hlb = stratify_ligand_residue_hbonds(ligand_residue_hbonds, ligand_mask, interaction_topology["backbone_mask"])
+    ligand_water_bridges = stratify_ligand_water_bridges(water_hbonds, solvent_mask, ligand_mask, water_bridge_depth)
+    hbonds = hls + hlb + ligand_water_bridges
 
     return hbonds
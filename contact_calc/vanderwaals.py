@@ -19,6 +19,7 @@
 ##############################################################################
 
 from .contact_utils import *
+from .neighbor_search import *
 
 __all__ = ["compute_vanderwaals"]
 
@@ -40,7 +41,8 @@ ATOM_RADIUS = {'H': 1.20,
 ##############################################################################
 
 
-def compute_vanderwaals(traj_frag_molid, frame_idx, index_to_label, sele_id, VDW_EPSILON, VDW_RES_DIFF):
+def compute_vanderwaals(traj_frag_molid, frame_idx, coords, interaction_topology, VDW_EPSILON, VDW_RES_DIFF,
+                        neighbor_engine="vmd", neighbor_cache=None, verlet_lists=None):
     """
     Compute all vanderwaals interactions in a frame of simulation
 
@@ -50,50 +52,44 @@ def compute_vanderwaals(traj_frag_molid, frame_idx, index_to_label, sele_id, VDW
         Identifier to simulation fragment in VMD
     frame_idx: int
         Frame number to query
-    index_to_label: dict
-        Maps VMD atom index to label "chain:resname:resid:name:index"
-        {11205: "A:ASP:114:CA:11205, ...}
-    sele_id: string, default = None
-        Compute contacts on subset of atom selection based on VMD query
+    coords: np.array of shape (num_atoms, 3)
+        Coordinates of all atoms in the frame, indexed by VMD atom index
+    interaction_topology: dict
+        Static atom groups generated by `gen_interaction_topology`
     VDW_EPSILON: float, default = 0.5 angstroms
         amount of padding for calculating vanderwaals contacts
     VDW_RES_DIFF: int, default = 2
         minimum residue distance for which to consider computing vdw interactions
+    neighbor_engine: string, default = "vmd"
+        Neighbor search engine used to find candidate pairs, see `find_contact_pairs`
+    neighbor_cache: dict, default = None
+        Per-frame cache of neighbor searches shared among itypes
+    verlet_lists: dict, default = None
+        Verlet lists reused across frames, see `init_verlet_lists`
 
     Returns
     -------
-    vanderwaals: list of tuples, [(frame_idx, itype, atom1_label, atom2_label), ...]
+    vanderwaals: list of lists, [[frame_idx, itype_code, atom1_index, atom2_index], ...]
         itype = "vdw"
     """
     vanderwaals = []
-    if sele_id is None:
-        evaltcl("set full_protein [atomselect %s \" noh and protein \" frame %s]" %
-                (traj_frag_molid, frame_idx))
-    else:
-        evaltcl("set full_protein [atomselect %s \" noh and protein and (%s) \" frame %s]" %
-                (traj_frag_molid, sele_id, frame_idx))
+    atom1_indices, atom2_indices = find_contact_pairs(traj_frag_molid, frame_idx, coords, interaction_topology,
+                                                      "heavy_protein_atoms", None, SOFT_VDW_CUTOFF, neighbor_engine,
+                                                      neighbor_cache, verlet_lists)
 
-    contacts = evaltcl("measure contacts %s $full_protein" % SOFT_VDW_CUTOFF)
-    contact_index_pairs = parse_contacts(contacts)
-    evaltcl('$full_protein delete')
-    for atom1_index, atom2_index in contact_index_pairs:
-        atom1_label, atom2_label = index_to_label[atom1_index], index_to_label[atom2_index]
-        atom1_label_split = atom1_label.split(":")
-        atom2_label_split = atom2_label.split(":")
+    # Skip pairs within VDW_RES_DIFF residues of each other on the same chain
+    chain_codes, resids = interaction_topology["chain_codes"], interaction_topology["resids"]
+    nearby_residues = (chain_codes[atom1_indices] == chain_codes[atom2_indices]) & \
+                      (np.abs(resids[atom1_indices] - resids[atom2_indices]) < VDW_RES_DIFF)
 
-        chain1 = atom1_label_split[0]
-        chain2 = atom2_label_split[0]
-        resi1 = int(atom1_label_split[2])
-        resi2 = int(atom2_label_split[2])
-        if chain1 == chain2 and abs(resi1-resi2) < VDW_RES_DIFF:
-            continue
+    # Atoms with elements missing from ATOM_RADIUS have a NaN radius and never pass the cutoff
+    vdw_radii = interaction_topology["vdw_radii"]
+    diff = coords[atom1_indices] - coords[atom2_indices]
+    distances = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    vanderwaal_cutoffs = vdw_radii[atom1_indices] + vdw_radii[atom2_indices] + VDW_EPSILON
 
-        element1 = atom1_label_split[3][0]
-        element2 = atom2_label_split[3][0]
-
-        distance = compute_distance(traj_frag_molid, frame_idx, atom1_label, atom2_label)
-        vanderwaal_cutoff = ATOM_RADIUS[element1] + ATOM_RADIUS[element2] + VDW_EPSILON
-        if distance < vanderwaal_cutoff:
-            vanderwaals.append([frame_idx, "vdw", atom1_label, atom2_label])
+    contacts = ~nearby_residues & (distances < vanderwaal_cutoffs)
+    for atom1_index, atom2_index in zip(atom1_indices[contacts].tolist(), atom2_indices[contacts].tolist()):
+        vanderwaals.append([frame_idx, ITYPE_CODES["vdw"], atom1_index, atom2_index])
 
     return vanderwaals
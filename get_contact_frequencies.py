@@ -19,8 +19,19 @@ id 1, residue id 2, and contact frequency.
 
 from __future__ import division
 from collections import defaultdict
+from multiprocessing import Pool
+import os
 import sys
 import argparse
+import numpy as np
+from contact_calc.contact_io import is_binary_contact_file, read_binary_header, iter_binary_blocks, \
+    iter_contact_lines, seek_to_frame, read_contact_header, count_frames_in_range, is_interval_contact_file, \
+    read_interval_contacts, contact_file_chunks, MAX_WATER_BRIDGE_DEPTH
+
+# With --cores, tsv and bin inputs are split into chunks of at least MIN_CHUNK_BYTES, aiming for
+# CHUNKS_PER_CORE chunks per core so that cores stay busy when chunks take unequal time
+MIN_CHUNK_BYTES = 16 * 1024 * 1024
+CHUNKS_PER_CORE = 4
 
 
 def atomid_to_resid(atom):
@@ -60,17 +71,20 @@ def gen_counts(input_lines, interaction_types, residuelabels=None):
     Returns
     -------
     (int, dict of (str, str): int)
-        Total frame-count and mapping of residue-residue interactions to frame-count
+        Total frame-count and mapping of residue-residue interactions to frame-count. The frame-count is taken from
+        the header if present, since frame numbers of windowed or strided contact files exceed it.
     """
     # Maps residue pairs to set of frames in which they're present
     rescontact_frames = defaultdict(set)
     total_frames = 0
+    header_total_frames = False
 
     for line in input_lines:
         line = line.strip()
         if "total_frames" in line:
             tokens = line.split(" ")
             total_frames = int(tokens[1][tokens[1].find(":")+1:])
+            header_total_frames = True
 
         if len(line) == 0 or line[0] == "#":
             continue
@@ -83,7 +97,7 @@ def gen_counts(input_lines, interaction_types, residuelabels=None):
             continue
 
         frame = int(tokens[0])
-        if frame + 1 > total_frames:
+        if not header_total_frames and frame + 1 > total_frames:
             total_frames = frame + 1
 
         res1 = atomid_to_resid(tokens[2])
@@ -107,6 +121,260 @@ def gen_counts(input_lines, interaction_types, residuelabels=None):
     return total_frames, rescontact_counts
 
 
+def gen_binary_counts(contact_path, interaction_types, residuelabels=None, frame_range=None, byte_range=None):
+    """
+    Same as `gen_counts` for a contact file in the binary format. Residues are resolved once per
+    atom of the label table and each block of contacts is counted with NumPy.
+
+    Parameters
+    ----------
+    contact_path: str
+        Path to a binary contact file
+    interaction_types: list of str
+        Which interaction types to consider
+    residuelabels: dict of (str: str)
+        Remaps and filters residuelabels, e.g. {"A:ARG:4": "R4"}
+    frame_range: tuple of (int, int), default = None
+        Only count contacts with frames from the first to the last value (inclusive)
+    byte_range: tuple of (int, int), default = None
+        Only count the blocks of this chunk of the file, see `contact_file_chunks`
+
+    Returns
+    -------
+    (int, dict of (str, str): int)
+        Total frame-count and mapping of residue-residue interactions to frame-count
+    """
+    with open(contact_path, "rb") as contact_fd:
+        header = read_binary_header(contact_fd)
+        total_frames = header["total_frames"]
+        selected_codes = [code for code, itype in enumerate(header["itype_names"]) if itype in interaction_types]
+
+        # Residue of each atom after applying `residuelabels`, None if filtered away
+        atom_residues = [atomid_to_resid(atom) for atom in header["atom_labels"]]
+        if residuelabels is not None:
+            atom_residues = [residuelabels.get(res) for res in atom_residues]
+
+        # Residue codes follow the lexicographical order of residue names, so ordering
+        # a pair of codes orders the pair of names
+        residue_names = sorted(set(res for res in atom_residues if res is not None))
+        residue_codes = {res: code for code, res in enumerate(residue_names)}
+        atom_residue_codes = np.array([-1 if res is None else residue_codes[res] for res in atom_residues],
+                                      dtype=np.int64)
+        num_residues = len(residue_names)
+
+        respair_counts = defaultdict(int)
+        end_offset = None
+        if byte_range is not None:
+            contact_fd.seek(byte_range[0])
+            end_offset = byte_range[1]
+        elif frame_range is not None:
+            seek_to_frame(contact_fd, contact_path, frame_range[0])
+        for frames, itypes, atoms in iter_binary_blocks(contact_fd, frame_range, header["atom_columns"], end_offset):
+            rows = np.isin(itypes, selected_codes)
+            if not rows.any():
+                continue
+            frames = frames[rows]
+
+            res1 = atom_residue_codes[atoms[rows, 0]]
+            res2 = atom_residue_codes[atoms[rows, 1]]
+            labeled = (res1 >= 0) & (res2 >= 0)
+            respair_keys = np.minimum(res1, res2)[labeled] * num_residues + np.maximum(res1, res2)[labeled]
+
+            # Count each residue pair once per frame. Frames never span blocks.
+            unique_contacts = np.unique(np.stack([respair_keys, frames[labeled]], axis=1), axis=0)
+            block_keys, block_counts = np.unique(unique_contacts[:, 0], return_counts=True)
+            for respair_key, count in zip(block_keys.tolist(), block_counts.tolist()):
+                respair_counts[respair_key] += count
+
+    rescontact_counts = {(residue_names[key // num_residues], residue_names[key % num_residues]): count
+                         for key, count in respair_counts.items()}
+    return total_frames, rescontact_counts
+
+
+def gen_interval_counts(contact_path, interaction_types, residuelabels=None, frame_range=None):
+    """
+    Same as `gen_counts` for a contact file in the interval format. The intervals of all atom
+    interactions of a residue pair are joined, so the frames of a pair are counted without
+    expanding the intervals.
+
+    Parameters
+    ----------
+    contact_path: str
+        Path to an interval contact file
+    interaction_types: list of str
+        Which interaction types to consider
+    residuelabels: dict of (str: str)
+        Remaps and filters residuelabels, e.g. {"A:ARG:4": "R4"}
+    frame_range: tuple of (int, int), default = None
+        Only count frames from the first to the last value (inclusive)
+
+    Returns
+    -------
+    (int, dict of (str, str): int)
+        Total frame-count and mapping of residue-residue interactions to frame-count
+    """
+    header = read_contact_header(contact_path)
+    first_frame, stride = header["first_frame"], header["stride"]
+    range_beg, range_end = (first_frame, float("inf")) if frame_range is None else \
+        (frame_range[0], frame_range[1] + 1)
+    # First computed frame at or after the beginning of the range
+    range_beg = first_frame + max(0, -((first_frame - range_beg) // stride)) * stride
+
+    # Maps residue pairs to the intervals in which they're present
+    rescontact_intervals = defaultdict(list)
+    for interaction, intervals in read_interval_contacts(contact_path, interaction_types):
+        res1 = atomid_to_resid(interaction[1])
+        res2 = atomid_to_resid(interaction[2])
+        if residuelabels is not None:
+            if res1 not in residuelabels or res2 not in residuelabels:
+                continue
+            res1 = residuelabels[res1]
+            res2 = residuelabels[res2]
+        if res2 < res1:
+            res1, res2 = res2, res1
+
+        for start, end, _ in intervals:
+            # Intervals start on computed frames, so clipping to computed frames keeps them aligned
+            start = start if start >= range_beg else range_beg
+            end = min(end, range_end)
+            if start < end:
+                rescontact_intervals[(res1, res2)].append((start, end))
+
+    rescontact_counts = {}
+    for respair, intervals in rescontact_intervals.items():
+        intervals.sort()
+        count, union_start, union_end = 0, intervals[0][0], intervals[0][1]
+        for start, end in intervals[1:]:
+            if start > union_end:
+                count += -((union_start - union_end) // stride)
+                union_start, union_end = start, end
+            else:
+                union_end = max(union_end, end)
+        rescontact_counts[respair] = count - ((union_start - union_end) // stride)
+    return header["total_frames"], rescontact_counts
+
+
+def gen_file_counts(contact_path, interaction_types, residuelabels=None, frame_range=None):
+    """
+    Compute the interaction-counts of a contact file in any format, see `gen_counts`. If `frame_range`
+    is given only frames from the first to the last value (inclusive) are considered, and the frame index
+    of the contact file is used to skip to them if it has one. Frame numbers refer to the original
+    trajectory, so the frame-count of a range follows the first_frame and stride of the header.
+
+    Returns
+    -------
+    (int, dict of (str, str): int)
+        Frame-count of the considered frames and mapping of residue-residue interactions to frame-count
+    """
+    if is_interval_contact_file(contact_path):
+        total_frames, counts = gen_interval_counts(contact_path, interaction_types, residuelabels, frame_range)
+    elif is_binary_contact_file(contact_path):
+        total_frames, counts = gen_binary_counts(contact_path, interaction_types, residuelabels, frame_range)
+    else:
+        total_frames, counts = gen_counts(iter_contact_lines(contact_path, frame_range), interaction_types,
+                                          residuelabels)
+
+    if frame_range is not None:
+        header = read_contact_header(contact_path)
+        header["total_frames"] = total_frames
+        total_frames = count_frames_in_range(header, frame_range)
+    return total_frames, counts
+
+
+def gen_chunk_counts(contact_path, byte_range, interaction_types, residuelabels=None, frame_range=None):
+    """
+    Compute the interaction-counts of a chunk of a tsv or bin contact file (see `contact_file_chunks`).
+    Chunks never share frames, so the counts of all chunks of a file add up to the counts of the file,
+    see `merge_chunk_counts`.
+
+    Returns
+    -------
+    (int, dict of (str, str): int)
+        Frame-count of the chunk, which is only used for files without a header, and mapping of
+        residue-residue interactions to frame-count
+    """
+    if is_binary_contact_file(contact_path):
+        return gen_binary_counts(contact_path, interaction_types, residuelabels, frame_range, byte_range)
+    return gen_counts(iter_contact_lines(contact_path, frame_range, byte_range), interaction_types, residuelabels)
+
+
+def merge_chunk_counts(contact_path, chunk_counts, frame_range=None):
+    """
+    Add up the interaction-counts of all chunks of a contact file in file order, giving the same result
+    as `gen_file_counts` on the whole file
+
+    Returns
+    -------
+    (int, dict of (str, str): int)
+        Frame-count of the considered frames and mapping of residue-residue interactions to frame-count
+    """
+    header = read_contact_header(contact_path)
+    counts = {}
+    for _, chunk_respair_counts in chunk_counts:
+        for respair, count in chunk_respair_counts.items():
+            counts[respair] = counts.get(respair, 0) + count
+
+    total_frames = header["total_frames"]
+    if total_frames is None:
+        total_frames = max([chunk_frames for chunk_frames, _ in chunk_counts] + [0])
+    if frame_range is not None:
+        header["total_frames"] = total_frames
+        total_frames = count_frames_in_range(header, frame_range)
+    return total_frames, counts
+
+
+def gen_counts_helper(args):
+    file_idx, contact_path, byte_range, interaction_types, residuelabels, frame_range = args
+    if byte_range is None:
+        return file_idx, gen_file_counts(contact_path, interaction_types, residuelabels, frame_range)
+    return file_idx, gen_chunk_counts(contact_path, byte_range, interaction_types, residuelabels, frame_range)
+
+
+def gen_parallel_counts(contact_paths, interaction_types, residuelabels=None, frame_range=None, cores=1):
+    """
+    Compute the interaction-counts of each contact file like `gen_file_counts`, in a pool of `cores`
+    processes. Tsv and bin files are split into chunks at frame boundaries so that a few large files
+    are spread over all processes. Interval files are counted whole, as the intervals of a residue pair
+    can be anywhere in the file.
+
+    Returns
+    -------
+    list of (int, dict of (str, str): int)
+        Frame-count and mapping of residue-residue interactions to frame-count of each contact file
+    """
+    total_bytes = sum(os.path.getsize(contact_path) for contact_path in contact_paths)
+    chunk_bytes = max(MIN_CHUNK_BYTES, total_bytes // (CHUNKS_PER_CORE * cores) + 1)
+    input_args = []
+    for file_idx, contact_path in enumerate(contact_paths):
+        if is_interval_contact_file(contact_path):
+            byte_ranges = [None]
+        else:
+            byte_ranges = contact_file_chunks(contact_path, chunk_bytes)
+        input_args += [(file_idx, contact_path, byte_range, interaction_types, residuelabels, frame_range)
+                       for byte_range in byte_ranges]
+
+    # Results arrive in the order of input_args, so chunks are merged in file order
+    file_chunk_counts = [[] for _ in contact_paths]
+    pool = Pool(processes=cores)
+    try:
+        for file_idx, chunk_counts in pool.imap(gen_counts_helper, input_args):
+            file_chunk_counts[file_idx].append(chunk_counts)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    counts = []
+    for contact_path, chunk_counts in zip(contact_paths, file_chunk_counts):
+        if is_interval_contact_file(contact_path):
+            counts.append(chunk_counts[0])
+        else:
+            counts.append(merge_chunk_counts(contact_path, chunk_counts, frame_range))
+    return counts
+
+
 def parse_labelfile(label_file):
     """
     Parses a label-file and returns a dictionary with the residue label mappings. Unless prepended with a comment-
@@ -187,11 +455,11 @@ def main():
     parser = MyParser(description=__doc__,
                       formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('--input_files',
-                        type=argparse.FileType('r'),
+                        type=str,
                         required=True,
                         nargs='+',
                         metavar='FILE.tsv',
-                        help="Path to one or more contact-file outputs")
+                        help="Path to one or more contact-file outputs (tsv, bin or int format)")
     parser.add_argument('--label_file',
                         type=argparse.FileType('r'),
                         required=False,
@@ -216,9 +484,23 @@ def main():
                              '* ts (t-stacking), \n'
                              '* vdw (van der Waals), \n'
                              '* hbbb, hbsb, hbss, (hydrogen bonds with specific backbone/side-chain profile)\n'
-                             '* wb, wb2 (water-bridges and extended water-bridges) \n'
+                             '* wb, wb2, wb3 ... wb6 (water-bridges through 1 to 6 waters) \n'
                              '* hls, hlb (ligand-sidechain and ligand-backbone hydrogen bonds), \n'
-                             '* lwb, lwb2 (ligand water-bridges and extended water-bridges)')
+                             '* lwb, lwb2, lwb3 ... lwb6 (ligand water-bridges through 1 to 6 waters)')
+    parser.add_argument('--frame_range',
+                        required=False,
+                        default=None,
+                        type=int,
+                        nargs=2,
+                        metavar=("BEGIN", "END"),
+                        help="Only consider frames from BEGIN to END (inclusive). Uses the frame index of the "
+                             "contact files if they were written with --frame_index")
+    parser.add_argument('--cores',
+                        required=False,
+                        default=1,
+                        type=int,
+                        help="Number of processes that count the input files in parallel. Large tsv and bin "
+                             "files are split into chunks at frame boundaries (default: 1)")
 
     # results, unknown = parser.parse_known_args()
     args = parser.parse_args()
@@ -226,14 +508,21 @@ def main():
     # Update itypes if "all" is specified
     if "all" in args.itypes:
         args.itypes = ["sb", "pc", "ps", "ts", "vdw", "hb", "lhb", "hbbb", "hbsb",
-                       "hbss", "wb", "wb2", "hls", "hlb", "lwb", "lwb2"]
+                       "hbss", "wb", "wb2", "hls", "hlb", "lwb", "lwb2"] + \
+                      ["wb%d" % depth for depth in range(3, MAX_WATER_BRIDGE_DEPTH + 1)] + \
+                      ["lwb%d" % depth for depth in range(3, MAX_WATER_BRIDGE_DEPTH + 1)]
 
     output_file = args.output_file
     input_files = args.input_files
     itypes = args.itypes
     labels = parse_labelfile(args.label_file) if args.label_file else None
 
-    counts = [gen_counts(input_file, itypes, labels) for input_file in input_files]
+    if args.cores < 1:
+        parser.error("--cores must be a positive integer")
+    if args.cores > 1:
+        counts = gen_parallel_counts(input_files, itypes, labels, args.frame_range, args.cores)
+    else:
+        counts = [gen_file_counts(input_file, itypes, labels, args.frame_range) for input_file in input_files]
     total_frames, frequencies = gen_frequencies(counts)
 
     output_file.write('#\ttotal_frames:%d\tinteraction_types:%s\n' % (total_frames, ','.join(itypes)))
@@ -17,6 +17,7 @@
 ############################################################################
 
 import argparse
+import glob
 from contact_calc.compute_contacts import *
 
 HELP_STR = """
@@ -32,12 +33,20 @@ Command was:
 python3 get_dynamic_contacts.py --help
 
 usage: python3 get_dynamic_contacts.py [--help] [--topology TOPOLOGY] 
-                      [--trajectory TRAJECTORY]
+                      [--trajectory TRAJECTORY [TRAJECTORY ...]]
                       [--output OUTPUT_PATH] 
                       [--cores NUM_CORES]
                       [--solv SOLVENT]
                       [--sele SELECTION]
                       [--ligand LIGAND]
+                      [--begin FIRST_FRAME]
+                      [--end LAST_FRAME]
+                      [--stride STRIDE]
+                      [--checkpoint CHECKPOINT_DIR]
+                      [--resume]
+                      [--output_format OUTPUT_FORMAT]
+                      [--frame_index]
+                      [--profile PROFILE_PATH]
                       [--itype INTERACTION_TYPES]
                       [--sb_cutoff_dist SALT_BRIDGE_CUTOFF_DISTANCE]
                       [--pc_cutoff_dist PI_CATION_CUTOFF_DISTANCE]
@@ -51,12 +60,21 @@ usage: python3 get_dynamic_contacts.py [--help] [--topology TOPOLOGY]
                       [--hbond_cutoff_dist HBOND_CUTOFF_DISTANCE]
                       [--hbond_cutoff_ang HBOND_CUTOFF_ANGLE]
                       [--vdw_epsilon VDW_EPSILON]
+                      [--water_bridge_depth WATER_BRIDGE_DEPTH]
+                      [--neighbor_engine NEIGHBOR_ENGINE]
+                      [--hbond_engine HBOND_ENGINE]
+                      [--shell_skin SHELL_SKIN]
+                      [--verlet_skin VERLET_SKIN]
 
 
 required arguments:
     --topology TOPOLOGY             path to topology file 
-    --trajectory TRAJECTORY         path to trajectory file
-    --output OUTPUT_PATH            path to output file
+    --trajectory TRAJECTORY         path to trajectory file, or several paths or
+                                    glob patterns of replicas of the same system
+    --output OUTPUT_PATH            path to output file. With several replicas,
+                                    each replica is written to OUTPUT_PATH with
+                                    the trajectory name inserted before the
+                                    extension (ie output_rep1.tsv)
     --itype INTERACTION_TYPES       list of interaction type flags
 
 optional arguments:
@@ -65,6 +83,31 @@ optional arguments:
     --solv SOLVENT          resname of solvent molecule [default = "TIP3"]
     --sele SELECTION        atom selection query in VMD [default = None]
     --ligand LIGAND         resname of ligand molecule [default = None]
+    --begin FIRST_FRAME     first trajectory frame to compute contacts for
+                            [default = 0]
+    --end LAST_FRAME        last trajectory frame to compute contacts for
+                            (inclusive) [default = last frame]
+    --stride STRIDE         compute contacts for every STRIDE-th frame starting
+                            at FIRST_FRAME [default = 1]. Output frame numbers
+                            always refer to the original trajectory
+    --checkpoint CHECKPOINT_DIR
+                            directory in which completed fragments are kept 
+                            until the run finishes [default = None]
+    --resume                skip fragments completed in CHECKPOINT_DIR by an 
+                            interrupted run with the same arguments
+    --output_format OUTPUT_FORMAT
+                            "tsv" for tab separated lines, "bin" for the 
+                            compact binary format read by get_contact_frequencies.py
+                            and the Applications, or "int" for one line per atom
+                            interaction with its [start, end) frame intervals 
+                            [default = "tsv"]
+    --frame_index           also write OUTPUT_PATH.idx mapping frames to byte 
+                            offsets, used by --frame_range of the analysis tools
+    --profile PROFILE_PATH  write a report of the time spent loading frames, in
+                            each interaction type, stratification and writing,
+                            along with evaltcl calls and candidate pairs, per
+                            worker and in total. JSON if PROFILE_PATH ends with
+                            .json, tab separated otherwise [default = None]
 
 geometric criteria options:
     --sb_cutoff_dist SALT_BRIDGE_CUTOFF_DISTANCE
@@ -109,6 +152,35 @@ geometric criteria options:
     --vdw_res_diff VDW_RES_DIFF
                     minimum residue distance for which to consider computing 
                     vdw interactions [default = 2]
+    --water_bridge_depth WATER_BRIDGE_DEPTH
+                    largest number of waters in a water bridge. Values above
+                    2 add wb3, lwb3 and deeper bridges, up to 6 [default = 2]
+
+engine options:
+    --neighbor_engine NEIGHBOR_ENGINE
+                    neighbor search used to find candidate atom pairs for
+                    vdw. "vmd" uses measure contacts, "cell" a NumPy
+                    cell list and "kdtree" scipy's cKDTree
+                    [default = "vmd"]
+    --hbond_engine HBOND_ENGINE
+                    hydrogen bond detection used for hb and lhb. "vmd" uses
+                    measure hbonds, "native" finds donor hydrogens from the
+                    topology bonds and applies the same criteria in NumPy
+                    [default = "vmd"]
+    --shell_skin SHELL_SKIN
+                    margin of the water shells around protein and ligands
+                    that hb and lhb track across frames. Shells are only
+                    rebuilt after atoms moved further than the skin, and
+                    otherwise only waters near the shell boundary are
+                    measured. A typical skin is 2.0 angstroms, 0 turns
+                    tracking off [default = 0]
+    --verlet_skin VERLET_SKIN
+                    margin of Verlet lists of vdw candidate pairs. A list
+                    holds the pairs within the cutoff plus the skin and is
+                    reused across frames until an atom moved more than half
+                    the skin. Lists are built with the "cell" neighbor
+                    engine unless "kdtree" is chosen. 0 searches the pairs
+                    of every frame from scratch [default = 0]
 
 
 interaction type flags:
@@ -128,6 +200,7 @@ output interaction subtypes:
     wb2            extended water bridges 
     lwb            ligand water bridges
     lwb2           extended ligand water bridges 
+    wbN, lwbN      water bridges through N waters, with --water_bridge_depth N
     hls            ligand-sidechain residue hydrogen bonds 
     hlb            ligand-backbone residue hydrogen bonds 
 
@@ -148,6 +221,15 @@ Compute salt bridges and hydrogen bonds for residues 100 to 160:
 Pi-cation, pi-stacking, and vanderwaals contacts in the entire protein:
 python get_dynamic_contacts.py --topology TOP.psf --trajectory TRAJ.dcd --output output.tsv --cores 6 --itype pc ps vdw
 
+Hydrogen bonds in all replicas of a system, written to output_rep1.tsv, output_rep2.tsv, ...:
+python get_dynamic_contacts.py --topology TOP.psf --trajectory "rep*.dcd" --output output.tsv --cores 24 --itype hb
+
+Van der Waals contacts written in the binary format:
+python get_dynamic_contacts.py --topology TOP.psf --trajectory TRAJ.dcd --output output.bin --output_format bin --cores 6 --itype vdw
+
+Hydrogen bonds written as frame intervals, which Applications/convert_contacts.py converts back to tsv:
+python get_dynamic_contacts.py --topology TOP.psf --trajectory TRAJ.dcd --output output.int --output_format int --cores 6 --itype hb
+
 Salt bridges and hydrogen bonds in the entire protein with modified distance cutoffs:
 python get_dynamic_contacts.py --topology TOP.mae --trajectory TRAJ.dcd --output output.tsv --cores 6 --sb_cutoff_dist 5.0 --hbond_cutoff_dist 4.5 --itype sb hb
 """
@@ -169,11 +251,52 @@ def process_geometric_criterion_args(args):
         "HBOND_CUTOFF_DISTANCE": args.hbond_cutoff_dist,
         "HBOND_CUTOFF_ANGLE": args.hbond_cutoff_ang,
         "VDW_EPSILON": args.vdw_epsilon,
-        "VDW_RES_DIFF": args.vdw_res_diff
+        "VDW_RES_DIFF": args.vdw_res_diff,
+        "WATER_BRIDGE_DEPTH": args.water_bridge_depth
     }
     return geom_criterion_values
 
 
+def expand_trajectory_args(trajectory_args):
+    """
+    Expand glob patterns among the --trajectory arguments, keeping the order in which
+    they were given. Paths without wildcards are kept as-is.
+    """
+    trajs = []
+    for trajectory_arg in trajectory_args:
+        if not os.path.exists(trajectory_arg) and any(c in trajectory_arg for c in "*?["):
+            matches = sorted(glob.glob(trajectory_arg), key=natural_keys)
+            if not matches:
+                print("Error: no trajectory matches " + trajectory_arg)
+                exit(1)
+            trajs += matches
+        else:
+            trajs.append(trajectory_arg)
+    return trajs
+
+
+def replica_output_paths(output, trajs):
+    """
+    Name one output per replica by inserting the trajectory name before the extension of
+    `output`, or the replica index if trajectory names are not unique.
+    """
+    output_root, output_ext = os.path.splitext(output)
+    traj_names = [os.path.splitext(os.path.basename(traj))[0] for traj in trajs]
+    if len(set(traj_names)) != len(traj_names):
+        traj_names = [str(replica_idx) for replica_idx in range(len(trajs))]
+    return ["%s_%s%s" % (output_root, traj_name, output_ext) for traj_name in traj_names]
+
+
+def process_engine_args(args):
+    engine_options = {
+        "neighbor_engine": args.neighbor_engine,
+        "hbond_engine": args.hbond_engine,
+        "shell_skin": args.shell_skin,
+        "verlet_skin": args.verlet_skin
+    }
+    return engine_options
+
+
 def main(traj_required=True):
     if "--help" in sys.argv or "-h" in sys.argv:
         print(HELP_STR)
@@ -182,13 +305,20 @@ def main(traj_required=True):
     # Parse required and optional arguments
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument('--topology', type=str, required=True, help='path to topology file ')
-    parser.add_argument('--trajectory', type=str, required=traj_required, default=None, help='path to trajectory file')
+    parser.add_argument('--trajectory', type=str, nargs="+", required=traj_required, default=None, help='path to trajectory file, or several paths or glob patterns of replicas')
     parser.add_argument('--output', type=str, required=True, help='path to output file')
     parser.add_argument('--cores', type=int, default=6, help='number of cpu cores to parallelize upon')
     parser.add_argument('--solv', type=str, default="TIP3", help='resname of solvent molecule')
     parser.add_argument('--sele', type=str, default=None, help='atom selection query in VMD')
     parser.add_argument('--stride', type=int, default=1, help='skip frames with specified frequency')
+    parser.add_argument('--begin', type=int, default=0, help='first trajectory frame to compute contacts for')
+    parser.add_argument('--end', type=int, default=None, help='last trajectory frame to compute contacts for (inclusive)')
     parser.add_argument('--ligand', type=str, nargs="+", default=[], help='resname of ligand molecule')
+    parser.add_argument('--checkpoint', type=str, default=None, help='directory in which completed fragments are kept until the run finishes')
+    parser.add_argument('--resume', action="store_true", help='skip fragments completed in the checkpoint directory by an interrupted run')
+    parser.add_argument('--output_format', type=str, default="tsv", choices=CONTACT_FORMATS, help='format of the output file [default = tsv]')
+    parser.add_argument('--frame_index', action="store_true", help='also write a frame index next to the output')
+    parser.add_argument('--profile', type=str, default=None, help='path of a per-stage and per-itype profiling report (.json or .tsv)')
 
     # Parse geometric criterion arguments
     parser.add_argument('--sb_cutoff_dist', type=float, default=4.0, help='cutoff for distance between anion and cation atoms [default = 4.0 angstroms]')
@@ -204,6 +334,13 @@ def main(traj_required=True):
     parser.add_argument('--hbond_cutoff_ang', type=float, default=70, help='cutoff for angle between donor hydrogen acceptor [default = 70 degrees]')
     parser.add_argument('--vdw_epsilon', type=float, default=0.5, help='amount of padding for calculating vanderwaals contacts [default = 0.5 angstroms]')
     parser.add_argument('--vdw_res_diff', type=int, default=2, help='minimum residue distance for which to consider computing vdw interactions')
+    parser.add_argument('--water_bridge_depth', type=int, default=2, help='largest number of waters in a water bridge, values above 2 add wb3, lwb3 and deeper bridges [default = 2]')
+
+    # Parse engine arguments
+    parser.add_argument('--neighbor_engine', type=str, default="vmd", choices=NEIGHBOR_ENGINES, help='neighbor search used to find candidate atom pairs [default = vmd]')
+    parser.add_argument('--hbond_engine', type=str, default="vmd", choices=HBOND_ENGINES, help='hydrogen bond detection used for hb and lhb [default = vmd]')
+    parser.add_argument('--shell_skin', type=float, default=0, help='margin of the tracked water shells of hb and lhb, typically 2.0 angstroms, 0 turns tracking off [default = 0]')
+    parser.add_argument('--verlet_skin', type=float, default=0, help='margin of Verlet lists of vdw candidate pairs reused across frames, 0 searches every frame from scratch [default = 0]')
 
 
     parser.add_argument('--itypes',
@@ -226,12 +363,26 @@ def main(traj_required=True):
     top = args.topology
     traj = args.trajectory
     output = args.output
+    if traj is not None:
+        traj = expand_trajectory_args(traj)
+        if len(traj) == 1:
+            traj = traj[0]
+        else:
+            output = replica_output_paths(output, traj)
     cores = args.cores
     ligand = args.ligand
     solv = args.solv
     sele = args.sele
     stride = args.stride
+    beg_frame = args.begin
+    end_frame = args.end
+    checkpoint = args.checkpoint
+    resume = args.resume
+    output_format = args.output_format
+    frame_index = args.frame_index
+    profile = args.profile
     geom_criterion_values = process_geometric_criterion_args(args)
+    engine_options = process_engine_args(args)
 
     # Check interaction types
     all_itypes = ["sb", "pc", "ps", "ts", "vdw", "hb", "lhb"]
@@ -245,20 +396,57 @@ def main(traj_required=True):
 
         itypes = args.itypes
 
+    if resume and checkpoint is None:
+        print("Error: --resume requires --checkpoint")
+        exit(1)
+
+    if output_format == "int" and frame_index:
+        print("Error: --frame_index can't be used with --output_format int, interval files have no frame index")
+        exit(1)
+
+    if stride < 1 or beg_frame < 0 or (end_frame is not None and end_frame < beg_frame):
+        print("Error: --begin and --end must define a non-empty frame window and --stride must be positive")
+        exit(1)
+
+    if engine_options["neighbor_engine"] == "kdtree":
+        try:
+            import scipy
+        except ImportError:
+            print("Error: --neighbor_engine kdtree requires scipy, install it or use --neighbor_engine cell")
+            exit(1)
+
+    if engine_options["shell_skin"] < 0 or engine_options["verlet_skin"] < 0:
+        print("Error: --shell_skin and --verlet_skin must not be negative")
+        exit(1)
+
+    if not 1 <= geom_criterion_values["WATER_BRIDGE_DEPTH"] <= MAX_WATER_BRIDGE_DEPTH:
+        print("Error: --water_bridge_depth must be between 1 and %d" % MAX_WATER_BRIDGE_DEPTH)
+        exit(1)
+
     # Begin computation
     tic = datetime.datetime.now()
-    compute_contacts(top, traj, output, itypes, geom_criterion_values, cores, stride, solv, sele, ligand)
+    compute_contacts(top, traj, output, itypes, geom_criterion_values, cores, stride, solv, sele, ligand, engine_options, checkpoint, resume, output_format, frame_index, beg_frame, end_frame, profile)
     toc = datetime.datetime.now()
     print("Computation time: " + str((toc-tic).total_seconds()) + " seconds")
 
     print("topology=%s" % top)
-    print("trajectory=%s" % traj)
-    print("output=%s" % output)
+    print("trajectory=%s" % (",".join(traj) if isinstance(traj, list) else traj))
+    print("output=%s" % (",".join(output) if isinstance(output, list) else output))
     print("cores=%s" % cores)
     print("ligand=%s" % ",".join(ligand))
     print("solv=%s" % solv)
     print("sele=%s" % sele)
     print("stride=%s" % stride)
+    print("begin=%s" % beg_frame)
+    print("end=%s" % end_frame)
+    print("neighbor_engine=%s" % engine_options["neighbor_engine"])
+    print("hbond_engine=%s" % engine_options["hbond_engine"])
+    print("shell_skin=%s" % engine_options["shell_skin"])
+    print("verlet_skin=%s" % engine_options["verlet_skin"])
+    print("checkpoint=%s" % checkpoint)
+    print("output_format=%s" % output_format)
+    print("frame_index=%s" % frame_index)
+    print("profile=%s" % profile)
 
 
 if __name__ == "__main__":
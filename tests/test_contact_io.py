@@ -0,0 +1,65 @@
+import os
+import sys
+from collections import Counter
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from contact_calc.contact_io import read_contacts, add_contact_intervals, merge_contact_intervals, \
+    write_interval_header, write_interval_contacts, read_interval_contacts
+
+TSV_CONTACTS = [
+    (0, "wb", "A:ASP:100:OD1", "A:ILE:67:O", "W:TIP3:7:OH2"),
+    (0, "hbbb", "A:ILE:12:N", "A:THR:20:O"),
+    (0, "wb", "A:ASP:100:OD1", "A:ILE:67:O", "W:TIP3:7:OH2"),
+    (2, "wb", "A:ASP:100:OD1", "A:ILE:67:O", "W:TIP3:7:OH2"),
+    (2, "hbbb", "A:ILE:12:N", "A:THR:20:O"),
+    (4, "wb", "A:ASP:100:OD1", "A:ILE:67:O", "W:TIP3:7:OH2"),
+    (4, "wb", "A:ASP:100:OD1", "A:ILE:67:O", "W:TIP3:7:OH2"),
+    (6, "wb", "A:ASP:100:OD1", "A:ILE:67:O", "W:TIP3:7:OH2"),
+    (6, "wb", "A:ASP:100:OD1", "A:ILE:67:O", "W:TIP3:7:OH2"),
+    (6, "hbbb", "A:ILE:12:N", "A:THR:20:O"),
+    (8, "wb", "A:ASP:100:OD1", "A:ILE:67:O", "W:TIP3:7:OH2"),
+]
+
+
+def write_tsv(path, contacts, stride):
+    with open(path, "w") as contact_fd:
+        contact_fd.write("# total_frames:5 interaction_types:hb,wb first_frame:0 stride:%d\n" % stride)
+        for contact in contacts:
+            contact_fd.write("%d\t%s\n" % (contact[0], "\t".join(contact[1:])))
+
+
+def write_intervals(path, interval_contacts, stride):
+    with open(path, "wb") as output_fd:
+        write_interval_header(output_fd, 5, ["hb", "wb"], 0, stride)
+        write_interval_contacts(output_fd, interval_contacts)
+
+
+def frame_contacts(contacts):
+    """ Contacts of each frame regardless of their order within the frame """
+    frames = {}
+    for contact in contacts:
+        frames.setdefault(contact[0], Counter())[contact] += 1
+    return frames
+
+
+def test_interval_round_trip_keeps_repeated_contacts(tmp_path):
+    tsv_path, int_path = str(tmp_path / "contacts.tsv"), str(tmp_path / "contacts.int")
+    write_tsv(tsv_path, TSV_CONTACTS, 2)
+    write_intervals(int_path, add_contact_intervals({}, read_contacts(tsv_path), 2), 2)
+
+    round_trip = list(read_contacts(int_path))
+    assert [contact[0] for contact in round_trip] == sorted(contact[0] for contact in TSV_CONTACTS)
+    assert frame_contacts(round_trip) == frame_contacts(TSV_CONTACTS)
+
+    in_range = list(read_contacts(int_path, frame_range=(3, 6)))
+    assert frame_contacts(in_range) == frame_contacts(c for c in TSV_CONTACTS if 3 <= c[0] <= 6)
+
+
+def test_merged_fragment_intervals_match_whole_run(tmp_path):
+    whole = add_contact_intervals({}, TSV_CONTACTS, 2)
+    merged = add_contact_intervals({}, TSV_CONTACTS[0:4], 2)
+    fragment_path = str(tmp_path / "fragment.int")
+    write_intervals(fragment_path, add_contact_intervals({}, TSV_CONTACTS[4:], 2), 2)
+    merge_contact_intervals(merged, read_interval_contacts(fragment_path))
+
+    assert merged == whole
+    assert whole[TSV_CONTACTS[0][1:]] == [[0, 2, 2], [2, 4, 1], [4, 8, 2], [8, 10, 1]]
@@ -0,0 +1,66 @@
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+# contact_calc.hbonds imports VMD at module level, the native engine itself only needs NumPy
+pytest.importorskip("vmd")
+from contact_calc.hbonds import calc_native_donor_acceptor_pairs
+from contact_calc.interaction_topology import gen_donor_hydrogens
+
+HBOND_CUTOFF_DISTANCE = 3.5
+HBOND_CUTOFF_ANGLE = 70
+
+
+def native_hbonds(coords, bonds, hydrogens):
+    """ Donor acceptor pairs of the native engine among all atoms of `coords` """
+    coords = np.array(coords, dtype=np.float32)
+    hydrogen_mask = np.zeros(len(coords), dtype=bool)
+    hydrogen_mask[hydrogens] = True
+    interaction_topology = {"hydrogen_mask": hydrogen_mask,
+                            "donor_hydrogens": gen_donor_hydrogens(np.array(bonds, dtype=np.int64).reshape(-1, 2),
+                                                                   hydrogen_mask)}
+    donors, acceptors = calc_native_donor_acceptor_pairs(coords, interaction_topology, np.arange(len(coords)),
+                                                         HBOND_CUTOFF_DISTANCE, HBOND_CUTOFF_ANGLE, "cell")
+    return sorted(zip(donors, acceptors))
+
+
+def bent_acceptor(deviation, hydrogen_acceptor_dist=2.0):
+    """ Acceptor position for a donor at the origin and its hydrogen at (1, 0, 0) with the D-H-A angle
+    deviating `deviation` degrees from 180 """
+    rad = np.radians(deviation)
+    return [1 + hydrogen_acceptor_dist * np.cos(rad), hydrogen_acceptor_dist * np.sin(rad), 0]
+
+
+@pytest.mark.parametrize("acceptor_dist, expected", [(HBOND_CUTOFF_DISTANCE - 0.05, [(0, 2)]),
+                                                     (HBOND_CUTOFF_DISTANCE + 0.05, [])])
+def test_linear_hbond_at_distance_cutoff(acceptor_dist, expected):
+    # Donor 0 with hydrogen 1 pointing straight at acceptor 2, which has no hydrogen to donate
+    coords = [[0, 0, 0], [1, 0, 0], [acceptor_dist, 0, 0]]
+    assert native_hbonds(coords, [(0, 1)], [1]) == expected
+
+
+@pytest.mark.parametrize("deviation, expected", [(HBOND_CUTOFF_ANGLE - 5, [(0, 2)]),
+                                                 (HBOND_CUTOFF_ANGLE + 5, [])])
+def test_bent_hbond_at_angle_cutoff(deviation, expected):
+    coords = [[0, 0, 0], [1, 0, 0], bent_acceptor(deviation)]
+    assert native_hbonds(coords, [(0, 1)], [1]) == expected
+
+
+def test_donor_without_hydrogen():
+    assert native_hbonds([[0, 0, 0], [2.8, 0, 0]], [], []) == []
+
+
+def test_hydrogens_are_neither_donor_nor_acceptor():
+    # Hydrogens 1 and 3 are within the distance cutoff of every other atom
+    coords = [[0, 0, 0], [1, 0, 0], [2.8, 0, 0], [1.8, 0.5, 0]]
+    hbonds = native_hbonds(coords, [(0, 1), (2, 3)], [1, 3])
+    assert hbonds
+    assert all(donor not in (1, 3) and acceptor not in (1, 3) for donor, acceptor in hbonds)
+
+
+def test_both_atoms_of_a_pair_donate():
+    # Donors 0 and 2 each point a hydrogen at the other
+    coords = [[0, 0, 0], [1, 0, 0], [2.8, 0, 0], [1.8, 0, 0]]
+    assert native_hbonds(coords, [(0, 1), (2, 3)], [1, 3]) == [(0, 2), (2, 0)]